@@ -0,0 +1,75 @@
+"""Memory per dobject, with the stored fields kept the way dobjects used to
+keep them (in the instance's __dict__, as a list of tuples) and the way they
+are kept now (in slots, packed into one record).
+
+The dobjects alone are measured, and the state keeper as a whole, in which the
+dobjects are also entries of the zone and visibility indexes.
+
+    python benchmarks/dobject_memory.py
+"""
+import tracemalloc
+
+from pandamonium.constants import field_types
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
+from pandamonium.state_server import SimpleStateKeeper
+
+
+NUM_DOBJECTS = 100000
+
+
+class Avatar(DClass):
+    dfield_name = ((field_types.STRING, ), fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_position = ((field_types.FLOAT,
+                        field_types.FLOAT,
+                        field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_score = ((field_types.CHANNEL, ), fp.AI_SEND|fp.OWNER_RECEIVE|fp.RAM)
+
+
+class DictAvatar:
+    """The former layout of a dobject."""
+    def __init__(self, dobject_id, fields, state_server=None):
+        self.dobject_id = dobject_id
+        self.state_server = state_server
+        self.storage = fields
+        self.owner = None
+        self.ai = None
+
+
+def fields(n):
+    return [("Avatar {}".format(n), ), (n * 0.5, n * 0.25, 1.0), (n, )]
+
+
+def measure(create):
+    tracemalloc.start()
+    kept = create()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size / NUM_DOBJECTS
+
+
+def dobjects(dclass):
+    return [dclass(n, fields(n)) for n in range(NUM_DOBJECTS)]
+
+
+def state_keeper():
+    sk = SimpleStateKeeper(dict(Avatar=Avatar))
+    for n in range(NUM_DOBJECTS):
+        sk.create_dobject(n, 0, fields(n))
+        sk.add_presence(n, n % 100)
+    return sk
+
+
+def main():
+    print("Bytes per dobject, {} dobjects".format(NUM_DOBJECTS))
+    print("{:>24} {:>8.0f}".format("__dict__ + tuples",
+                                   measure(lambda: dobjects(DictAvatar))))
+    print("{:>24} {:>8.0f}".format("__slots__ + packed",
+                                   measure(lambda: dobjects(Avatar))))
+    print("{:>24} {:>8.0f}".format("state keeper", measure(state_keeper)))
+
+
+if __name__ == '__main__':
+    main()
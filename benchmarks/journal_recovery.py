@@ -0,0 +1,80 @@
+"""Time it takes to restore a state server from its journal, once from the
+journal alone, and once from a snapshot of the same state.
+
+    python benchmarks/journal_recovery.py [number of dobjects]
+"""
+import sys
+import tempfile
+import time
+
+from pandamonium.constants import field_types
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
+from pandamonium.journal import StateJournal
+from pandamonium.state_server import StateServer
+
+
+UPDATES_PER_DOBJECT = 4
+
+
+class Avatar(DClass):
+    dfield_name = ((field_types.STRING, ), fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_position = ((field_types.FLOAT,
+                        field_types.FLOAT,
+                        field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+
+
+class NullMessageDirector:
+    def create_message(self, *message):
+        pass
+
+    def create_multicast_message(self, *message):
+        pass
+
+
+def start_state_server(directory):
+    state_server = StateServer(
+        dict(Avatar=Avatar),
+        journal=StateJournal(directory, snapshot_interval=None),
+    )
+    state_server.message_director = NullMessageDirector()
+    return state_server
+
+
+def populate(directory, num_dobjects):
+    state_server = start_state_server(directory)
+    for n in range(num_dobjects):
+        state_server.create_dobject(n, 0, [("Avatar {}".format(n), ),
+                                           (0.0, 0.0, 0.0)])
+        state_server.set_ai(1000, n)
+        state_server.add_presence(n, n % 100)
+        for update in range(UPDATES_PER_DOBJECT):
+            state_server.set_field(1000, n, 1, (update, 0.0, 0.0))
+    state_server.shutdown()
+
+
+def time_recovery(directory):
+    start = time.perf_counter()
+    state_server = start_state_server(directory)
+    duration = time.perf_counter() - start
+    return state_server, duration
+
+
+def main():
+    num_dobjects = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        populate(directory, num_dobjects)
+        state_server, duration = time_recovery(directory)
+        print("{} dobjects from journal:  {:.2f}s".format(num_dobjects,
+                                                         duration))
+        state_server.snapshot_journal()
+        state_server.shutdown()
+        state_server, duration = time_recovery(directory)
+        print("{} dobjects from snapshot: {:.2f}s".format(num_dobjects,
+                                                         duration))
+        state_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
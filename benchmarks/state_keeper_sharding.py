@@ -0,0 +1,108 @@
+"""Field update throughput of the state keeper by number of worker threads.
+
+Each worker sets fields on the dobjects of its own zone, while one more thread
+keeps setting and unsetting interest, which takes the state lock. This is run
+once with all dobjects in a single shard, which is the default, and once with
+SHARD_COUNT shards.
+
+Note that on an interpreter with a GIL, the threads still take turns at running
+Python code; there, this shows how much the locking itself serializes updates,
+and the numbers only scale with the workers on a free-threaded build.
+
+    python benchmarks/state_keeper_sharding.py
+"""
+import sys
+import time
+from threading import Thread, Event
+
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
+from pandamonium.state_server import SimpleStateKeeper
+
+
+DOBJECTS_PER_ZONE = 64
+UPDATES_PER_WORKER = 20000
+WORKER_COUNTS = (1, 2, 4, 8)
+SHARD_COUNT = 16
+
+
+class Mover(DClass):
+    dfield_position = ((float, float, float), fp.CLIENT_SEND|fp.CLIENT_RECEIVE)
+
+
+class NullMessageDirector:
+    def create_message(self, *message):
+        pass
+
+    def create_multicast_message(self, *message):
+        pass
+
+
+class StateKeeper(SimpleStateKeeper):
+    individual_channel = 17
+    all_connections = 1
+
+    def __init__(self, dclasses, shard_count):
+        self.shard_count = shard_count
+        super().__init__(dclasses)
+        self.message_director = NullMessageDirector()
+
+
+def setup(workers, shard_count):
+    sk = StateKeeper(dict(Mover=Mover), shard_count)
+    for zone in range(workers):
+        sk.set_interest(100000 + zone, zone)
+        for n in range(DOBJECTS_PER_ZONE):
+            dobject_id = zone * DOBJECTS_PER_ZONE + n
+            sk.create_dobject(dobject_id, 0, [])
+            sk.add_presence(dobject_id, zone)
+    return sk
+
+
+def run(workers, shard_count):
+    sk = setup(workers, shard_count)
+    stop_churning = Event()
+
+    def update(zone):
+        first = zone * DOBJECTS_PER_ZONE
+        for n in range(UPDATES_PER_WORKER):
+            dobject_id = first + n % DOBJECTS_PER_ZONE
+            sk.set_field(0, dobject_id, 0, (1.0, 2.0, 3.0))
+
+    def churn():
+        while not stop_churning.is_set():
+            sk.set_interest(200000, 0)
+            sk.unset_interest(200000, 0)
+
+    churner = Thread(target=churn)
+    threads = [Thread(target=update, args=(zone, ))
+               for zone in range(workers)]
+    churner.start()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    stop_churning.set()
+    churner.join()
+    return workers * UPDATES_PER_WORKER / duration
+
+
+def main():
+    gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print("Python {}, GIL {}".format(
+        sys.version.split()[0],
+        "enabled" if gil_enabled else "disabled",
+    ))
+    print("{:>8} {:>16} {:>16}".format("workers", "1 shard", "{} shards".format(
+        SHARD_COUNT,
+    )))
+    for workers in WORKER_COUNTS:
+        single = run(workers, 1)
+        sharded = run(workers, SHARD_COUNT)
+        print("{:>8} {:>14.0f}/s {:>14.0f}/s".format(workers, single, sharded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Time it takes a client repository to create the views of the dobjects in a
+zone that it enters.
+
+    python benchmarks/view_creation.py [number of dobjects]
+"""
+import sys
+import time
+
+from pandamonium.constants import field_types
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass, ClientView
+
+
+class Avatar(DClass):
+    dfield_move_command = ((field_types.FLOAT, field_types.FLOAT),
+                           fp.OWNER_SEND|fp.AI_RECEIVE)
+    dfield_name = ((field_types.STRING, ), fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_position = ((field_types.FLOAT,
+                        field_types.FLOAT,
+                        field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_emote = ((field_types.STRING, ), fp.OWNER_SEND|fp.CLIENT_RECEIVE)
+
+
+class AvatarView(ClientView, Avatar):
+    def on_name(self, name):
+        pass
+
+    def on_position(self, x, y, z):
+        pass
+
+    def do_move_command(self, x, y):
+        return (x, y)
+
+    def do_emote(self, emote):
+        return (emote, )
+
+
+def main():
+    num_dobjects = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    fields = [("Bob", ), (1.0, 2.0, 3.0)]
+    start = time.perf_counter()
+    for dobject_id in range(num_dobjects):
+        AvatarView(None, dobject_id, fields)
+    duration = time.perf_counter() - start
+    print("{} client views: {:.2f}s".format(num_dobjects, duration))
+
+
+if __name__ == '__main__':
+    main()
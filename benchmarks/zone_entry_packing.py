@@ -0,0 +1,68 @@
+"""Time it takes a client agent to pack the CREATE_DOBJECT_VIEWs of a zone's
+dobjects for each player that enters the zone, with the fields given as
+tuples (as the state keeper used to send them), and as the dobjects'
+StoredFields.
+
+    python benchmarks/zone_entry_packing.py
+"""
+from threading import Lock
+import time
+
+from pandamonium.constants import field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
+from pandamonium.packers import ClientPacker
+
+
+NUM_DOBJECTS = 1000
+NUM_PLAYERS = 200
+
+
+class Avatar(DClass):
+    dfield_name = ((field_types.STRING, ), fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_position = ((field_types.FLOAT,
+                        field_types.FLOAT,
+                        field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_score = ((field_types.CHANNEL, ), fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+
+
+class Packer(ClientPacker):
+    def __init__(self):
+        self.dclasses_by_id = [Avatar]
+        self.dclasses_by_dobject_id = {}
+        self.dclasses_lock = Lock()
+
+
+def zone_entries(packer, dobjects, fields):
+    start = time.perf_counter()
+    for _player in range(NUM_PLAYERS):
+        for dobject in dobjects:
+            packer.pack_message(
+                msgtypes.CREATE_DOBJECT_VIEW,
+                dobject.dobject_id,
+                0,
+                fields(dobject),
+            )
+    return time.perf_counter() - start
+
+
+def main():
+    packer = Packer()
+    dobjects = [Avatar(n, [("Avatar {}".format(n), ), (n * 0.5, 0.0, 1.0),
+                           (n, )])
+                for n in range(NUM_DOBJECTS)]
+    print("{} players entering a zone of {} dobjects".format(NUM_PLAYERS,
+                                                           NUM_DOBJECTS))
+    print("{:>14} {:.2f}s".format(
+        "tuples",
+        zone_entries(packer, dobjects, lambda dobject: dobject.storage),
+    ))
+    print("{:>14} {:.2f}s".format(
+        "StoredFields",
+        zone_entries(packer, dobjects, lambda dobject: dobject.stored_fields()),
+    ))
+
+
+if __name__ == '__main__':
+    main()
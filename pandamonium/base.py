@@ -6,4 +6,9 @@ class BaseComponent:
     def handle_message(self, from_channel, to_channel, message_type, *args):
         raise NotImplementedError
 
+    def handle_multicast_message(self, from_channel, to_channels, message_type,
+                                 *args):
+        for to_channel in to_channels:
+            self.handle_message(from_channel, to_channel, message_type, *args)
+
 
@@ -7,6 +7,13 @@ class field_policies:
     AI_RECEIVE = 1 << 5  # Only the dobject's AI receives updates
     RAM = 1 << 6  # State is stored for the server's runtime
     PERSIST = 1 << 7  # State is persisted, i.e. on disk
+    UNRELIABLE = 1 << 8  # Updates may be lost; only the latest value matters
+
+
+class overflow_policies:
+    DISCONNECT = 0  # Disconnect the client
+    DROP_UNRELIABLE = 1  # Drop the oldest queued UNRELIABLE field updates
+    COLLAPSE_FIELDS = 2  # Keep only the latest queued update of each field
 
 
 class channels:
@@ -16,15 +23,19 @@ class channels:
     ALL_CLIENTS = 3
     MESSAGE_DIRECTORS = (10, 99)
     STATE_SERVERS = (100, 999)
+    # Each state server owns the block of this many dobject IDs that belongs
+    # to its channel, see util.state_server_channel()
+    DOBJECT_IDS_PER_STATE_SERVER = 1000000
     AIS = (1000, 9999)
     CLIENTS = (100000, 999999)
 
 
 class FixedSizeFieldType:
-    def __init__(self, ftype, length, name):
+    def __init__(self, ftype, length, name, struct_format):
         self.ftype = ftype
         self.length = length
         self.name = name
+        self.struct_format = struct_format
 
     def __repr__(self):
         return self.name
@@ -48,17 +59,22 @@ class ListFieldType:
 
 
 class field_types:
-    CHANNEL = FixedSizeFieldType(int, 4, "CHANNEL")
-    ZONE = FixedSizeFieldType(int, 4, "ZONE")
-    DCLASS = FixedSizeFieldType(int, 2, "DCLASS")
-    DOBJECT_ID = FixedSizeFieldType(int, 4, "DOBJECT_ID")
-    FIELD_ID = FixedSizeFieldType(int, 2, "FIELD_ID")
+    CHANNEL = FixedSizeFieldType(int, 4, "CHANNEL", 'i')
+    ZONE = FixedSizeFieldType(int, 4, "ZONE", 'i')
+    DCLASS = FixedSizeFieldType(int, 2, "DCLASS", 'h')
+    DOBJECT_ID = FixedSizeFieldType(int, 4, "DOBJECT_ID", 'i')
+    FIELD_ID = FixedSizeFieldType(int, 2, "FIELD_ID", 'h')
     FIELD_VALUE = ListFieldType("FIELD_VALUE")
     FIELD_VALUES = ListFieldType("FIELD_VALUES")
-    MESSAGE_TYPE = FixedSizeFieldType(int, 2, "MESSAGE_TYPE")
+    MESSAGE_TYPE = FixedSizeFieldType(int, 2, "MESSAGE_TYPE", 'h')
     STRING = VariableSizeFieldType(str, "STRING")
-    FLOAT = FixedSizeFieldType(float, 4, "FLOAT")
-    TOKEN = FixedSizeFieldType(int, 4, "TOKEN")
+    FLOAT = FixedSizeFieldType(float, 4, "FLOAT", 'f')
+    TOKEN = FixedSizeFieldType(int, 4, "TOKEN", 'i')
+    FRAME_LENGTH = FixedSizeFieldType(int, 4, "FRAME_LENGTH", 'I')
+    SEQUENCE = FixedSizeFieldType(int, 4, "SEQUENCE", 'I')
+    PORT = FixedSizeFieldType(int, 2, "PORT", 'H')
+    DELTA_MASK = FixedSizeFieldType(int, 2, "DELTA_MASK", 'H')
+    QUANTIZED_FLOAT = FixedSizeFieldType(int, 2, "QUANTIZED_FLOAT", 'h')
 
 
 class MsgType:
@@ -68,8 +84,13 @@ class MsgType:
         self.fields = fields
 
     def __eq__(self, other):
+        if not isinstance(other, MsgType):
+            return NotImplemented
         return self.num_id == other.num_id
 
+    def __hash__(self):
+        return hash(self.num_id)
+
     def __repr__(self):
         return self.str_repr
 
@@ -104,6 +125,16 @@ class msgtypes:
         field_types.CHANNEL, # client
         field_types.STRING, # reason
     )
+    # Tell a state server process its own channel
+    STATE_SERVER_CHANNEL_ASSIGNED = MsgType(
+        20,
+        "STATE_SERVER_CHANNEL_ASSIGNED",
+        field_types.CHANNEL,
+    )
+    # MessageDirector -> peer MessageDirectors
+    MD_SUBSCRIBE = MsgType(30, "MD_SUBSCRIBE", field_types.CHANNEL)
+    # MessageDirector -> peer MessageDirectors
+    MD_UNSUBSCRIBE = MsgType(31, "MD_UNSUBSCRIBE", field_types.CHANNEL)
     # -> client repo
     CONNECTED = MsgType(1000, "CONNECTED")
     # -> client repo
@@ -119,6 +150,13 @@ class msgtypes:
         field_types.CHANNEL, # client
         field_types.STRING, # reason
     )
+    # client agent -> client repo over TCP, and back over UDP
+    UNRELIABLE_CHANNEL = MsgType(
+        1003,
+        "UNRELIABLE_CHANNEL",
+        field_types.TOKEN,
+        field_types.PORT,
+    )
     # ai repo -> state server
     SET_INTEREST = MsgType(
         2000,
@@ -198,6 +236,12 @@ class msgtypes:
         "BECOME_OWNER",
         field_types.DOBJECT_ID,
     )
+    # state server -> interested
+    DESTROY_DOBJECT_VIEW = MsgType(
+        2023,
+        "DESTROY_DOBJECT_VIEW",
+        field_types.DOBJECT_ID,
+    )
     # repo -> state_server
     SET_FIELD = MsgType(
         2030,
@@ -214,6 +258,16 @@ class msgtypes:
         field_types.FIELD_ID,
         field_types.FIELD_VALUE,
     )
+    # client agent -> client repo; the components of a FIELD_UPDATE that
+    # changed since the last one of the field
+    FIELD_DELTA = MsgType(
+        2032,
+        "FIELD_DELTA",
+        field_types.DOBJECT_ID,
+        field_types.FIELD_ID,
+        field_types.DELTA_MASK,
+        field_types.FIELD_VALUE,
+    )
 
 all_message_types = [
     msgtypes.TEST_NO_ARGS,
@@ -223,9 +277,13 @@ all_message_types = [
     msgtypes.CLIENT_CONNECTED,
     msgtypes.CLIENT_DISCONNECTED,
     msgtypes.DISCONNECT_CLIENT,
+    msgtypes.STATE_SERVER_CHANNEL_ASSIGNED,
+    msgtypes.MD_SUBSCRIBE,
+    msgtypes.MD_UNSUBSCRIBE,
     msgtypes.CONNECTED,
     msgtypes.DISCONNECTED,
     msgtypes.DISCONNECT,
+    msgtypes.UNRELIABLE_CHANNEL,
     msgtypes.SET_INTEREST,
     msgtypes.UNSET_INTEREST,
     msgtypes.CREATE_DOBJECT,
@@ -237,8 +295,10 @@ all_message_types = [
     msgtypes.CREATE_DOBJECT_VIEW,
     msgtypes.CREATE_AI_VIEW,
     msgtypes.BECOME_OWNER,
+    msgtypes.DESTROY_DOBJECT_VIEW,
     msgtypes.SET_FIELD,
     msgtypes.FIELD_UPDATE,
+    msgtypes.FIELD_DELTA,
 ]
 
 
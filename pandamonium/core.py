@@ -1,10 +1,13 @@
-from threading import Lock
+from threading import Thread, Lock, Semaphore, local
+from queue import Queue, Empty
+from functools import partial
+from itertools import count
 import logging
 
 from pandamonium.base import BaseComponent
 from pandamonium.state_server import StateServer
 from pandamonium.constants import channels, msgtypes
-from pandamonium.util import IDGenerator
+from pandamonium.util import IDGenerator, state_server_channel
 
 
 logger = logging.getLogger(__name__)
@@ -37,6 +40,29 @@ class BaseAgent(BaseComponent):
                 *args,
             )
 
+    def handle_multicast_message(self, from_channel, to_channels, message_type,
+                                 *args):
+        """Message for several of the agent's connections."""
+        logger.debug("Agent {} got multicast to handle: {} -> {} ({})".format(
+            self, from_channel, to_channels, message_type,
+        ))
+        if self.all_connections in to_channels:
+            self.handle_broadcast_message(
+                from_channel,
+                self.all_connections,
+                message_type,
+                *args,
+            )
+            to_channels = [to_channel for to_channel in to_channels
+                           if to_channel != self.all_connections]
+        if to_channels:
+            self.handle_multicast_connection_message(
+                from_channel,
+                to_channels,
+                message_type,
+                *args,
+            )
+
     def get_dobject_dclass(self, dobject_id):
         self.state_server.get_dobject_fields(dobject_id)
 
@@ -77,6 +103,23 @@ class AIAgent(BaseAgent):
         )
 
 
+    def handle_incoming_frame(self, frame):
+        """Pass-through routing: Only the channels of the framed message are
+        read, and it is left to the MessageDirector to decode it if any of
+        its recipients needs it decoded."""
+        start, end = self.frame_bounds(frame, 0)
+        from_channel, to_channel = self.peek_channels(frame, start)
+        logger.debug("AIAgent got incoming frame to route: {} -> {}".format(
+            from_channel, to_channel,
+        ))
+        self.message_director.route_frame(
+            from_channel,
+            to_channel,
+            frame,
+            partial(self.unpack_frame, frame, start, end),
+        )
+
+
 class ClientAgent(BaseAgent):
     all_connections = channels.ALL_CLIENTS
     connection_ids = channels.CLIENTS
@@ -115,16 +158,127 @@ class ClientAgent(BaseAgent):
             raise NotImplementedError
 
 
+class StateServerAgent(AIAgent):
+    """Serves StateServers that run in processes of their own. They connect
+    like AIs do, and speak the same protocol, but each gets a channel from the
+    range of state server channels, and with it the range of dobject IDs that
+    it owns."""
+    all_connections = channels.ALL_STATE_SERVERS
+    connection_ids = channels.STATE_SERVERS
+
+    def handle_connection(self, state_server_id, addr):
+        logger.info("Connection from state server {} ({})".format(
+            state_server_id,
+            addr,
+        ))
+        self.message_director.create_message(
+            self.all_connections,
+            state_server_id,
+            msgtypes.STATE_SERVER_CHANNEL_ASSIGNED,
+            state_server_id,
+        )
+
+
+# Messages for all state servers that concern only a single dobject, and the
+# index of its ID among their arguments. The MessageDirector sends these only to
+# the state server that owns the dobject.
+dobject_addressed_messages = {
+    msgtypes.ADD_TO_ZONE: 0,
+    msgtypes.REMOVE_FROM_ZONE: 0,
+    msgtypes.SET_AI: 1,
+    msgtypes.SET_OWNER: 1,
+    msgtypes.SET_FIELD: 0,
+}
+
+
+# Marks the threads of DispatchWorkers.
+_dispatch_state = local()
+
+
+class DispatchWorker:
+    """Handles the messages for one component on a thread of its own, in
+    batches. Producers are throttled once max_queued of their messages are
+    waiting; workers are not, as two workers that wait for space in each
+    other's queue would deadlock."""
+    def __init__(self, component, max_queued, batch_size):
+        self.component = component
+        self.batch_size = batch_size
+        self.queue = Queue()
+        self.slots = Semaphore(max_queued)
+        self.thread = Thread(
+            target=self._work,
+            name="Dispatch thread ({})".format(component),
+        )
+        self.thread.start()
+
+    def put(self, method, args):
+        throttled = not getattr(_dispatch_state, 'is_worker', False)
+        if throttled:
+            self.slots.acquire()
+        self.queue.put((method, args, throttled))
+
+    def _work(self):
+        _dispatch_state.is_worker = True
+        keep_running = True
+        while keep_running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get(block=False))
+            except Empty:
+                pass
+            for item in batch:
+                if item is None:
+                    keep_running = False
+                else:
+                    method, args, throttled = item
+                    try:
+                        method(*args)
+                    except Exception:
+                        logger.exception("{} failed to handle message"
+                                         "".format(self.component))
+                    if throttled:
+                        self.slots.release()
+                self.queue.task_done()
+        logger.info("Stopping dispatch thread for {}".format(self.component))
+
+    def join_queue(self):
+        self.queue.join()
+
+    def shutdown(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
 # TODO
 # _ Implement wait_for_ai: If True, don't start up the client agent before an
 #   AIRepository has connected. The idea is to let that repo do necessary
 #   initial setup before a client has the chance to connect. Maybe there should
 #   be a whole sub-protocol about this setup phase?
 class MessageDirector:
+    dispatch_queue_size = 10000
+    dispatch_batch_size = 100
+
     def __init__(self, state_server=None,client_agent=None, ai_agent=None,
-                 wait_for_ai=True):
+                 wait_for_ai=True, queued_dispatch=False,
+                 channel=channels.MESSAGE_DIRECTORS[0]):
+        self.channel = channel
+        # Listeners per channel are frozensets, which (un)subscribing replaces
+        # instead of changing them. Routing can thus read them without taking
+        # the lock or copying them; the lock only serializes the writers.
         self.channels = {}
         self.channels_lock = Lock()
+        # Links to peer MessageDirectors (listeners with is_peer_link set)
+        # subscribe to the channels that their peers have subscribers on.
+        # Messages that came in over such a link are routed only to the local
+        # listeners, so that they never travel on to a third MessageDirector,
+        # or back.
+        self.peers = frozenset()
+        self.local_channels = {}
+        # Subscribed channels of individual state servers, replaced in the same
+        # way, and a counter to take turns between them at creating dobjects.
+        self.state_server_channels = ()
+        self.dobject_creations = count()
 
         if state_server is None:
             state_server = StateServer()
@@ -141,6 +295,18 @@ class MessageDirector:
         self.ai_agent = ai_agent
         self.ai_agent.set_message_director(self)
 
+        # With queued dispatch, messages are only enqueued for the components
+        # by the threads creating them, and each component handles its
+        # messages on a worker thread of its own.
+        self.workers = {}
+        if queued_dispatch:
+            for component in [state_server, client_agent, ai_agent]:
+                self.workers[component] = DispatchWorker(
+                    component,
+                    self.dispatch_queue_size,
+                    self.dispatch_batch_size,
+                )
+
     def startup(self):
         logger.info("MessageDirector starting up.")
         self.ai_agent.listen()
@@ -153,40 +319,188 @@ class MessageDirector:
         self.ai_agent.shutdown()
         self.client_agent.shutdown()
         self.state_server.shutdown()
+        for worker in self.workers.values():
+            worker.shutdown()
         logger.info("MessageDirector shutdown complete.")
 
+    def join_dispatch(self):
+        """Block until all queued messages have been handled."""
+        for worker in self.workers.values():
+            worker.join_queue()
+
 
     def subscribe_to_channel(self, channel, listener):
         logger.debug("New subscriber to {}: {}".format(channel, listener))
         with self.channels_lock:
-            listeners = self.channels.get(channel, set())
-            listeners.add(listener)
-            self.channels[channel] = listeners
+            listeners = self.channels.get(channel, frozenset())
+            # Each state server channel, with its range of dobject IDs, belongs
+            # to a single state server, be it local or behind a peer link.
+            low, high = channels.STATE_SERVERS
+            if low <= channel <= high and listeners - {listener}:
+                raise ValueError("State server channel {} is taken already"
+                                 "".format(channel))
+            self.channels[channel] = listeners | {listener}
+            if not getattr(listener, 'is_peer_link', False):
+                local_listeners = self.local_channels.get(channel, frozenset())
+                self.local_channels[channel] = local_listeners | {listener}
+                if not local_listeners:
+                    for peer in self.peers:
+                        peer.advertise_subscription(channel)
+            self._update_state_server_channels()
 
     def unsubscribe_from_channel(self, channel, listener):
         logger.debug("Unsubscribing from {}: {}".format(channel, listener))
         with self.channels_lock:
             # TODO: And if some key error occurs?
             listeners = self.channels[channel]
-            listeners.remove(listener)
+            if listener not in listeners:
+                raise KeyError(listener)
+            self.channels[channel] = listeners - {listener}
+            if not getattr(listener, 'is_peer_link', False):
+                local_listeners = self.local_channels[channel] - {listener}
+                if local_listeners:
+                    self.local_channels[channel] = local_listeners
+                else:
+                    del self.local_channels[channel]
+                    for peer in self.peers:
+                        peer.advertise_unsubscription(channel)
+            self._update_state_server_channels()
+
+    def add_peer(self, peer):
+        """Register the link to a peer MessageDirector, and advertise all
+        channels with local subscribers to it."""
+        logger.info("New peer: {}".format(peer))
+        with self.channels_lock:
+            self.peers = self.peers | {peer}
+            for channel in self.local_channels:
+                peer.advertise_subscription(channel)
+
+    def remove_peer(self, peer):
+        """Forget a peer, and unsubscribe its link from all channels."""
+        logger.info("Removing peer: {}".format(peer))
+        with self.channels_lock:
+            for channel, listeners in list(self.channels.items()):
+                if peer in listeners:
+                    self.channels[channel] = listeners - {peer}
+            self.peers = self.peers - {peer}
+            self._update_state_server_channels()
 
-    def create_message(self, from_channel, to_channel, message_type, *args):
-        # TODO: This might also write into a queue, which a thread, representing
-        # the MD and/or SS, reads from, isolating the Agent thread to otherwise
-        # keep in just the agent module.
+    def _update_state_server_channels(self):
+        low, high = channels.STATE_SERVERS
+        self.state_server_channels = tuple(sorted(
+            channel
+            for channel, listeners in self.channels.items()
+            if low <= channel <= high and listeners
+        ))
+
+    def _route_to_state_server(self, message_type, args):
+        """Narrow down a message for all state servers to the one that it
+        concerns; the owner of its dobject, or the next one in turn to create a
+        dobject. Returns None if no state server owns its dobject."""
+        state_servers = self.state_server_channels
+        dobject_id_index = dobject_addressed_messages.get(message_type)
+        if dobject_id_index is not None:
+            dobject_id = args[dobject_id_index]
+            channel = state_server_channel(dobject_id)
+            if channel not in state_servers:
+                logger.warning("No state server owns dobject {}, dropping {}"
+                               "".format(dobject_id, message_type))
+                return None
+            return channel
+        if message_type == msgtypes.CREATE_DOBJECT and state_servers:
+            turn = next(self.dobject_creations)
+            return state_servers[turn % len(state_servers)]
+        return channels.ALL_STATE_SERVERS
+
+    def _dispatch(self, listener, method, *args):
+        worker = self.workers.get(listener)
+        if worker is None:
+            method(*args)
+        else:
+            worker.put(method, args)
+
+    def _listeners(self, channel, local):
+        if local:
+            return self.local_channels.get(channel, ())
+        listeners = self.channels.get(channel)
+        if not listeners:
+            logger.warning("Nothing listens on channel {}, dropping message "
+                           "for it".format(channel))
+            return ()
+        return listeners
+
+    def create_message(self, from_channel, to_channel, message_type, *args,
+                       local=False):
+        """Route a message to all listeners on to_channel. If local is set,
+        the message came from a peer MessageDirector, and only local listeners
+        get it."""
         logger.debug("Creating message: {} -> {}: {}".format(
             from_channel, to_channel, message_type,
         ))
-        with self.channels_lock:
-            listeners = self.channels[to_channel].copy()
-        for listener in listeners:
-            listener.handle_message(
+        if to_channel == channels.ALL_STATE_SERVERS:
+            to_channel = self._route_to_state_server(message_type, args)
+            if to_channel is None:
+                return
+        for listener in self._listeners(to_channel, local):
+            self._dispatch(
+                listener,
+                listener.handle_message,
                 from_channel,
                 to_channel,
                 message_type,
                 *args,
             )
 
+    def create_multicast_message(self, from_channel, to_channels, message_type,
+                                 *args, local=False):
+        """Create the same message for several channels. Each listener gets it
+        only once, together with the channels of its that it is for, so that
+        it can be encoded once for all of them."""
+        logger.debug("Creating multicast message: {} -> {}: {}".format(
+            from_channel, to_channels, message_type,
+        ))
+        channels_by_listener = {}
+        for to_channel in to_channels:
+            for listener in self._listeners(to_channel, local):
+                listener_channels = channels_by_listener.setdefault(
+                    listener,
+                    [],
+                )
+                listener_channels.append(to_channel)
+        for listener, listener_channels in channels_by_listener.items():
+            self._dispatch(
+                listener,
+                listener.handle_multicast_message,
+                from_channel,
+                listener_channels,
+                message_type,
+                *args,
+            )
+
+    def route_frame(self, from_channel, to_channel, frame, decode, local=False):
+        """Route a message that is still packed as an AI frame. Listeners in
+        pass-through mode get the frame forwarded as it is; for all others it
+        is decoded, once, by calling decode()."""
+        logger.debug("Routing frame: {} -> {}".format(from_channel, to_channel))
+        if to_channel == channels.ALL_STATE_SERVERS:
+            # Which state servers it is for depends on the message's body.
+            self.create_message(*decode(), local=local)
+            return
+        message = None
+        for listener in self._listeners(to_channel, local):
+            if getattr(listener, 'pass_through', False):
+                self._dispatch(
+                    listener,
+                    listener.handle_frame,
+                    from_channel,
+                    to_channel,
+                    frame,
+                )
+            else:
+                if message is None:
+                    message = decode()
+                self._dispatch(listener, listener.handle_message, *message)
+
 
 def start_server():
     try:
@@ -1,10 +1,17 @@
+from collections.abc import Sequence
+from functools import wraps
+import json
 import logging
 
 from pandamonium.constants import (
+    FixedSizeFieldType,
+    VariableSizeFieldType,
+    field_types,
     msgtypes,
     channels,
 )
 from pandamonium.constants import field_policies as fp
+from pandamonium.packers import FieldSequenceCodec
 
 
 logger = logging.getLogger(__name__)
@@ -20,8 +27,58 @@ class Zone:
         self.zone_id = zone_id
 
 
+def _default_value(dtype):
+    if isinstance(dtype, (FixedSizeFieldType, VariableSizeFieldType)):
+        return dtype.ftype()
+    if isinstance(dtype, type):
+        return dtype()
+    return None
+
+
+def _field_codec(dtypes):
+    if all(isinstance(dtype, (FixedSizeFieldType, VariableSizeFieldType))
+           for dtype in dtypes):
+        return FieldSequenceCodec(dtypes)
+    return None
+
+
+def _pack_storage(dclass, fields):
+    if len(fields) != len(dclass._storage_ids):
+        raise ValueError("{} has {} stored fields, got {}".format(
+            dclass.__name__,
+            len(dclass._storage_ids),
+            len(fields),
+        ))
+    if dclass._storage_codecs is None:
+        return [tuple(values) for values in fields]
+    return b''.join([codec.pack((field_id, *values))
+                     for codec, field_id, values
+                     in zip(dclass._storage_codecs, dclass._storage_ids,
+                            fields)])
+
+
+def _unpack_storage(dclass, storage):
+    if dclass._storage_codecs is None:
+        return list(storage)
+    fields = []
+    offset = 0
+    for codec in dclass._storage_codecs:
+        values, offset = codec.unpack_from(storage, offset)
+        fields.append(tuple(values[1:]))
+    return fields
+
+
 class DFieldSorter(type):
     def __new__(cls, name, bases, dct):
+        # Slotted dclasses that only derive from dclasses get no __dict__, so
+        # that their dobjects stay small. Views have one through their other
+        # bases.
+        slotted = dct.get('slotted',
+                          any(getattr(base, 'slotted', False)
+                              for base in bases))
+        if slotted and '__slots__' not in dct and \
+           all('__slots__' in vars(base) for base in bases):
+            dct = dict(dct, __slots__=())
         dclass = super().__new__(cls, name, bases, dct)
         dfield_names = sorted([field for field in dir(dclass)
                                if field.startswith('dfield_')])
@@ -33,19 +90,209 @@ class DFieldSorter(type):
             field_policy = field_attr[1]
             dfields.append((field_name, field_type, field_policy))
         dclass._dfields = dfields
+        # Tables of the fields' properties by field ID, so that they needn't
+        # be unpacked from _dfields where fields are handled.
+        dclass._field_names = [name for name, _types, _policy in dfields]
+        dclass._field_policies = [policy for _name, _types, policy in dfields]
+        # Codecs of the individual fields' values, or None for fields whose
+        # types have none
+        dclass._field_codecs = [_field_codec(dtypes)
+                                for _name, dtypes, _policy in dfields]
+        # policy -> IDs of the fields that have it
+        dclass._policy_fields = {
+            policy: frozenset(field_id
+                              for field_id, field_policy
+                              in enumerate(dclass._field_policies)
+                              if field_policy & policy)
+            for policy in vars(fp).values()
+            if isinstance(policy, int)
+        }
+        cls._compile_storage(dclass)
+        # View classes get their senders and receivers compiled here, once,
+        # so that creating views only looks them up.
+        if hasattr(dclass, '_view_send_policy'):
+            _compile_view_methods(
+                dclass,
+                dclass._view_send_policy,
+                dclass._view_receive_policy,
+                dclass._dfield_sending_field_sender,
+            )
         return dclass
 
+    @staticmethod
+    def _compile_storage(dclass):
+        """Lay out the values of the stored (RAM / PERSIST) fields as one
+        record. If all their types can be packed, that is the stored fields
+        in wire format, i.e. each field's ID followed by its values, as they
+        are sent in a CREATE_DOBJECT_VIEW."""
+        storage_ids = [field_id
+                       for field_id, (_name, _types, policy)
+                       in enumerate(dclass._dfields)
+                       if policy & (fp.RAM | fp.PERSIST)]
+        dclass._storage_ids = storage_ids
+        # field_id -> index into the stored fields
+        dclass._storage_index = {field_id: index
+                                 for index, field_id in enumerate(storage_ids)}
+        dclass._storage_defaults = [
+            tuple(_default_value(dtype)
+                  for dtype in dclass._dfields[field_id][1])
+            for field_id in storage_ids
+        ]
+        codecs = [_field_codec((field_types.FIELD_ID, ) +
+                               tuple(dclass._dfields[field_id][1]))
+                  for field_id in storage_ids]
+        if None in codecs:
+            dclass._storage_codecs = None
+            return
+        dclass._storage_codecs = codecs
+        # If all stored fields have a fixed size, they are at fixed offsets in
+        # the record; otherwise the fields before a field have to be skipped.
+        if all(codec.size is not None for codec in codecs):
+            offsets = []
+            offset = 0
+            for codec in codecs:
+                offsets.append((offset, offset + codec.size))
+                offset += codec.size
+            dclass._storage_offsets = offsets
+        else:
+            dclass._storage_offsets = None
+        dclass._packed_storage_defaults = _pack_storage(
+            dclass,
+            dclass._storage_defaults,
+        )
+
+
+class StoredFields(Sequence):
+    """The values of a dobject's stored fields at one point in time. They are
+    kept in their packed form, and only unpacked when looked at, so packers
+    can put them into messages as they are.
+    A dobject hands out the same StoredFields until its fields change, so
+    packers keep the messages that they encode with them in encoded, to reuse
+    them for all further recipients."""
+    __slots__ = ('dclass', 'packed', 'encoded', '_fields')
+
+    def __init__(self, dclass, packed):
+        self.dclass = dclass
+        self.packed = packed
+        # (message type ID, dobject ID) -> encoded message body
+        self.encoded = {}
+        self._fields = None
+
+    def _unpacked(self):
+        if self._fields is None:
+            self._fields = _unpack_storage(self.dclass, self.packed)
+        return self._fields
+
+    def __getitem__(self, index):
+        return self._unpacked()[index]
+
+    def __len__(self):
+        return len(self.dclass._storage_ids)
+
+    def __eq__(self, other):
+        return self._unpacked() == list(other)
+
+    def __repr__(self):
+        return repr(self._unpacked())
+
 
 class DClass(metaclass=DFieldSorter):
+    # The stored fields are kept in _storage; packed into a bytes object by
+    # the dclass's storage codecs, or, if their types have no codec, as a list
+    # of value tuples.
+    __slots__ = ('dobject_id', 'state_server', 'owner', 'ai', '_storage',
+                 '_stored_fields')
+    # Dobjects keep only these slots and no __dict__, which saves memory on
+    # servers with many dobjects; with their fields packed, they take about
+    # 2.6 times less than with a __dict__ and a list of tuples (see
+    # benchmarks/dobject_memory.py). Attributes can't be set on them at will,
+    # though; a dclass that needs that sets slotted to False, for itself and
+    # the dclasses that derive from it.
+    slotted = True
+
     def __init__(self, dobject_id, fields, state_server=None):
         self.dobject_id = dobject_id
         self.state_server = state_server
-        # TODO: set initial field values
-        self.storage = fields
+        self._stored_fields = None
+        if fields:
+            self.storage = fields
+        elif self._storage_codecs is not None:
+            self._storage = self._packed_storage_defaults
+        else:
+            self.storage = self._storage_defaults
 
         self.owner = None
         self.ai = None
 
+    @property
+    def storage(self):
+        """The values of the stored fields, in field order."""
+        return _unpack_storage(type(self), self._storage)
+
+    @storage.setter
+    def storage(self, fields):
+        self._storage = _pack_storage(type(self), fields)
+
+    def stored_fields(self):
+        """The current values of the stored fields, to be sent in messages.
+        They won't change along with the dobject's."""
+        if self._storage_codecs is None:
+            return list(self._storage)
+        # Each write of a field replaces the packed storage, which makes the
+        # StoredFields of the former one stale.
+        stored_fields = self._stored_fields
+        if stored_fields is None or stored_fields.packed is not self._storage:
+            stored_fields = StoredFields(type(self), self._storage)
+            self._stored_fields = stored_fields
+        return stored_fields
+
+    def get_packed_storage(self):
+        """The stored fields as bytes; JSON if their types have no codec."""
+        if self._storage_codecs is None:
+            return json.dumps(self._storage).encode('UTF-8')
+        return self._storage
+
+    def set_packed_storage(self, data):
+        if self._storage_codecs is None:
+            self.storage = json.loads(str(data, 'UTF-8'))
+        else:
+            self._storage = bytes(data)
+
+    def _stored_field_bounds(self, index):
+        """Start and end of the packed stored field at index."""
+        if self._storage_offsets is not None:
+            return self._storage_offsets[index]
+        offset = 0
+        for codec in self._storage_codecs[:index]:
+            _values, offset = codec.unpack_from(self._storage, offset)
+        _values, end = self._storage_codecs[index].unpack_from(self._storage,
+                                                               offset)
+        return offset, end
+
+    def get_stored_field(self, field_id):
+        index = self._storage_index[field_id]
+        if self._storage_codecs is None:
+            return self._storage[index]
+        start, _end = self._stored_field_bounds(index)
+        values, _offset = self._storage_codecs[index].unpack_from(
+            self._storage,
+            start,
+        )
+        return tuple(values[1:])
+
+    def set_stored_field(self, field_id, values):
+        """Replace the value of one stored field. In packed storage, only that
+        field is packed anew."""
+        index = self._storage_index[field_id]
+        if self._storage_codecs is None:
+            self._storage[index] = tuple(values)
+            return
+        start, end = self._stored_field_bounds(index)
+        packed = self._storage_codecs[index].pack((field_id, *values))
+        self._storage = b''.join([self._storage[:start],
+                                  packed,
+                                  self._storage[end:]])
+
     def set_owner(self, owner):
         self.owner = owner
 
@@ -53,10 +300,54 @@ class DClass(metaclass=DFieldSorter):
         self.ai = ai_channel
 
 
+def _compile_view_methods(view_class, send_policy, receive_policy,
+                          make_sender):
+    """Check the methods of a view class against its fields' policies, turn
+    its senders into methods that send the values that they return, and
+    return its receivers by field ID. This is done once per view class, when
+    it is created."""
+    receivers = [None] * len(view_class._dfields)
+    for field_id, name in enumerate(view_class._field_names):
+        policy = view_class._field_policies[field_id]
+        sender_name = 'do_' + name
+        receiver_name = 'on_' + name
+        if policy & send_policy:
+            if not hasattr(view_class, sender_name):
+                raise Exception("Method {} is missing".format(sender_name))
+            sender = getattr(view_class, sender_name)
+            # Inherited from a view class that was compiled already, where
+            # the field may have had another ID.
+            sent_field_id = getattr(sender, 'sent_field_id', None)
+            if sent_field_id != field_id:
+                if sent_field_id is not None:
+                    sender = sender.__wrapped__
+                setattr(view_class, sender_name, make_sender(field_id, sender))
+            if hasattr(view_class, receiver_name):
+                raise Exception("Method {} should not be set on a field "
+                                "with client-side sender policy"
+                                "".format(receiver_name))
+        elif policy & receive_policy:
+            if hasattr(view_class, sender_name):
+                raise Exception("Method {} should not be set on a field "
+                                "with client-side receiver policy"
+                                "".format(sender_name))
+            if not hasattr(view_class, receiver_name):
+                raise Exception("Method {} is missing"
+                                "".format(receiver_name))
+            receivers[field_id] = getattr(view_class, receiver_name)
+    view_class._view_receivers = receivers
+    return receivers
+
+
 class AIView:
-    def _dfield_sending_field_sender(self, dobject_id, field_id, f):
-        def inner(*args):
-            values = f(*args)
+    _view_send_policy = fp.AI_SEND
+    _view_receive_policy = fp.AI_RECEIVE
+
+    @staticmethod
+    def _dfield_sending_field_sender(field_id, f):
+        @wraps(f)
+        def inner(self, *args):
+            values = f(self, *args)
             self.repository.send_message(
                 self.repository.channel,
                 channels.ALL_STATE_SERVERS,
@@ -65,45 +356,19 @@ class AIView:
                 field_id,
                 values,
             )
+        inner.sent_field_id = field_id
         return inner
 
-    # FIXME: Copypasted from ClientView
     def __init__(self, repository, dobject_id, fields):
         self.repository = repository
         super().__init__(dobject_id, fields)
-        self.receiver_methods = [None] * len(self._dfields)
-        for field_id, (name, _, policy) in enumerate(self._dfields):
-            sender_name = 'do_' + name
-            receiver_name = 'on_' + name
-            if policy & fp.AI_SEND:
-                if not hasattr(self, sender_name):
-                    raise Exception("Method {} is missing".format(sender_name))
-                sender_wrapper = self._dfield_sending_field_sender(
-                    dobject_id,
-                    field_id,
-                    getattr(self, sender_name),
-                )
-                setattr(self,  sender_name, sender_wrapper)
-                if hasattr(self, receiver_name):
-                    raise Exception("Method {} should not be set on a field "
-                                    "with client-side sender policy"
-                                    "".format(receiver_name))
-            elif policy & fp.AI_RECEIVE:
-                if hasattr(self, sender_name):
-                    raise Exception("Method {} should not be set on a field "
-                                    "with client-side receiver policy"
-                                    "".format(sender_name))
-                if not hasattr(self, receiver_name):
-                    raise Exception("Method {} is missing"
-                                    "".format(receiver_name))
-                self.receiver_methods[field_id] = getattr(self, receiver_name)
         self.creation_hook()
 
     def creation_hook(self):
         pass
 
     def handle_field_update(self, source, field_id, values):
-        self.receiver_methods[field_id](source, *values)
+        self._view_receivers[field_id](self, source, *values)
 
     def disconnect_client(self, client_id, reason):
         self.repository.disconnect_client(client_id, reason)
@@ -138,53 +403,33 @@ class AIView:
 
 
 class ClientView:
-    def _dfield_sending_field_sender(self, dobject_id, field_id, f):
-        def inner(*args):
-            values = f(*args)
+    _view_send_policy = fp.CLIENT_SEND|fp.OWNER_SEND
+    _view_receive_policy = fp.CLIENT_RECEIVE|fp.OWNER_RECEIVE
+
+    @staticmethod
+    def _dfield_sending_field_sender(field_id, f):
+        @wraps(f)
+        def inner(self, *args):
+            values = f(self, *args)
             self.repository.send_message(
                 msgtypes.SET_FIELD,
                 self.dobject_id,
                 field_id,
                 values,
             )
+        inner.sent_field_id = field_id
         return inner
 
     def __init__(self, repository, dobject_id, fields):
         self.repository = repository
         super().__init__(dobject_id, fields)
-        self.receiver_methods = [None] * len(self._dfields)
-        for field_id, (name, _, policy) in enumerate(self._dfields):
-            sender_name = 'do_' + name
-            receiver_name = 'on_' + name
-            if policy & (fp.CLIENT_SEND|fp.OWNER_SEND):
-                if not hasattr(self, sender_name):
-                    raise Exception("Method {} is missing".format(sender_name))
-                sender_wrapper = self._dfield_sending_field_sender(
-                    dobject_id,
-                    field_id,
-                    getattr(self, sender_name),
-                )
-                setattr(self, sender_name, sender_wrapper)
-                if hasattr(self, receiver_name):
-                    raise Exception("Method {} should not be set on a field "
-                                    "with client-side sender policy"
-                                    "".format(receiver_name))
-            elif policy & (fp.CLIENT_RECEIVE|fp.OWNER_RECEIVE):
-                if hasattr(self, sender_name):
-                    raise Exception("Method {} should not be set on a field "
-                                    "with client-side receiver policy"
-                                    "".format(sender_name))
-                if not hasattr(self, receiver_name):
-                    raise Exception("Method {} is missing"
-                                    "".format(receiver_name))
-                self.receiver_methods[field_id] = getattr(self, receiver_name)
         self.creation_hook()
 
     def creation_hook(self):
         pass
 
     def handle_field_update(self, field_id, values):
-        self.receiver_methods[field_id](*values)
+        self._view_receivers[field_id](self, *values)
 
     def become_owner(self):
         pass
@@ -0,0 +1,343 @@
+from threading import Lock, Thread, Event
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from pandamonium.constants import field_types
+from pandamonium.packers import FieldCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+class records:
+    CREATE_DOBJECT = 0
+    ADD_PRESENCE = 1
+    REMOVE_PRESENCE = 2
+    SET_INTEREST = 3
+    UNSET_INTEREST = 4
+    SET_OWNER = 5
+    SET_AI = 6
+    SET_FIELD = 7
+
+
+# Each record is its kind and the length of its payload, followed by the
+# payload; its fixed arguments, and for some kinds a blob of field values.
+record_header = struct.Struct('=BI')
+record_codecs = {
+    records.CREATE_DOBJECT: FieldCodec((field_types.DOBJECT_ID,
+                                        field_types.DCLASS)),
+    records.ADD_PRESENCE: FieldCodec((field_types.DOBJECT_ID,
+                                      field_types.ZONE)),
+    records.REMOVE_PRESENCE: FieldCodec((field_types.DOBJECT_ID,
+                                         field_types.ZONE)),
+    records.SET_INTEREST: FieldCodec((field_types.CHANNEL, field_types.ZONE)),
+    records.UNSET_INTEREST: FieldCodec((field_types.CHANNEL,
+                                        field_types.ZONE)),
+    records.SET_OWNER: FieldCodec((field_types.CHANNEL,
+                                   field_types.DOBJECT_ID)),
+    records.SET_AI: FieldCodec((field_types.CHANNEL, field_types.DOBJECT_ID)),
+    records.SET_FIELD: FieldCodec((field_types.DOBJECT_ID,
+                                   field_types.FIELD_ID)),
+}
+snapshot_magic = b'PDMS'
+snapshot_header = struct.Struct('=4sI')  # magic, generation
+
+
+def encode_record(kind, args, blob=b''):
+    payload = record_codecs[kind].pack(args)
+    return b''.join([record_header.pack(kind, len(payload) + len(blob)),
+                     payload,
+                     blob])
+
+
+def pack_field_values(dclass, field_id, values):
+    codec = dclass._field_codecs[field_id]
+    if codec is None:
+        return json.dumps(list(values)).encode('UTF-8')
+    return codec.pack(values)
+
+
+def unpack_field_values(dclass, field_id, blob):
+    codec = dclass._field_codecs[field_id]
+    if codec is None:
+        return tuple(json.loads(str(blob, 'UTF-8')))
+    values, _offset = codec.unpack_from(blob)
+    return tuple(values)
+
+
+# The arguments of all records have fixed sizes.
+record_structs = {kind: codec.struct for kind, codec in record_codecs.items()}
+
+
+def replay_records(state_keeper, data, offset):
+    """Restore the state in the records in data from offset on into the state
+    keeper, through its restore_*() methods. Returns the number of records
+    applied, and the offset behind the last complete record."""
+    num_records = 0
+    # dobject_id -> field_id -> packed values; only the latest values of each
+    # field are unpacked, and each dobject's fields are restored at once.
+    field_updates = {}
+    data_length = len(data)
+    header_size = record_header.size
+    unpack_header = record_header.unpack_from
+    dobjects = state_keeper.dobjects.forward_map
+    while data_length - offset >= header_size:
+        kind, length = unpack_header(data, offset)
+        start = offset + header_size
+        end = start + length
+        if data_length < end:
+            break
+        args_struct = record_structs[kind]
+        args = args_struct.unpack_from(data, start)
+        blob_start = start + args_struct.size
+        if kind == records.CREATE_DOBJECT:
+            dobject_id, dclass_id = args
+            state_keeper.restore_dobject(dobject_id, dclass_id,
+                                         data[blob_start:end])
+        elif kind == records.ADD_PRESENCE:
+            state_keeper.restore_presence(*args, True)
+        elif kind == records.REMOVE_PRESENCE:
+            state_keeper.restore_presence(*args, False)
+        elif kind == records.SET_INTEREST:
+            state_keeper.restore_interest(*args, True)
+        elif kind == records.UNSET_INTEREST:
+            state_keeper.restore_interest(*args, False)
+        elif kind == records.SET_OWNER:
+            owner_channel, dobject_id = args
+            dobjects[dobject_id].set_owner(owner_channel)
+        elif kind == records.SET_AI:
+            ai_channel, dobject_id = args
+            dobjects[dobject_id].set_ai(ai_channel)
+        elif kind == records.SET_FIELD:
+            dobject_id, field_id = args
+            updates = field_updates.get(dobject_id)
+            if updates is None:
+                updates = field_updates[dobject_id] = {}
+            updates[field_id] = data[blob_start:end]
+        else:
+            raise ValueError("Unknown journal record {}".format(kind))
+        num_records += 1
+        offset = end
+    for dobject_id, updates in field_updates.items():
+        dclass = type(dobjects[dobject_id])
+        state_keeper.restore_fields(dobject_id, {
+            field_id: unpack_field_values(dclass, field_id, packed_values)
+            for field_id, packed_values in updates.items()
+        })
+    return num_records, offset
+
+
+class StateJournal:
+    """An append-only binary journal of the mutations of a state keeper's
+    state, kept in a directory of its own.
+
+    The journal is split into generations, journal.<generation>. A snapshot
+    of generation n holds the state from before journal.<n> was started, in
+    the form of records that recreate it. Taking a snapshot starts a new
+    generation, and once the snapshot is written, the journals before it are
+    removed. To recover, the snapshot is replayed, and then the journals that
+    follow it.
+
+    Records refer to dclasses and fields by ID, so the journal is only valid
+    for the dclasses that it was written with.
+    """
+    # Seconds between writing buffered records to the OS
+    flush_interval = 0.1
+    # Whether to also fsync() them. Without this, records survive the crash
+    # of the process, but not necessarily that of the machine.
+    fsync = False
+    # Seconds between snapshots; if None, they are only taken on request.
+    snapshot_interval = 300.0
+
+    def __init__(self, directory, flush_interval=None, snapshot_interval=None):
+        self.directory = directory
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if snapshot_interval is not None:
+            self.snapshot_interval = snapshot_interval
+        os.makedirs(directory, exist_ok=True)
+        self.generation = 0
+        self.file = None
+        # Protects the journal file; taken last, after any state keeper lock.
+        self.lock = Lock()
+        self.snapshot_lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.take_snapshot = None
+
+    def _journal_path(self, generation):
+        return os.path.join(self.directory, 'journal.{:08d}'.format(generation))
+
+    def _snapshot_path(self):
+        return os.path.join(self.directory, 'snapshot')
+
+    def _journal_generations(self):
+        return sorted(int(name.partition('.')[2])
+                      for name in os.listdir(self.directory)
+                      if name.startswith('journal.'))
+
+    def load(self, state_keeper):
+        """Restore the state keeper's state from the latest snapshot and the
+        journals after it. Returns the number of records applied."""
+        num_records = 0
+        snapshot_generation = 0
+        if os.path.exists(self._snapshot_path()):
+            with open(self._snapshot_path(), 'rb') as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, snapshot_generation = snapshot_header.unpack_from(data)
+                if magic != snapshot_magic:
+                    raise ValueError("Not a snapshot: {}".format(
+                        self._snapshot_path(),
+                    ))
+                applied, offset = replay_records(state_keeper, data,
+                                                 snapshot_header.size)
+                if offset != len(data):
+                    raise ValueError("Snapshot is truncated: {}".format(
+                        self._snapshot_path(),
+                    ))
+                num_records += applied
+        generations = [generation
+                       for generation in self._journal_generations()
+                       if generation >= snapshot_generation]
+        for generation in generations:
+            path = self._journal_path(generation)
+            if not os.path.getsize(path):
+                continue
+            with open(path, 'rb') as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                applied, offset = replay_records(state_keeper, data, 0)
+                if offset != len(data):
+                    # The process died while writing the last record.
+                    logger.warning("Ignoring torn record at the end of {}"
+                                   "".format(path))
+                num_records += applied
+        # A torn journal can't be appended to, so a new generation is started.
+        self.generation = max([snapshot_generation] +
+                              [generation + 1 for generation in generations])
+        logger.info("Replayed {} journal records".format(num_records))
+        return num_records
+
+    def start(self, take_snapshot):
+        """Start journaling into a new generation. take_snapshot is called
+        every snapshot_interval seconds."""
+        self.take_snapshot = take_snapshot
+        self.file = open(self._journal_path(self.generation), 'ab')
+        self.thread = Thread(
+            target=self._maintain,
+            name="State journal thread",
+        )
+        self.thread.start()
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(record)
+
+    def create_dobject(self, dobject):
+        self.append(encode_record(
+            records.CREATE_DOBJECT,
+            (dobject.dobject_id, dobject.dclass_id),
+            dobject.get_packed_storage(),
+        ))
+
+    def add_presence(self, dobject_id, zone_id):
+        self.append(encode_record(records.ADD_PRESENCE, (dobject_id, zone_id)))
+
+    def remove_presence(self, dobject_id, zone_id):
+        self.append(encode_record(records.REMOVE_PRESENCE,
+                                  (dobject_id, zone_id)))
+
+    def set_interest(self, recipient_id, zone_id):
+        self.append(encode_record(records.SET_INTEREST,
+                                  (recipient_id, zone_id)))
+
+    def unset_interest(self, recipient_id, zone_id):
+        self.append(encode_record(records.UNSET_INTEREST,
+                                  (recipient_id, zone_id)))
+
+    def set_owner(self, owner_channel, dobject_id):
+        self.append(encode_record(records.SET_OWNER,
+                                  (owner_channel, dobject_id)))
+
+    def set_ai(self, ai_channel, dobject_id):
+        self.append(encode_record(records.SET_AI, (ai_channel, dobject_id)))
+
+    def set_field(self, dobject, field_id, values):
+        self.append(encode_record(
+            records.SET_FIELD,
+            (dobject.dobject_id, field_id),
+            pack_field_values(type(dobject), field_id, values),
+        ))
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def rotate(self):
+        """Start the next generation. Returns its number. Must be called
+        while the state is captured for a snapshot, so that each mutation ends
+        up either in the snapshot or in the new generation."""
+        with self.lock:
+            self.file.close()
+            self.generation += 1
+            self.file = open(self._journal_path(self.generation), 'ab')
+            return self.generation
+
+    def write_snapshot(self, generation, dobjects, presence, interest):
+        """Write the snapshot of generation, and remove the journals that it
+        replaces. dobjects holds (dobject_id, dclass_id, packed storage,
+        owner, AI), presence (dobject_id, zone_id), and interest
+        (recipient_id, zone_id)."""
+        snapshot_records = []
+        for dobject_id, dclass_id, storage, owner, ai in dobjects:
+            snapshot_records.append(encode_record(
+                records.CREATE_DOBJECT,
+                (dobject_id, dclass_id),
+                storage,
+            ))
+            if owner is not None:
+                snapshot_records.append(encode_record(records.SET_OWNER,
+                                                      (owner, dobject_id)))
+            if ai is not None:
+                snapshot_records.append(encode_record(records.SET_AI,
+                                                      (ai, dobject_id)))
+        snapshot_records.extend(encode_record(records.ADD_PRESENCE, args)
+                                for args in presence)
+        snapshot_records.extend(encode_record(records.SET_INTEREST, args)
+                                for args in interest)
+        with self.snapshot_lock:
+            temp_path = self._snapshot_path() + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(snapshot_header.pack(snapshot_magic, generation))
+                f.writelines(snapshot_records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self._snapshot_path())
+            for old_generation in self._journal_generations():
+                if old_generation < generation:
+                    os.remove(self._journal_path(old_generation))
+
+    def _maintain(self):
+        last_snapshot = time.monotonic()
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+                if self.snapshot_interval is not None and \
+                   time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    last_snapshot = time.monotonic()
+                    self.take_snapshot()
+            except Exception:
+                logger.exception("Failed to maintain the state journal")
+
+    def shutdown(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.file is not None:
+            with self.lock:
+                self.file.close()
@@ -6,122 +6,370 @@ from pandamonium.constants import (
     ListFieldType,
     field_types,
     msgtypes,
+    all_message_types,
     message_type_by_id,
 )
-from pandamonium.constants import field_policies as fp
 
 
 class DatagramIncomplete(Exception):
     Exception
 
 
-class BasePacker:
-    def _to_network(self, value, field_type):
-        if isinstance(field_type, FixedSizeFieldType):
-            if field_type.ftype is int and field_type.length == 2:
-                return struct.pack('h', value)
-            elif field_type.ftype is int and field_type.length == 4:
-                return struct.pack('i', value)
-            elif field_type.ftype is float:
-                # FIXME: Should depend on .length
-                return struct.pack('f', value)
-        elif isinstance(field_type, VariableSizeFieldType):
-            if field_type.ftype is str:
-                str_repr = value.encode('UTF-8')
-                length = struct.pack('h', len(str_repr))
-                return length + str_repr
+class FieldCodec:
+    """Wire format of a sequence of field types, compiled into a single
+    struct. That struct holds all fixed-size fields, followed by the length
+    prefixes of the variable-size fields, whose payloads then follow the struct
+    in field order. List fields are left out; it is up to the caller to pack
+    them after the codec's part of the message."""
+    def __init__(self, fields):
+        fields = [field_type for field_type in fields
+                  if not isinstance(field_type, ListFieldType)]
+        formats = []
+        self.fixed_positions = []
+        self.variable_positions = []
+        for position, field_type in enumerate(fields):
+            if isinstance(field_type, FixedSizeFieldType):
+                formats.append(field_type.struct_format)
+                self.fixed_positions.append(position)
+            elif isinstance(field_type, VariableSizeFieldType):
+                if field_type.ftype is not str:
+                    raise Exception  # FIXME
+                self.variable_positions.append(position)
             else:
-                raise Exception  # FIXME
-        elif isinstance(field_type, ListFieldType):
-            import pdb; pdb.set_trace()
+                raise TypeError("Unknown field type {}".format(field_type))
+        formats.extend(['H'] * len(self.variable_positions))
+        self.struct = struct.Struct('=' + ''.join(formats))
+        self.size = self.struct.size
+        self.num_values = len(fields)
+        self.num_fixed = len(self.fixed_positions)
+        self.fixed_only = not self.variable_positions
 
-    def _from_network(self, datagram, field_type):
-        if isinstance(field_type, FixedSizeFieldType):
-            if len(datagram) < field_type.length:
+    def pack(self, values):
+        if len(values) != self.num_values:
+            raise Exception  # FIXME?
+        if self.fixed_only:
+            return self.struct.pack(*values)
+        payloads = [values[position].encode('UTF-8')
+                    for position in self.variable_positions]
+        header = bytearray(self.size)
+        self.struct.pack_into(
+            header,
+            0,
+            *[values[position] for position in self.fixed_positions],
+            *[len(payload) for payload in payloads],
+        )
+        return b''.join([header] + payloads)
+
+    def unpack_from(self, datagram, offset=0):
+        """Returns the list of values, and the offset behind them."""
+        if len(datagram) - offset < self.size:
+            raise DatagramIncomplete
+        unpacked = self.struct.unpack_from(datagram, offset)
+        offset += self.size
+        if self.fixed_only:
+            return list(unpacked), offset
+        values = [None] * self.num_values
+        for position, value in zip(self.fixed_positions, unpacked):
+            values[position] = value
+        lengths = unpacked[self.num_fixed:]
+        for position, length in zip(self.variable_positions, lengths):
+            end = offset + length
+            if len(datagram) < end:
                 raise DatagramIncomplete
-            field_bytes = datagram[0:field_type.length]
-            datagram = datagram[field_type.length:]
-            if field_type.ftype is int and field_type.length == 2:
-                value = struct.unpack('h', field_bytes)[0]
-            elif field_type.ftype is int and field_type.length == 4:
-                value = struct.unpack('i', field_bytes)[0]
-            elif field_type.ftype is float:
-                value = struct.unpack('f', field_bytes)[0] # FIXME: See .length
-        elif isinstance(field_type, VariableSizeFieldType):
-            if field_type.ftype is str:
-                if len(datagram) < 2:
-                    raise DatagramIncomplete
-                length = struct.unpack('h', len(datagram[0:2]))[0]
-                datagram = datagram[2:]
-                if len(datagram) < length:
-                    raise DatagramIncomplete
-                str_repr = datagram[:length]
-                datagram = datagram[length:]
-                value = str_repr.decode('UTF-8')
-            else:
-                raise Exception  # FIXME
-        elif isinstance(field_type, ListFieldType):
-            import pdb; pdb.set_trace()
-        return value, datagram
+            values[position] = str(datagram[offset:end], 'UTF-8')
+            offset = end
+        return values, offset
 
-    def pack_args(self, message_type, *args):
-        message = b''
-        if len(args) != len(message_type.fields):
+
+class FieldSequenceCodec:
+    """Wire format of field values as they follow each other in a message,
+    each packed on its own the way _to_network() does it, e.g. a field's
+    values. Runs of fixed-size types are compiled into one struct."""
+    def __init__(self, fields):
+        self.runs = []  # (codec, first position, behind last position)
+        run_start = None
+        for position, field_type in enumerate(fields):
+            if isinstance(field_type, FixedSizeFieldType):
+                if run_start is None:
+                    run_start = position
+                continue
+            if run_start is not None:
+                self.runs.append((FieldCodec(fields[run_start:position]),
+                                  run_start, position))
+                run_start = None
+            self.runs.append((FieldCodec((field_type, )),
+                              position, position + 1))
+        if run_start is not None:
+            self.runs.append((FieldCodec(fields[run_start:]),
+                              run_start, len(fields)))
+        self.num_values = len(fields)
+        # The packed size, if it is the same for all values
+        if all(codec.fixed_only for codec, _start, _end in self.runs):
+            self.size = sum(codec.size for codec, _start, _end in self.runs)
+        else:
+            self.size = None
+
+    def pack(self, values):
+        if len(values) != self.num_values:
             raise Exception  # FIXME?
-        for field_type, arg in zip(message_type.fields, args):
-            message += self._to_network(arg, field_type)
+        return b''.join([codec.pack(values[start:end])
+                         for codec, start, end in self.runs])
+
+    def unpack_from(self, datagram, offset=0):
+        """Returns the list of values, and the offset behind them."""
+        values = []
+        for codec, _start, _end in self.runs:
+            run_values, offset = codec.unpack_from(datagram, offset)
+            values.extend(run_values)
+        return values, offset
+
+
+# Compiled once at import time, so that packing a message's arguments does not
+# need to dispatch on each field's type.
+field_type_codecs = {field_type: FieldCodec((field_type, ))
+                     for field_type in vars(field_types).values()
+                     if isinstance(field_type, (FixedSizeFieldType,
+                                                VariableSizeFieldType))}
+message_codecs = {message_type.num_id: FieldCodec(message_type.fields)
+                  for message_type in all_message_types}
+channel_header_codec = FieldCodec((field_types.CHANNEL, field_types.CHANNEL))
+frame_header_codec = FieldCodec((field_types.FRAME_LENGTH, ))
+# Header of the datagrams of unreliable channels, which carry frames after it.
+sequence_header_codec = FieldCodec((field_types.SEQUENCE, ))
+
+
+class BasePacker:
+    # If set, FLOAT components in FIELD_DELTAs are sent as 16 bit multiples of
+    # this. Both ends of a connection have to agree on it.
+    float_quantum = None
+    # The number of components that a FIELD_DELTA's mask can mark
+    max_delta_components = 16
+
+    def _to_network(self, value, field_type):
+        return field_type_codecs[field_type].pack((value, ))
+
+    def _from_network(self, datagram, field_type):
+        value, offset = self._from_network_at(datagram, 0, field_type)
+        return value, datagram[offset:]
+
+    def _from_network_at(self, datagram, offset, field_type):
+        (value, ), offset = field_type_codecs[field_type].unpack_from(
+            datagram,
+            offset,
+        )
+        return value, offset
+
+    def frame(self, message):
+        """Prefix the message with its length."""
+        return b''.join([frame_header_codec.pack((len(message), )), message])
+
+    def frame_bounds(self, datagram, offset):
+        """Check whether the frame at offset is complete, without decoding it.
+        Returns the start and end offsets of the message in the frame, or
+        raises DatagramIncomplete."""
+        (length, ), start = frame_header_codec.unpack_from(datagram, offset)
+        end = start + length
+        if len(datagram) < end:
+            raise DatagramIncomplete
+        return start, end
+
+    def unpack_frame(self, datagram, start, end):
+        """Unpack the message of a complete frame."""
+        with memoryview(datagram)[:end] as frame:
+            try:
+                message, offset = self.unpack_unframed_from(frame, start)
+            except DatagramIncomplete:
+                offset = None
+        if offset != end:
+            raise ValueError("Message does not fill its frame ({} - {})"
+                             "".format(start, end))
         return message
 
+    def unpack_message(self, datagram):
+        message, offset = self.unpack_message_from(datagram, 0)
+        return message, datagram[offset:]
+
+    def unpack_message_from(self, datagram, offset):
+        start, end = self.frame_bounds(datagram, offset)
+        return self.unpack_frame(datagram, start, end), end
+
+    def pack_args(self, message_type, *args):
+        return message_codecs[message_type.num_id].pack(args)
+
     def unpack_args(self, message_type, datagram):
-        args = []
-        for field_type in message_type.fields:
-            arg, datagram = self._from_network(datagram, field_type)
-            args.append(arg)
-        return args, datagram
+        args, offset = self.unpack_args_from(message_type, datagram, 0)
+        return args, datagram[offset:]
 
-    def pack_field(self, dclass_id, field_id, values):
+    def unpack_args_from(self, message_type, datagram, offset):
+        return message_codecs[message_type.num_id].unpack_from(
+            datagram,
+            offset,
+        )
+
+    def pack_field_values(self, dclass_id, field_id, values):
         dclass = self.dclasses_by_id[dclass_id]
+        codec = dclass._field_codecs[field_id]
+        if codec is not None:
+            return codec.pack(values)
         _name, dtypes, _policy = dclass._dfields[field_id]
-        datagram = b''
-        datagram += self._to_network(field_id, field_types.FIELD_ID)
-        for dtype, value in zip(dtypes, values):
-            datagram += self._to_network(value, dtype)
-        return datagram
+        return b''.join([self._to_network(value, dtype)
+                         for dtype, value in zip(dtypes, values)])
 
-    def unpack_field(self, dclass_id, datagram):
-        field_id, datagram = self._from_network(datagram, field_types.FIELD_ID)
+    def unpack_field_values(self, dclass_id, field_id, datagram):
+        values, offset = self.unpack_field_values_from(
+            dclass_id,
+            field_id,
+            datagram,
+            0,
+        )
+        return values, datagram[offset:]
+
+    def unpack_field_values_from(self, dclass_id, field_id, datagram, offset):
         dclass = self.dclasses_by_id[dclass_id]
+        codec = dclass._field_codecs[field_id]
+        if codec is not None:
+            values, offset = codec.unpack_from(datagram, offset)
+            return tuple(values), offset
         _name, dtypes, _policy = dclass._dfields[field_id]
         values = []
         for dtype in dtypes:
-            value, datagram = self._from_network(datagram, dtype)
+            value, offset = self._from_network_at(datagram, offset, dtype)
             values.append(value)
-        return field_id, tuple(values), datagram
+        return tuple(values), offset
+
+    def _delta_types(self, dclass_id, field_id):
+        dclass = self.dclasses_by_id[dclass_id]
+        _name, dtypes, _policy = dclass._dfields[field_id]
+        if self.float_quantum is None:
+            return dtypes
+        return [field_types.QUANTIZED_FLOAT if dtype is field_types.FLOAT
+                else dtype
+                for dtype in dtypes]
+
+    def field_delta(self, dobject_id, field_id, baseline, values):
+        """Compare the values of a field with the baseline that the recipient
+        already knows. Returns the mask of the changed components, their
+        values, and the values that the recipient will know after applying
+        them. Returns None if a complete FIELD_UPDATE should be sent instead."""
+        with self.dclasses_lock:
+            dclass = self.dclasses_by_dobject_id[dobject_id]
+        delta_types = self._delta_types(dclass, field_id)
+        if len(delta_types) > self.max_delta_components:
+            return None
+        mask = 0
+        changed = []
+        known = list(baseline)
+        for position, (dtype, old, new) in enumerate(zip(delta_types,
+                                                         baseline,
+                                                         values)):
+            if dtype is field_types.QUANTIZED_FLOAT:
+                quantized = round(new / self.float_quantum)
+                if not -2**15 <= quantized < 2**15:
+                    return None
+                if quantized == round(old / self.float_quantum):
+                    continue
+                new = quantized * self.float_quantum
+            elif new == old:
+                continue
+            mask |= 1 << position
+            changed.append(new)
+            known[position] = new
+        if len(changed) == len(delta_types):
+            return None  # The complete update is smaller.
+        return mask, tuple(changed), tuple(known)
+
+    def apply_field_delta(self, baseline, mask, changed):
+        """The complete values of a field, given the values that were known
+        before and a FIELD_DELTA's mask and components."""
+        values = list(baseline)
+        changed = iter(changed)
+        for position in range(len(values)):
+            if mask & (1 << position):
+                values[position] = next(changed)
+        return tuple(values)
+
+    def pack_delta_values(self, dclass_id, field_id, mask, values):
+        delta_types = self._delta_types(dclass_id, field_id)
+        changed_types = [dtype for position, dtype in enumerate(delta_types)
+                         if mask & (1 << position)]
+        packed = []
+        for dtype, value in zip(changed_types, values):
+            if dtype is field_types.QUANTIZED_FLOAT:
+                value = round(value / self.float_quantum)
+            packed.append(self._to_network(value, dtype))
+        return b''.join(packed)
+
+    def unpack_delta_values_from(self, dclass_id, field_id, mask, datagram,
+                                 offset):
+        delta_types = self._delta_types(dclass_id, field_id)
+        values = []
+        for position, dtype in enumerate(delta_types):
+            if mask & (1 << position):
+                value, offset = self._from_network_at(datagram, offset, dtype)
+                if dtype is field_types.QUANTIZED_FLOAT:
+                    value = value * self.float_quantum
+                values.append(value)
+        return tuple(values), offset
+
+    def pack_field(self, dclass_id, field_id, values):
+        return b''.join([
+            self._to_network(field_id, field_types.FIELD_ID),
+            self.pack_field_values(dclass_id, field_id, values),
+        ])
+
+    def unpack_field(self, dclass_id, datagram):
+        field_id, values, offset = self.unpack_field_from(
+            dclass_id,
+            datagram,
+            0,
+        )
+        return field_id, values, datagram[offset:]
+
+    def unpack_field_from(self, dclass_id, datagram, offset):
+        field_id, offset = self._from_network_at(
+            datagram,
+            offset,
+            field_types.FIELD_ID,
+        )
+        values, offset = self.unpack_field_values_from(
+            dclass_id,
+            field_id,
+            datagram,
+            offset,
+        )
+        return field_id, values, offset
 
     def pack_fields(self, dclass_id, values):
-        all_fields = self.dclasses_by_id[dclass_id]._dfields
-        storage_ids = [f_id
-                       for f_id, (_name, types, policy) in enumerate(all_fields)
-                       if policy & (fp.RAM | fp.PERSIST)]
-        message = b''.join([self.pack_field(dclass_id, s_id, v)
-                            for s_id, v in zip(storage_ids, values)])
+        dclass = self.dclasses_by_id[dclass_id]
+        if dclass._storage_codecs is None:
+            message = b''.join([self.pack_field(dclass_id, s_id, v)
+                                for s_id, v in zip(dclass._storage_ids,
+                                                   values)])
+        else:
+            message = b''.join([codec.pack((s_id, *v))
+                                for codec, s_id, v
+                                in zip(dclass._storage_codecs,
+                                       dclass._storage_ids,
+                                       values)])
         return message
 
     def unpack_fields(self, dclass_id, datagram):
-        all_fields = self.dclasses_by_id[dclass_id]._dfields
-        storages = [(f_id, types)
-                    for f_id, (_name, types, policy) in enumerate(all_fields)
-                    if policy & (fp.RAM | fp.PERSIST)]
+        values, offset = self.unpack_fields_from(dclass_id, datagram, 0)
+        return values, datagram[offset:]
+
+    def unpack_fields_from(self, dclass_id, datagram, offset):
+        storage_ids = self.dclasses_by_id[dclass_id]._storage_ids
         field_values = []
-        for field_id, dtypes in storages:
-            field_id, field_value, datagram = self.unpack_field(
+        for _storage_id in storage_ids:
+            field_id, field_value, offset = self.unpack_field_from(
                 dclass_id,
                 datagram,
+                offset,
             )
             field_values.append((field_id, field_value))
         field_values = sorted(field_values)
         id_matches = list(zip(
-            [s_id for s_id, _ in storages],
+            storage_ids,
             [f_id for f_id, _ in field_values],
         ))
         if not all([s_id == f_id for s_id, f_id in id_matches]):
@@ -131,7 +379,7 @@ class BasePacker:
             # FIXME: Better exception, with text!
             raise ValueError("Storage ID -> Field ID mismatch: {}"
                              "".format(mismatches))
-        return [v for _, v in field_values], datagram
+        return [v for _, v in field_values], offset
 
     def pack_message_body(self, message_type, *args):
         packed_message_type = self._to_network(
@@ -141,9 +389,8 @@ class BasePacker:
         if message_type == msgtypes.CREATE_DOBJECT:
             dclass, field_values, token = args
             packed_args = b''.join([
-                self._to_network(dclass, field_types.DCLASS),
+                self.pack_args(message_type, dclass, token),
                 self.pack_fields(dclass, field_values),
-                self._to_network(token, field_types.TOKEN),
             ])
         elif message_type in [
                 msgtypes.CREATE_DOBJECT_VIEW,
@@ -151,87 +398,176 @@ class BasePacker:
             dobject_id, dclass, fields = args
             with self.dclasses_lock:
                 self.dclasses_by_dobject_id[dobject_id] = dclass
-            packed_args = b''.join([
-                self._to_network(dobject_id, field_types.DOBJECT_ID),
-                self._to_network(dclass, field_types.DCLASS),
-                self.pack_fields(dclass, fields),
-            ])
+            return self.pack_view_body(message_type, dobject_id, dclass,
+                                       fields)
         elif message_type in [msgtypes.SET_FIELD, msgtypes.FIELD_UPDATE]:
             dobject_id, field_id, field_values = args
             with self.dclasses_lock:
                 dclass = self.dclasses_by_dobject_id[dobject_id]
             packed_args = b''.join([
-                self._to_network(dobject_id, field_type.DOBJECT_ID),
-                self._to_network(field_id, field_type.FIELD_ID),
-                self.pack_field(dclass, field_id, field_values),
+                self.pack_args(message_type, dobject_id, field_id),
+                self.pack_field_values(dclass, field_id, field_values),
+            ])
+        elif message_type == msgtypes.FIELD_DELTA:
+            dobject_id, field_id, mask, field_values = args
+            with self.dclasses_lock:
+                dclass = self.dclasses_by_dobject_id[dobject_id]
+            packed_args = b''.join([
+                self.pack_args(message_type, dobject_id, field_id, mask),
+                self.pack_delta_values(dclass, field_id, mask, field_values),
             ])
         else:
             packed_args = self.pack_args(message_type, *args)
         message = b''.join([packed_message_type, packed_args])
         return message
 
+    def pack_view_body(self, message_type, dobject_id, dclass, fields):
+        """Pack a CREATE_DOBJECT_VIEW or CREATE_AI_VIEW. The fields are sent
+        as they are stored if they are StoredFields, and the message is kept
+        with them, so that it is encoded only once for all recipients."""
+        encoded = getattr(fields, 'encoded', None)
+        key = (message_type.num_id, dobject_id)
+        if encoded is not None:
+            message = encoded.get(key)
+            if message is not None:
+                return message
+            packed_fields = fields.packed
+        else:
+            packed_fields = self.pack_fields(dclass, fields)
+        message = b''.join([
+            self._to_network(message_type.num_id, field_types.MESSAGE_TYPE),
+            self.pack_args(message_type, dobject_id, dclass),
+            packed_fields,
+        ])
+        if encoded is not None:
+            encoded[key] = message
+        return message
+
     def unpack_message_body(self, datagram):
-        message_type_id, datagram = self._from_network(
+        message, offset = self.unpack_message_body_from(datagram, 0)
+        return message, datagram[offset:]
+
+    def unpack_message_body_from(self, datagram, offset):
+        """Unpack the message starting at offset, without copying any part of
+        the datagram. Returns the message, and the offset behind it."""
+        message_type_id, offset = self._from_network_at(
             datagram,
+            offset,
             field_types.MESSAGE_TYPE,
         )
         message_type = message_type_by_id[message_type_id]
+        args, offset = self.unpack_args_from(message_type, datagram, offset)
         if message_type == msgtypes.CREATE_DOBJECT:
-            dclass_id, datagram = self._from_network(
-                datagram,
-                field_types.DCLASS,
-            )
-            field_values, datagram = self.unpack_fields(dclass_id, datagram)
-            token, datagram = self._from_network(
+            dclass_id, token = args
+            field_values, offset = self.unpack_fields_from(
+                dclass_id,
                 datagram,
-                field_types.TOKEN,
+                offset,
             )
             args = [dclass_id, field_values, token]
         elif message_type in [
                 msgtypes.CREATE_DOBJECT_VIEW,
                 msgtypes.CREATE_AI_VIEW]:
-            dobject_id, datagram = self._from_network(
+            dobject_id, dclass = args
+            with self.dclasses_lock:
+                self.dclasses_by_dobject_id[dobject_id] = dclass
+            field_values, offset = self.unpack_fields_from(
+                dclass,
                 datagram,
-                field_types.DOBJECT_ID,
+                offset,
             )
-            dclass, datagram = self._from_network(
+            args = [dobject_id, dclass, field_values]
+        elif message_type in [msgtypes.SET_FIELD, msgtypes.FIELD_UPDATE]:
+            dobject_id, field_id = args
+            with self.dclasses_lock:
+                dclass = self.dclasses_by_dobject_id[dobject_id]
+            field_values, offset = self.unpack_field_values_from(
+                dclass,
+                field_id,
                 datagram,
-                field_types.DCLASS,
+                offset,
             )
-            field_values, datagram = self.unpack_fields(dclass, datagram)
-            args = [dobject_id, dclass, field_values]
-        else:
-            args, datagram = self.unpack_args(message_type, datagram)
-        return ([message_type] + args, datagram)
+            args = [dobject_id, field_id, field_values]
+        elif message_type == msgtypes.FIELD_DELTA:
+            dobject_id, field_id, mask = args
+            with self.dclasses_lock:
+                dclass = self.dclasses_by_dobject_id[dobject_id]
+            field_values, offset = self.unpack_delta_values_from(
+                dclass,
+                field_id,
+                mask,
+                datagram,
+                offset,
+            )
+            args = [dobject_id, field_id, mask, field_values]
+        return ([message_type] + args, offset)
 
 
 class AIPacker(BasePacker):
     def pack_message(self, from_channel, to_channel, message_type, *args):
-        channels = b''.join([
-            self._to_network(from_channel, field_types.CHANNEL),
-            self._to_network(to_channel, field_types.CHANNEL),
-        ])
+        channels = channel_header_codec.pack((from_channel, to_channel))
         message_body = self.pack_message_body(message_type, *args)
         message = b''.join([channels, message_body])
-        return message
+        return self.frame(message)
 
-    def unpack_message(self, datagram):
-        from_channel, datagram = self._from_network(
+    def pack_multicast_message(self, from_channel, to_channels, message_type,
+                               *args):
+        """Pack a message for several recipients. The body is encoded only
+        once; only the channel header differs between the returned frames."""
+        message_body = self.pack_message_body(message_type, *args)
+        return [self.frame(b''.join([
+                    channel_header_codec.pack((from_channel, to_channel)),
+                    message_body,
+                ]))
+                for to_channel in to_channels]
+
+    def peek_channels(self, datagram, start):
+        """Read only the from and to channels of the message starting at
+        start, leaving the rest of it undecoded."""
+        channels, _offset = channel_header_codec.unpack_from(datagram, start)
+        return channels
+
+    def unpack_unframed_from(self, datagram, offset):
+        (from_channel, to_channel), offset = channel_header_codec.unpack_from(
             datagram,
-            field_types.CHANNEL,
+            offset,
         )
-        to_channel, datagram = self._from_network(
+        [message_type, *args], offset = self.unpack_message_body_from(
             datagram,
-            field_types.CHANNEL,
+            offset,
         )
-        [message_type, *args], datagram = self.unpack_message_body(datagram)
-        return ([from_channel, to_channel, message_type] + args, datagram)
+        return ([from_channel, to_channel, message_type] + args, offset)
 
 
 class ClientPacker(BasePacker):
     def pack_message(self, message_type, *args):
-        return self.pack_message_body(message_type, *args)
+        return self.frame(self.pack_message_body(message_type, *args))
 
-    def unpack_message(self, datagram):
-        message, datagram = self.unpack_message_body(datagram)
-        return message, datagram
+    def pack_field_update(self, baseline, dobject_id, field_id, values):
+        """Pack a FIELD_UPDATE for a recipient that knows the field's values
+        in baseline, or None if it doesn't know them yet. Only the changed
+        components are sent if possible. Returns the frame, and the values
+        that the recipient will know."""
+        delta = None
+        if baseline is not None:
+            delta = self.field_delta(dobject_id, field_id, baseline, values)
+        if delta is None:
+            frame = self.pack_message(
+                msgtypes.FIELD_UPDATE,
+                dobject_id,
+                field_id,
+                values,
+            )
+            return frame, tuple(values)
+        mask, changed, known = delta
+        frame = self.pack_message(
+            msgtypes.FIELD_DELTA,
+            dobject_id,
+            field_id,
+            mask,
+            changed,
+        )
+        return frame, known
+
+    def unpack_unframed_from(self, datagram, offset):
+        return self.unpack_message_body_from(datagram, offset)
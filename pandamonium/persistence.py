@@ -0,0 +1,158 @@
+from threading import Lock, Thread, Event
+import json
+import logging
+import sqlite3
+
+
+logger = logging.getLogger(__name__)
+
+
+class BasePersistence:
+    """A storage backend for the PERSIST fields of dobjects. Dobjects and
+    fields are recorded by name rather than by ID, since IDs are assigned by
+    sorting names, and shift when dclasses or fields are added."""
+    def write_batch(self, dobjects, fields):
+        """Store a batch of writes in one go.
+
+        dobjects is a list of (dobject_id, dclass_name), fields a dict of
+        (dobject_id, field_name) -> values. Dobjects are written first, as
+        fields may belong to dobjects of the same batch."""
+        raise NotImplementedError
+
+    def load(self):
+        """Yield (dobject_id, dclass_name, {field_name: values}) for each
+        stored dobject."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores dobjects in an SQLite database, with one row per dobject, and
+    one row per field holding its values as JSON."""
+    def __init__(self, path):
+        # Batches are written by the WriteBehind thread, while loading happens
+        # on the thread that starts the state server.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS dobjects ("
+                "dobject_id INTEGER PRIMARY KEY, "
+                "dclass TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fields ("
+                "dobject_id INTEGER NOT NULL, "
+                "field TEXT NOT NULL, "
+                "value TEXT NOT NULL, "
+                "PRIMARY KEY (dobject_id, field))"
+            )
+
+    def write_batch(self, dobjects, fields):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO dobjects (dobject_id, dclass) "
+                "VALUES (?, ?)",
+                dobjects,
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fields (dobject_id, field, value) "
+                "VALUES (?, ?, ?)",
+                [(dobject_id, field_name, json.dumps(list(values)))
+                 for (dobject_id, field_name), values in fields.items()],
+            )
+
+    def load(self):
+        with self.lock:
+            dobjects = self.connection.execute(
+                "SELECT dobject_id, dclass FROM dobjects ORDER BY dobject_id"
+            ).fetchall()
+            fields = {}
+            for dobject_id, field_name, value in self.connection.execute(
+                    "SELECT dobject_id, field, value FROM fields"):
+                fields.setdefault(dobject_id, {})[field_name] = \
+                    tuple(json.loads(value))
+        for dobject_id, dclass_name in dobjects:
+            yield dobject_id, dclass_name, fields.get(dobject_id, {})
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class WriteBehind:
+    """Puts a persistence backend behind a buffer, so that writes never wait
+    for the disk. Writes are collected, with only the latest value of each
+    field kept, and handed to the backend in one batch every flush_interval
+    seconds, or as soon as batch_size writes are waiting."""
+    flush_interval = 1.0
+    batch_size = 1000
+
+    def __init__(self, backend, flush_interval=None, batch_size=None):
+        self.backend = backend
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.pending_dobjects = []
+        self.pending_fields = {}
+        # Held only to swap the pending writes; the backend is written to
+        # under the flush lock, which is never taken by the writers.
+        self.pending_lock = Lock()
+        self.flush_lock = Lock()
+        self.batch_full = Event()
+        self.stopped = False
+        self.thread = Thread(
+            target=self._write_behind,
+            name="Persistence write-behind thread",
+        )
+        self.thread.start()
+
+    def load(self):
+        return self.backend.load()
+
+    def create_dobject(self, dobject_id, dclass_name, fields):
+        with self.pending_lock:
+            self.pending_dobjects.append((dobject_id, dclass_name))
+            for field_name, values in fields.items():
+                self.pending_fields[(dobject_id, field_name)] = tuple(values)
+            self._check_batch_size()
+
+    def set_field(self, dobject_id, field_name, values):
+        with self.pending_lock:
+            self.pending_fields[(dobject_id, field_name)] = tuple(values)
+            self._check_batch_size()
+
+    def _check_batch_size(self):
+        if len(self.pending_dobjects) + len(self.pending_fields) >= \
+           self.batch_size:
+            self.batch_full.set()
+
+    def flush(self):
+        """Write all pending writes to the backend now."""
+        with self.flush_lock:
+            with self.pending_lock:
+                dobjects = self.pending_dobjects
+                fields = self.pending_fields
+                self.pending_dobjects = []
+                self.pending_fields = {}
+                self.batch_full.clear()
+            if dobjects or fields:
+                self.backend.write_batch(dobjects, fields)
+
+    def _write_behind(self):
+        while not self.stopped:
+            self.batch_full.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write to persistence backend")
+
+    def shutdown(self):
+        self.stopped = True
+        self.batch_full.set()
+        self.thread.join()
+        self.flush()
+        self.backend.close()
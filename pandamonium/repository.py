@@ -25,8 +25,11 @@ class BaseRepository:
             fields,
         )
 
+    def handle_destroy_dobject_view(self, dobject_id):
+        del self.dobjects[dobject_id]
+
     def get_dobject_fields(self, dobject_id):
-        return self.dobjects[dobject_id].dfields
+        return self.dobjects[dobject_id].storage
 
 
 class ClientRepository(BaseRepository):
@@ -45,6 +48,9 @@ class ClientRepository(BaseRepository):
             dclass = args[1]
             fields = args[2]
             self.handle_create_dobject_view(dobject_id, dclass, fields)
+        elif message_type == msgtypes.DESTROY_DOBJECT_VIEW:
+            dobject_id = args[0]
+            self.handle_destroy_dobject_view(dobject_id)
         elif message_type == msgtypes.BECOME_OWNER:
             dobject_id = args[0]
             self.handle_become_owner(dobject_id)
@@ -111,6 +117,9 @@ class AIRepository(BaseRepository):
             dclass = args[1]
             fields = args[2]
             self.handle_create_dobject_view(dobject_id, dclass, fields)
+        elif message_type == msgtypes.DESTROY_DOBJECT_VIEW:
+            dobject_id = args[0]
+            self.handle_destroy_dobject_view(dobject_id)
         elif message_type == msgtypes.CREATE_AI_VIEW:
             dobject_id = args[0]
             dclass = args[1]
@@ -1,17 +1,36 @@
 import socket
+import asyncio
+import selectors
+import secrets
+import struct
+import time
+from collections import deque
 from queue import Queue, Empty
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, Event
+from functools import partial
 import logging
 
-from pandamonium.util import IDGenerator
-from pandamonium.constants import channels, msgtypes
-from pandamonium.packers import DatagramIncomplete
+from pandamonium.util import IDGenerator, ReceiveBuffer, sequence_newer
+from pandamonium.constants import channels, msgtypes, overflow_policies
+from pandamonium.constants import field_policies as fp
+from pandamonium.packers import DatagramIncomplete, sequence_header_codec
 
 
 logger = logging.getLogger(__name__)
 
 
+class InvalidFrame(Exception):
+    """A frame could not be decoded; it is malformed, or of an unknown message
+    type or dclass."""
+
+
 class BaseListener:
+    # Limits of each connection's queue of messages waiting to be sent, and
+    # what to do when a connection falls so far behind that they overflow.
+    send_queue_max_messages = None
+    send_queue_max_bytes = None
+    send_queue_overflow = overflow_policies.DISCONNECT
+
     def listen(self):
         """Start to listen for new connections."""
         raise NotImplementedError
@@ -30,6 +49,45 @@ class BaseListener:
         """A message for a connection has occurred."""
         raise NotImplementedError
 
+    def handle_multicast_connection_message(self, from_channel, to_channels,
+                                            message_type, *args):
+        """A message for several connections has occurred."""
+        for to_channel in to_channels:
+            self.handle_connection_message(
+                from_channel,
+                to_channel,
+                message_type,
+                *args,
+            )
+
+    def pack_connection_message(self, connection, message):
+        """Pack a message that was enqueued for the connection, right before
+        it is written to it."""
+        return self.pack_message(*message)
+
+    def make_send_queue(self):
+        return SendQueue(
+            max_messages=self.send_queue_max_messages,
+            max_bytes=self.send_queue_max_bytes,
+            overflow=self.send_queue_overflow,
+        )
+
+    def handle_send_queue_overflow(self, connection):
+        """The connection's send queue has overflowed, and nothing more is
+        queued for it."""
+        logger.error("{} can't keep up with its messages, closing it."
+                     "".format(connection))
+        connection.shutdown()
+
+    def send_queue_depths(self):
+        """The number of messages and bytes waiting to be sent, for each
+        connection."""
+        with self.connections_lock:
+            connections = list(self.connections.items())
+        return {connection_id: (len(connection.queue),
+                                connection.queue.num_bytes)
+                for connection_id, connection in connections}
+
 
 class BaseConnector:
     def connect(self):
@@ -49,15 +107,160 @@ class BaseConnector:
 # hybrid TCP / UDP.
 
 
-class NetworkListenerConnection:
-    def __init__(self, agent, socket, address, connection_id):
+class SendQueue:
+    """The messages waiting to be written to a connection. It may be bounded
+    in messages and bytes; if it overflows, the overflow policy decides which
+    queued field updates are dropped to make room. The sizes of messages that
+    are packed only when they are written are estimated."""
+    unpacked_message_size = 64
+
+    def __init__(self, max_messages=None, max_bytes=None,
+                 overflow=overflow_policies.DISCONNECT):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        # (message, size, (dobject_id, field_id) or None, droppable)
+        self.entries = deque()
+        self.num_bytes = 0
+        self.condition = Condition()
+        # Metrics
+        self.peak_messages = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _exceeds(self, num_messages, num_bytes):
+        return (self.max_messages is not None and
+                num_messages > self.max_messages) or \
+               (self.max_bytes is not None and num_bytes > self.max_bytes)
+
+    def put(self, message, field=None, droppable=False):
+        """Queue a message. For FIELD_UPDATEs, field is the updated
+        (dobject_id, field_id), and droppable tells whether the update may be
+        lost. Returns False if the queue overflows despite the policy."""
+        if isinstance(message, bytes):
+            size = len(message)
+        else:
+            size = self.unpacked_message_size
+        with self.condition:
+            self.entries.append((message, size, field, droppable))
+            self.num_bytes += size
+            fits = True
+            if self._exceeds(len(self.entries), self.num_bytes):
+                if self.overflow == overflow_policies.DROP_UNRELIABLE:
+                    self._drop_unreliable()
+                elif self.overflow == overflow_policies.COLLAPSE_FIELDS:
+                    self._collapse_fields()
+                fits = not self._exceeds(len(self.entries), self.num_bytes)
+            self.peak_messages = max(self.peak_messages, len(self.entries))
+            self.condition.notify()
+        return fits
+
+    def _drop_unreliable(self):
+        """Drop droppable updates, oldest first, until the queue fits."""
+        kept = deque()
+        num_messages = len(self.entries)
+        for entry in self.entries:
+            _message, size, _field, droppable = entry
+            if droppable and self._exceeds(num_messages, self.num_bytes):
+                num_messages -= 1
+                self.num_bytes -= size
+                self.dropped += 1
+            else:
+                kept.append(entry)
+        self.entries = kept
+
+    def _collapse_fields(self):
+        """Drop all updates that are followed by a later one of the same
+        field."""
+        kept = deque()
+        fields = set()
+        for entry in reversed(self.entries):
+            _message, size, field, _droppable = entry
+            if field is not None:
+                if field in fields:
+                    self.num_bytes -= size
+                    self.dropped += 1
+                    continue
+                fields.add(field)
+            kept.appendleft(entry)
+        self.entries = kept
+
+    def get(self, block=True, timeout=None):
+        """Take the oldest message, or raise Empty."""
+        with self.condition:
+            if block:
+                self.condition.wait_for(lambda: self.entries, timeout)
+            if not self.entries:
+                raise Empty
+            message, size, _field, _droppable = self.entries.popleft()
+            self.num_bytes -= size
+            return message
+
+    def clear(self):
+        with self.condition:
+            self.entries.clear()
+            self.num_bytes = 0
+
+
+class BaseListenerConnection:
+    def _handle_received(self, receive_buffer):
+        """Parse and handle all complete frames in the buffer in place."""
+        with receive_buffer.view() as datagram:
+            offset = receive_buffer.start
+            try:
+                while True:
+                    try:
+                        start, end = self.agent.frame_bounds(datagram, offset)
+                        if self.agent.pass_through:
+                            frame = bytes(datagram[offset:end])
+                        else:
+                            message = self.agent.unpack_frame(
+                                datagram,
+                                start,
+                                end,
+                            )
+                    except (ValueError, KeyError, struct.error) as e:
+                        raise InvalidFrame(e) from e
+                    offset = end
+                    # The frame was fine, so a failure to handle it doesn't
+                    # concern the connection.
+                    try:
+                        if self.agent.pass_through:
+                            self.agent.handle_incoming_frame(frame)
+                        else:
+                            self.agent.handle_incoming_message(*message)
+                    except Exception:
+                        logger.exception("Failed to handle a message from {}"
+                                         "".format(self))
+            except DatagramIncomplete:
+                # keep reading
+                pass
+            receive_buffer.consume(offset)
+
+
+class NetworkListenerConnection(BaseListenerConnection):
+    # The writer sends all messages that have queued up in one call, up to
+    # this many of them and about this many bytes.
+    flush_max_messages = 256
+    flush_max_bytes = 65536
+
+    def __init__(self, agent, socket, address, connection_id,
+                 send_queue=None):
         self.agent = agent
         self.socket = socket
         self.address = address
         self.connection_id = connection_id
+        # dobject_id -> field_id -> values that the peer knows
+        self.field_baselines = {}
         self.keep_running = True
         self.keep_enqueueing = True
-        self.queue = Queue()
+        # Set once the connection is to be closed after its queue is written
+        self.closing = False
+        if send_queue is None:
+            send_queue = SendQueue()
+        self.queue = send_queue
         self.timeout = 2.0
         self.socket.settimeout(self.timeout)
 
@@ -78,61 +281,263 @@ class NetworkListenerConnection:
     def read_socket(self):
         logger.info("Starting thread for connection {} ({})".format(
             self.connection_id, self.address))
-        datagram = b''
+        receive_buffer = ReceiveBuffer()
         try:
             while self.keep_running:
                 try:
-                    incoming = self.socket.recv(1024)
-                    if incoming == b'':
+                    if receive_buffer.recv_from(self.socket) == 0:
                         raise ConnectionResetError
-                    datagram += incoming
-                    try:
-                        while True:
-                            message, datagram = self.agent.unpack_message(
-                                datagram,
-                            )
-                            self.agent.handle_incoming_message(*message)
-                    except DatagramIncomplete:
-                        # keep reading
-                        pass
+                    self._handle_received(receive_buffer)
                 except socket.timeout:
                     pass
         except ConnectionResetError:
             logger.warning("{} lost connection".format(self))
+        except InvalidFrame:
+            logger.exception("{} sent an invalid frame".format(self))
         self.agent.close_connection(self.connection_id)
         logger.info("Stopping reader thread for connection {}"
                     "".format(self.connection_id))
 
+    def _pack(self, message):
+        if isinstance(message, bytes):
+            return message  # Already packed frame
+        return self.agent.pack_connection_message(self, message)
+
+    def _next_batch(self):
+        """Wait for a message, then pack it and all that are queued behind it
+        into one buffer, within the flush budget. Returns None if nothing was
+        queued until the timeout."""
+        try:
+            message = self.queue.get(block=True, timeout=self.timeout)
+        except Empty:
+            return None
+        batch = [self._pack(message)]
+        num_bytes = len(batch[0])
+        try:
+            while len(batch) < self.flush_max_messages and \
+                  num_bytes < self.flush_max_bytes:
+                frame = self._pack(self.queue.get(block=False))
+                batch.append(frame)
+                num_bytes += len(frame)
+        except Empty:
+            pass
+        return b''.join(batch)
+
     def write_socket(self):
         # FIXME: Handle socket disconnection with cleanup
         while self.keep_running:
-            try:
-                message = self.queue.get(block=True, timeout=self.timeout)
-                datagram = self.agent.pack_message(*message)
-                self.socket.send(datagram)
-            except Empty:
-                pass
+            datagram = self._next_batch()
+            if datagram is not None:
+                try:
+                    self.socket.sendall(datagram)
+                except OSError:
+                    # Including timeouts, after which part of the batch may
+                    # have been sent; the stream can't be continued.
+                    logger.warning("{} could not be written to".format(self))
+                    self._shutdown_socket()
+                    break
+            if self.closing and not self.queue:
+                # The reader will see the connection closed, and have it
+                # cleaned up.
+                self._shutdown_socket()
+                break
         logger.info("Stopping writer thread for connection {}"
                     "".format(self.connection_id))
 
+    def _put(self, message, field=None, droppable=False):
+        if not self.keep_enqueueing:
+            return
+        if not self.queue.put(message, field, droppable):
+            self.keep_enqueueing = False
+            self.agent.handle_send_queue_overflow(self)
+
     def enqueue(self, *message):
-        if self.keep_enqueueing:
-            self.queue.put(message)
-        else:
-            pass
+        self._put(message)
+
+    def enqueue_frame(self, frame):
+        self._put(frame)
+
+    def enqueue_field_update(self, message, dobject_id, field_id, droppable):
+        """Queue a FIELD_UPDATE, packed or not. If the queue overflows, it
+        may be dropped in favor of a later update of the same field, or, if
+        droppable, for being old."""
+        self._put(message, (dobject_id, field_id), droppable)
+
+    def disconnect(self, frame):
+        """Replace everything that is queued with a last frame, and close the
+        connection once it is written."""
+        self.keep_enqueueing = False
+        self.closing = True
+        self.queue.clear()
+        self.queue.put(frame)
+
+    def _shutdown_socket(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already disconnected
 
     def shutdown(self):
         self.keep_running = False
         self.keep_enqueueing = False
         # FIXME: Move into cleanup
-        self.socket.shutdown(socket.SHUT_RDWR)
+        self._shutdown_socket()
 
     def join(self):
         self.reader_tread.join()
         self.writer_tread.join()
 
 
+class SharedFieldUpdate:
+    """A FIELD_UPDATE for several connections of a listener that sends
+    deltas. It is packed when it is written to each connection, against that
+    connection's baseline; connections with the same baseline share the
+    frame."""
+    __slots__ = ('message', 'frames')
+
+    def __init__(self, message):
+        self.message = message
+        # baseline -> (frame, values known after it)
+        self.frames = {}
+
+
+class UnreliableChannel:
+    """The UDP side channel of a listener. Updates of UNRELIABLE fields are
+    sent over it instead of over the connections' TCP streams, so that a lost
+    packet doesn't hold up the ones behind it.
+    A connection is offered a token over TCP, and its UDP address is learned
+    from the datagram that the client sends that token back in. Until then,
+    its unreliable updates go over TCP as well.
+    Only the latest update per dobject field is kept for sending, and each
+    datagram carries a sequence number, so that the client can drop updates
+    that arrive after newer ones."""
+    datagram_size = 1200
+    timeout = 0.2
+
+    def __init__(self, listener, interface, port):
+        self.listener = listener
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((interface, port))
+        self.socket.settimeout(self.timeout)
+        self.connections_by_token = {}
+        # connection -> (dobject_id, field_id) -> frame
+        self.pending = {}
+        self.pending_condition = Condition()
+        self.keep_running = True
+        self.reader_thread = Thread(
+            target=self._read_socket,
+            name="UDP reader thread ({})".format(listener),
+        )
+        self.writer_thread = Thread(
+            target=self._write_socket,
+            name="UDP writer thread ({})".format(listener),
+        )
+        self.reader_thread.start()
+        self.writer_thread.start()
+
+    def get_port(self):
+        return self.socket.getsockname()[1]
+
+    def offer(self, connection):
+        """Send the connection the token to claim its UDP address with."""
+        token = secrets.randbelow(2**31)
+        connection.udp_address = None
+        connection.udp_sequence = 0
+        self.connections_by_token[token] = connection
+        connection.udp_token = token
+        connection.enqueue(msgtypes.UNRELIABLE_CHANNEL, token, self.get_port())
+
+    def forget(self, connection):
+        self.connections_by_token.pop(connection.udp_token, None)
+        with self.pending_condition:
+            self.pending.pop(connection, None)
+
+    def enqueue(self, connection, dobject_id, field_id, frame):
+        """Queue a FIELD_UPDATE frame, replacing any unsent earlier update of
+        the same field."""
+        with self.pending_condition:
+            updates = self.pending.setdefault(connection, {})
+            updates[(dobject_id, field_id)] = frame
+            self.pending_condition.notify()
+
+    def _read_socket(self):
+        while self.keep_running:
+            try:
+                datagram, address = self.socket.recvfrom(self.datagram_size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                start, end = self.listener.frame_bounds(datagram, 0)
+                message_type, token, _port = self.listener.unpack_frame(
+                    datagram,
+                    start,
+                    end,
+                )
+            except (DatagramIncomplete, KeyError, ValueError):
+                continue
+            connection = self.connections_by_token.get(token)
+            if message_type != msgtypes.UNRELIABLE_CHANNEL or \
+               connection is None:
+                continue
+            if connection.udp_address != address:
+                logger.info("{} receives unreliable updates at {}"
+                            "".format(connection, address))
+                connection.udp_address = address
+            # An empty datagram acknowledges the claim.
+            self._send(connection, [])
+        logger.info("Stopping UDP reader thread for {}".format(self.listener))
+
+    def _write_socket(self):
+        while self.keep_running:
+            with self.pending_condition:
+                if not self.pending:
+                    self.pending_condition.wait(self.timeout)
+                pending, self.pending = self.pending, {}
+            for connection, updates in pending.items():
+                self._send_updates(connection, list(updates.values()))
+        logger.info("Stopping UDP writer thread for {}".format(self.listener))
+
+    def _send_updates(self, connection, frames):
+        """Send the frames in as few datagrams as possible."""
+        space = self.datagram_size - sequence_header_codec.size
+        datagram_frames = []
+        datagram_length = 0
+        for frame in frames:
+            if datagram_frames and datagram_length + len(frame) > space:
+                self._send(connection, datagram_frames)
+                datagram_frames = []
+                datagram_length = 0
+            datagram_frames.append(frame)
+            datagram_length += len(frame)
+        if datagram_frames:
+            self._send(connection, datagram_frames)
+
+    def _send(self, connection, frames):
+        if frames:
+            connection.udp_sequence = (connection.udp_sequence + 1) % 2**32
+        header = sequence_header_codec.pack((connection.udp_sequence, ))
+        try:
+            self.socket.sendto(b''.join([header] + frames),
+                               connection.udp_address)
+        except OSError:
+            logger.warning("Could not send datagram to {}".format(connection))
+
+    def shutdown(self):
+        self.keep_running = False
+        with self.pending_condition:
+            self.pending_condition.notify()
+        self.reader_thread.join()
+        self.writer_thread.join()
+        self.socket.close()
+
+
 class NetworkListener(BaseListener):
+    pass_through = False
+    # If set, UNRELIABLE field updates are sent over UDP on this port
+    udp_port = None
+
     def __init__(self):
         self.id_gen = IDGenerator(id_range=self.connection_ids)
         self.dclasses_by_id = [self.dclasses[dclass_name]
@@ -144,6 +549,13 @@ class NetworkListener(BaseListener):
         self.socket.bind((self.interface, self.port))
         self.socket.listen()
         self.socket.settimeout(self.timeout)
+        self.unreliable_channel = None
+        if self.udp_port is not None:
+            self.unreliable_channel = UnreliableChannel(
+                self,
+                self.interface,
+                self.udp_port,
+            )
 
         self.listener_thread = None
         self.cleanup_thread = None
@@ -187,12 +599,16 @@ class NetworkListener(BaseListener):
         logger.info("{} opens connection from {} (id {})"
                     "".format(self, addr, connection_id))
         with self.connections_lock:
-            self.connections[connection_id] = NetworkListenerConnection(
+            connection = NetworkListenerConnection(
                 self,
                 sock,
                 addr,
                 connection_id,
+                send_queue=self.make_send_queue(),
             )
+            self.connections[connection_id] = connection
+        if self.unreliable_channel is not None:
+            self.unreliable_channel.offer(connection)
         self.message_director.subscribe_to_channel(connection_id, self)
         self.handle_connection(connection_id, addr)
 
@@ -200,6 +616,8 @@ class NetworkListener(BaseListener):
         logger.fatal("Implement closing for connection {}, please"
                       "".format(connection_id))
         self.message_director.unsubscribe_from_channel(connection_id, self)
+        if self.unreliable_channel is not None:
+            self.unreliable_channel.forget(self.connections[connection_id])
         # TODO: broadcast ai/client vanishing
         self.cleanup_queue.put(connection_id)
 
@@ -227,15 +645,18 @@ class NetworkListener(BaseListener):
             connection.shutdown()
         logger.info("{} waiting for cleanup to finish".format(self))
         self.cleanup_thread.join()
+        if self.unreliable_channel is not None:
+            self.unreliable_channel.shutdown()
         logger.info("{} shutting down socket".format(self))
         self.socket.shutdown(socket.SHUT_RDWR)
 
 
-class NetworkAIListener(NetworkListener):
-    interface = '127.0.0.1'
-    port = 50550
-    timeout = 5.0
-    threaded_connections = True
+class AIListenerMessages:
+    """Message handling of AI listeners, regardless of how their connections
+    are served."""
+    # Route incoming frames by their channels only, and forward frames for
+    # other AIs without unpacking and repacking them.
+    pass_through = False
 
     def handle_connection_message(self, from_channel, to_channel, message_type,
                                   *args):
@@ -259,30 +680,71 @@ class NetworkAIListener(NetworkListener):
                         from_channel, to_channel, message_type,
                     )
         )
-        for connection in self.connections.values():
-            self.send_message(
-                connection,
-                from_channel,
-                to_channel,
-                message_type,
-                *args,
-            )
+        # Encode once, no matter how many AIs there are.
+        frame = self.pack_message(from_channel, to_channel, message_type, *args)
+        for connection in list(self.connections.values()):
+            connection.enqueue_frame(frame)
+
+    def handle_multicast_connection_message(self, from_channel, to_channels,
+                                            message_type, *args):
+        logger.debug("AIListener got multicast message to handle: "
+                     "{} -> {} ({})".format(
+                         from_channel, to_channels, message_type,
+                     )
+        )
+        frames = self.pack_multicast_message(
+            from_channel,
+            to_channels,
+            message_type,
+            *args,
+        )
+        for to_channel, frame in zip(to_channels, frames):
+            self.connections[to_channel].enqueue_frame(frame)
 
     def send_message(self, connection, from_channel, to_channel, message_type,
                      *args):
         connection.enqueue(from_channel, to_channel, message_type, *args)
 
+    def handle_frame(self, from_channel, to_channel, frame):
+        """An already packed frame for one or all connections has occurred."""
+        logger.debug("AIListener got frame to forward: {} -> {}".format(
+            from_channel, to_channel,
+        ))
+        if to_channel == self.all_connections:
+            connections = list(self.connections.values())
+        else:
+            connections = [self.connections[to_channel]]
+        for connection in connections:
+            connection.enqueue_frame(frame)
+
+
+class NetworkAIListener(AIListenerMessages, NetworkListener):
+    interface = '127.0.0.1'
+    port = 50550
+    timeout = 5.0
+    threaded_connections = True
 
     def __repr__(self):
         return "<AI agent listener>"
 
 
-class NetworkClientListener(NetworkListener):
-    interface = '0.0.0.0'
-    port = 50551
+class NetworkStateServerListener(AIListenerMessages, NetworkListener):
+    interface = '127.0.0.1'
+    port = 50552
     timeout = 5.0
     threaded_connections = True
 
+    def __repr__(self):
+        return "<state server agent listener>"
+
+
+class ClientListenerMessages:
+    """Message handling of client listeners, regardless of how their
+    connections are served."""
+    # If set, FIELD_UPDATEs sent over the connections' streams carry only the
+    # components that changed since the field's last update to the connection.
+    delta_updates = False
+
     def handle_connection_message(self, from_channel, to_channel, message_type,
                                   *args):
         logger.debug("ClientAgent got connection message to handle: "
@@ -290,51 +752,547 @@ class NetworkClientListener(NetworkListener):
                          from_channel, to_channel, message_type,
                     )
         )
-        # if message_type == msgtypes.DISCONNECT_CLIENT:
-        #     client_id = to_channel
-        #     reason = args[0]
-        #     self.handle_disconnect_client(client_id, reason)
-        # else:
-        #     self.listeners[to_channel].handle_message(
-        #         message_type,
-        #         *args,
-        #     )
+        if message_type == msgtypes.DISCONNECT_CLIENT:
+            client_id, reason = args
+            self.handle_disconnect_client(client_id, reason)
+        elif message_type == msgtypes.FIELD_UPDATE:
+            dobject_id, field_id = args[0], args[1]
+            connection = self.connections[to_channel]
+            unreliable = self._field_is_unreliable(dobject_id, field_id)
+            if unreliable and self.unreliable_channel is not None and \
+               connection.udp_address is not None:
+                self.unreliable_channel.enqueue(
+                    connection,
+                    dobject_id,
+                    field_id,
+                    self.pack_message(message_type, *args),
+                )
+            else:
+                # Packed when written, as the view may not have been yet.
+                connection.enqueue_field_update(
+                    (message_type, ) + args,
+                    dobject_id,
+                    field_id,
+                    unreliable,
+                )
+        else:
+            self.connections[to_channel].enqueue(message_type, *args)
+
+    def handle_disconnect_client(self, client_id, reason):
+        """Send the client the reason, then close its connection."""
+        logger.info("Disconnecting client {}: {}".format(client_id, reason))
+        with self.connections_lock:
+            connection = self.connections.get(client_id)
+        if connection is None:
+            return  # Already gone
+        connection.disconnect(self.pack_message(msgtypes.DISCONNECTED, reason))
+        self.message_director.create_message(
+            client_id,
+            channels.ALL_AIS,
+            msgtypes.CLIENT_DISCONNECTED,
+            client_id,
+        )
+
+    def handle_send_queue_overflow(self, connection):
+        logger.warning("{} can't keep up with its messages".format(connection))
+        client_id = connection.connection_id
+        self.message_director.create_message(
+            client_id,
+            client_id,
+            msgtypes.DISCONNECT_CLIENT,
+            client_id,
+            "Too many messages waiting to be sent.",
+        )
+
+    def handle_broadcast_message(self, from_channel, to_channel, message_type,
+                                 *args):
+        logger.debug("ClientAgent got broadcast message to handle: "
+                     "{} -> {} ({})".format(
+                         from_channel, to_channel, message_type,
+                     )
+        )
+        self.handle_multicast_connection_message(
+            from_channel,
+            list(self.connections),
+            message_type,
+            *args,
+        )
+
+    def handle_multicast_connection_message(self, from_channel, to_channels,
+                                            message_type, *args):
+        # Client frames carry no channels, so all recipients get the very same
+        # frame, unless it depends on what each of them knows already.
+        if self.delta_updates and message_type == msgtypes.FIELD_UPDATE:
+            stream_frame = SharedFieldUpdate((message_type, ) + args)
+            frame = None
+        elif self.delta_updates and \
+             message_type == msgtypes.DESTROY_DOBJECT_VIEW:
+            # Packed for each connection, so that its baselines get dropped.
+            for to_channel in to_channels:
+                self.connections[to_channel].enqueue(message_type, *args)
+            return
+        else:
+            frame = self.pack_message(message_type, *args)
+            stream_frame = frame
+        if message_type != msgtypes.FIELD_UPDATE:
+            for to_channel in to_channels:
+                self.connections[to_channel].enqueue_frame(stream_frame)
+            return
+        dobject_id, field_id = args[0], args[1]
+        unreliable = self._field_is_unreliable(dobject_id, field_id)
+        use_udp = unreliable and self.unreliable_channel is not None
+        if use_udp and frame is None:
+            # Datagrams can't rely on baselines, as they may get lost.
+            frame = self.pack_message(message_type, *args)
+        for to_channel in to_channels:
+            connection = self.connections[to_channel]
+            if use_udp and connection.udp_address is not None:
+                self.unreliable_channel.enqueue(
+                    connection,
+                    dobject_id,
+                    field_id,
+                    frame,
+                )
+            else:
+                connection.enqueue_field_update(
+                    stream_frame,
+                    dobject_id,
+                    field_id,
+                    unreliable,
+                )
+
+    def pack_connection_message(self, connection, message):
+        if not self.delta_updates:
+            return self.pack_message(*message)
+        if isinstance(message, SharedFieldUpdate):
+            frames = message.frames
+            message = message.message
+        else:
+            frames = {}
+        message_type = message[0]
+        if message_type == msgtypes.FIELD_UPDATE:
+            _message_type, dobject_id, field_id, values = message
+            baselines = connection.field_baselines.setdefault(dobject_id, {})
+            baseline = baselines.get(field_id)
+            if baseline not in frames:
+                frames[baseline] = self.pack_field_update(
+                    baseline,
+                    dobject_id,
+                    field_id,
+                    values,
+                )
+            frame, baselines[field_id] = frames[baseline]
+            return frame
+        if message_type == msgtypes.DESTROY_DOBJECT_VIEW:
+            connection.field_baselines.pop(message[1], None)
+        return self.pack_message(*message)
+
+    def _field_is_unreliable(self, dobject_id, field_id):
+        """Whether updates of the field may be lost."""
+        with self.dclasses_lock:
+            dclass_id = self.dclasses_by_dobject_id.get(dobject_id)
+        if dclass_id is None:
+            # The view hasn't been packed yet, so the update has to queue up
+            # behind it on the TCP stream.
+            return False
+        dclass = self.dclasses_by_id[dclass_id]
+        return field_id in dclass._policy_fields[fp.UNRELIABLE]
+
+
+class NetworkClientListener(ClientListenerMessages, NetworkListener):
+    interface = '0.0.0.0'
+    port = 50551
+    timeout = 5.0
+    threaded_connections = True
 
     def __repr__(self):
         return "<client agent listener>"
 
 
+# Asyncio network classes. All connections of a listener are served by a single
+# event loop, running in a thread of its own, instead of by two threads per
+# connection. Messages for connections may be created on any thread; they are
+# handed over to the loop.
+
+
+class AsyncListenerConnection(BaseListenerConnection, asyncio.BufferedProtocol):
+    # How long a disconnected client gets to read its last messages
+    disconnect_timeout = 2.0  # seconds
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.loop = agent.loop
+        self.transport = None
+        self.address = None
+        self.connection_id = None
+        # dobject_id -> field_id -> values that the peer knows
+        self.field_baselines = {}
+        self.receive_buffer = ReceiveBuffer()
+        # Messages are queued until the end of the loop iteration, then
+        # handed to the transport together. While the transport's buffer is
+        # full, they stay queued, so that the queue's limits apply.
+        self.queue = agent.make_send_queue()
+        self.keep_enqueueing = True
+        self.flush_scheduled = False
+        self.paused = False
+
+    def __repr__(self):
+        return "Connection {}".format(self.connection_id)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.agent._setup_connection(self)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.warning("{} lost connection".format(self))
+        self.agent.close_connection(self.connection_id)
+
+    def get_buffer(self, sizehint):
+        return self.receive_buffer.writable()
+
+    def buffer_updated(self, nbytes):
+        self.receive_buffer.written(nbytes)
+        try:
+            self._handle_received(self.receive_buffer)
+        except InvalidFrame:
+            logger.exception("{} sent an invalid frame".format(self))
+            self.transport.close()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._schedule_flush()
+
+    def _write(self, message, field=None, droppable=False):
+        if not self.keep_enqueueing or self.transport.is_closing():
+            return
+        if not self.queue.put(message, field, droppable):
+            self.keep_enqueueing = False
+            self.agent.handle_send_queue_overflow(self)
+            return
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self.flush_scheduled and not self.paused:
+            # Runs after the callbacks that are ready already, which includes
+            # the writes that have been handed over so far.
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.paused or self.transport.is_closing():
+            return
+        batch = []
+        try:
+            while True:
+                message = self.queue.get(block=False)
+                if isinstance(message, bytes):
+                    batch.append(message)  # Already packed frame
+                else:
+                    batch.append(
+                        self.agent.pack_connection_message(self, message),
+                    )
+        except Empty:
+            pass
+        if batch:
+            self.transport.write(b''.join(batch))
+
+    def enqueue(self, *message):
+        self.loop.call_soon_threadsafe(self._write, message)
+
+    def enqueue_frame(self, frame):
+        self.loop.call_soon_threadsafe(self._write, frame)
+
+    def enqueue_field_update(self, message, dobject_id, field_id, droppable):
+        """Queue a FIELD_UPDATE, packed or not. If the queue overflows, it
+        may be dropped in favor of a later update of the same field, or, if
+        droppable, for being old."""
+        self.loop.call_soon_threadsafe(
+            self._write,
+            message,
+            (dobject_id, field_id),
+            droppable,
+        )
+
+    def disconnect(self, frame):
+        """Replace everything that is queued with a last frame, and close the
+        connection once it is written."""
+        self.loop.call_soon_threadsafe(self._disconnect, frame)
+
+    def _disconnect(self, frame):
+        self.keep_enqueueing = False
+        self.queue.clear()
+        if self.transport.is_closing():
+            return
+        self.transport.write(frame)
+        self.transport.close()
+        self.loop.call_later(self.disconnect_timeout, self.transport.abort)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
+
+
+class AsyncNetworkListener(BaseListener):
+    pass_through = False
+    # If set, UNRELIABLE field updates are sent over UDP on this port
+    udp_port = None
+
+    def __init__(self):
+        self.id_gen = IDGenerator(id_range=self.connection_ids)
+        self.dclasses_by_id = [self.dclasses[dclass_name]
+                               for dclass_name in sorted(self.dclasses)]
+        self.dclasses_by_dobject_id = {}
+        self.dclasses_lock = Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.loop_thread = None
+        self.unreliable_channel = None
+        self.connections = {}
+        self.connections_lock = Lock()
+
+    def listen(self):
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(
+                lambda: AsyncListenerConnection(self),
+                self.interface,
+                self.port,
+            ),
+        )
+        if self.udp_port is not None:
+            self.unreliable_channel = UnreliableChannel(
+                self,
+                self.interface,
+                self.udp_port,
+            )
+        logger.debug("{} starting event loop thread".format(self))
+        self.loop_thread = Thread(
+            target=self._run_loop,
+            name="Event loop thread ({})".format(self),
+        )
+        self.loop_thread.start()
+        logger.info("{} started listener".format(self))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        logger.info("{} stopped listener".format(self))
+
+    def get_port(self):
+        """The port that the listener is bound to; useful with port 0."""
+        return self.server.sockets[0].getsockname()[1]
+
+    def _setup_connection(self, connection):
+        # TODO: Check addr against a blacklist
+        connection_id = self.id_gen.get_new()
+        connection.connection_id = connection_id
+        logger.info("{} opens connection from {} (id {})"
+                    "".format(self, connection.address, connection_id))
+        with self.connections_lock:
+            self.connections[connection_id] = connection
+        if self.unreliable_channel is not None:
+            self.unreliable_channel.offer(connection)
+        self.message_director.subscribe_to_channel(connection_id, self)
+        self.handle_connection(connection_id, connection.address)
+
+    def close_connection(self, connection_id):
+        self.message_director.unsubscribe_from_channel(connection_id, self)
+        # TODO: broadcast ai/client vanishing
+        with self.connections_lock:
+            connection = self.connections.pop(connection_id)
+        if self.unreliable_channel is not None:
+            self.unreliable_channel.forget(connection)
+        logger.info("Cleaned up connection {}".format(connection_id))
+
+    def _stop(self):
+        self.server.close()
+        for connection in list(self.connections.values()):
+            connection.transport.close()
+        self.loop.stop()
+
+    def shutdown(self):
+        logger.info("{} shutting down listener".format(self))
+        self.loop.call_soon_threadsafe(self._stop)
+        self.loop_thread.join()
+        if self.unreliable_channel is not None:
+            self.unreliable_channel.shutdown()
+
+
+class AsyncNetworkAIListener(AIListenerMessages, AsyncNetworkListener):
+    interface = '127.0.0.1'
+    port = 50550
+
+    def __repr__(self):
+        return "<async AI agent listener>"
+
+
+class AsyncNetworkStateServerListener(AIListenerMessages,
+                                      AsyncNetworkListener):
+    interface = '127.0.0.1'
+    port = 50552
+
+    def __repr__(self):
+        return "<async state server agent listener>"
+
+
+class AsyncNetworkClientListener(ClientListenerMessages, AsyncNetworkListener):
+    interface = '0.0.0.0'
+    port = 50551
+
+    def __repr__(self):
+        return "<async client agent listener>"
+
+
 class NetworkConnector(BaseConnector):
+    # If set, the socket is non-blocking, and incoming messages are merely
+    # decoded into an inbound queue. They are handled by pump(), which can run
+    # as a Panda3D task, within a budget of messages and time per call.
+    queue_incoming = False
+    pump_max_messages = 100
+    pump_max_time = 0.002  # seconds
+
     def __init__(self):
         self.socket = socket.socket()
         self.dclasses_by_id = [self.dclasses[dclass_name]
                                for dclass_name in sorted(self.dclasses)]
-        self.datagram = b''
+        self.dclasses_by_dobject_id = {}
+        self.dclasses_lock = Lock()
+        self.receive_buffer = ReceiveBuffer()
+        self.selector = None
+        self.inbound = deque()
+        self.outbound = bytearray()
+        # Messages may be sent from other threads than the one that pumps,
+        # e.g. a state server's coalescing thread.
+        self.outbound_lock = Lock()
 
     def connect(self):
         self.socket.connect((self.host, self.port))
-        self.socket.settimeout(0.0001)
+        if self.queue_incoming:
+            self.socket.setblocking(False)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, selectors.EVENT_READ)
+        else:
+            self.socket.settimeout(0.0001)
+
+    def _send(self, datagram):
+        with self.outbound_lock:
+            if self.queue_incoming:
+                self.outbound += datagram
+                self._flush_outbound()
+            else:
+                self.socket.send(datagram)
+
+    def _send_all(self, datagrams):
+        """Send several datagrams, without others between them."""
+        with self.outbound_lock:
+            for datagram in datagrams:
+                self.outbound += datagram
+            self._flush_outbound()
+
+    def _flush(self):
+        """Send as much of the outbound buffer as the socket takes."""
+        with self.outbound_lock:
+            self._flush_outbound()
+
+    def _flush_outbound(self):
+        try:
+            while self.outbound:
+                num_bytes = self.socket.send(self.outbound)
+                del self.outbound[:num_bytes]
+        except BlockingIOError:
+            pass
+
+    def _read_available(self):
+        """Read what has arrived without blocking, and decode the complete
+        messages into the inbound queue."""
+        if not self.selector.select(timeout=0):
+            return
+        try:
+            while True:
+                if self.receive_buffer.recv_from(self.socket) == 0:
+                    raise ConnectionResetError
+                self._decode_received()
+        except BlockingIOError:
+            pass
+        except ConnectionResetError:
+            self.close_connection()
+
+    def _decode_received(self):
+        with self.receive_buffer.view() as datagram:
+            offset = self.receive_buffer.start
+            try:
+                while True:
+                    start, end = self.frame_bounds(datagram, offset)
+                    message = self.unpack_frame(datagram, start, end)
+                    offset = end
+                    if not self.handle_transport_message(message):
+                        self.inbound.append(self.resolve_message(message))
+            except DatagramIncomplete:
+                pass
+            self.receive_buffer.consume(offset)
+
+    def pump(self, max_messages=None, max_time=None):
+        """Exchange data with the network, then handle queued messages until
+        either max_messages have been handled, or max_time seconds have
+        passed. Returns the number of handled messages."""
+        if max_messages is None:
+            max_messages = self.pump_max_messages
+        if max_time is None:
+            max_time = self.pump_max_time
+        self._flush()
+        self._read_available()
+        deadline = time.perf_counter() + max_time
+        handled = 0
+        while self.inbound and handled < max_messages:
+            self.handle_message(*self.inbound.popleft())
+            handled += 1
+            if time.perf_counter() >= deadline:
+                break
+        return handled
+
+    def pump_task(self, task):
+        """To be run as a Panda3D task:
+        base.taskMgr.add(repository.pump_task, "Network pump")"""
+        self.pump()
+        return task.cont
 
     def _read_socket(self):
         try:
             while True:
-                incoming = self.socket.recv(1024)
-                if incoming == b'':
+                if self.receive_buffer.recv_from(self.socket) == 0:
                     raise ConnectionResetError
-                print(incoming)
-                self.datagram += incoming
-                try:
-                    while True:
-                        self.datagram = self.handle_incoming_datagram(
-                            self.datagram,
-                        )
-                except DatagramIncomplete:
-                    pass
+                with self.receive_buffer.view() as datagram:
+                    offset = self.receive_buffer.start
+                    try:
+                        while True:
+                            start, end = self.frame_bounds(datagram, offset)
+                            self.handle_incoming_frame(datagram, start, end)
+                            offset = end
+                    except DatagramIncomplete:
+                        pass
+                    self.receive_buffer.consume(offset)
         except socket.timeout:
             pass
         except ConnectionResetError:
             self.close_connection()
 
+    def handle_transport_message(self, message):
+        """Handle a message that concerns the connection itself, not the
+        repository. Returns whether the message was one of those."""
+        return False
+
+    def resolve_message(self, message):
+        """Turn a message that was received over the connection's stream, in
+        order, into the message to be handled."""
+        return message
+
     def close_connection(self):
         logger.fatal("Implement close_connection, please")
 
@@ -343,17 +1301,15 @@ class NetworkAIConnector(NetworkConnector):
     host ='127.0.0.1'
     port = 50550
 
-    def handle_incoming_datagram(self, datagram):
-        message, datagram = self.unpack_message(datagram)
+    def handle_incoming_frame(self, datagram, start, end):
+        message = self.unpack_frame(datagram, start, end)
         [from_channel, to_channel, message_type, *args] = message
         self.handle_message(
             from_channel,
             to_channel,
             message_type,
             *args,
-        ) # FIXME: This should write into a queue instead, and i.e. a Panda3D
-          # task should process what's in it.
-        return datagram
+        )  # See queue_incoming for handling it in a Panda3D task instead.
 
     def send_message(self, from_channel, to_channel, message_type, *args):
         datagram = self.pack_message(
@@ -362,33 +1318,421 @@ class NetworkAIConnector(NetworkConnector):
             message_type,
             *args,
         )
-        self.socket.send(datagram)
+        self._send(datagram)
+
+
+class NetworkStateServerConnector(NetworkAIConnector):
+    """Connects a StateServer that runs in a process of its own to the
+    StateServerAgent of a MessageDirector, and stands in as the state server's
+    MessageDirector. serve_forever() runs it until the connection is lost."""
+    queue_incoming = True
+    timeout = 0.1
+
+    def __init__(self, state_server, host='127.0.0.1', port=50552):
+        self.host = host
+        self.port = port
+        super().__init__()
+        self.state_server = state_server
+        self.state_server.message_director = self
+        self.keep_running = True
+
+    def create_message(self, from_channel, to_channel, message_type, *args):
+        self.send_message(from_channel, to_channel, message_type, *args)
+
+    def create_multicast_message(self, from_channel, to_channels, message_type,
+                                 *args):
+        self._send_all(self.pack_multicast_message(
+            from_channel,
+            to_channels,
+            message_type,
+            *args,
+        ))
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        if message_type == msgtypes.STATE_SERVER_CHANNEL_ASSIGNED:
+            channel = args[0]
+            logger.info("State server was assigned channel {}".format(channel))
+            self.state_server.set_channel(channel)
+        else:
+            self.state_server.handle_message(
+                from_channel,
+                to_channel,
+                message_type,
+                *args,
+            )
+
+    def serve_forever(self):
+        while self.keep_running:
+            self.selector.select(timeout=self.timeout)
+            while self.pump():
+                pass
+
+    def close_connection(self):
+        logger.info("State server lost its connection")
+        self.keep_running = False
 
 
 class NetworkClientConnector(NetworkConnector):
+    # How often to claim the unreliable channel until the agent answers
+    unreliable_claim_interval = 0.5  # seconds
+
     def __init__(self, host='127.0.0.1', port=50551):
         self.host = host
         self.port = port
         super().__init__()
+        self.udp_socket = None
+        self.udp_token = None
+        self.udp_confirmed = False
+        self.udp_last_claim = 0.0
+        # (dobject_id, field_id) -> sequence number of the latest update
+        self.udp_sequences = {}
+        # dobject_id -> field_id -> values last received over the stream
+        self.field_baselines = {}
+
+    def handle_transport_message(self, message):
+        if message[0] == msgtypes.UNRELIABLE_CHANNEL:
+            _message_type, token, port = message
+            self._open_unreliable_channel(token, port)
+            return True
+        return False
+
+    def resolve_message(self, message):
+        message_type = message[0]
+        if message_type == msgtypes.FIELD_UPDATE:
+            _message_type, dobject_id, field_id, values = message
+            baselines = self.field_baselines.setdefault(dobject_id, {})
+            baselines[field_id] = values
+        elif message_type == msgtypes.FIELD_DELTA:
+            _message_type, dobject_id, field_id, mask, changed = message
+            baselines = self.field_baselines[dobject_id]
+            values = self.apply_field_delta(baselines[field_id], mask, changed)
+            baselines[field_id] = values
+            message = [msgtypes.FIELD_UPDATE, dobject_id, field_id, values]
+        elif message_type == msgtypes.DESTROY_DOBJECT_VIEW:
+            dobject_id = message[1]
+            self.field_baselines.pop(dobject_id, None)
+            # Updates of the dobject that arrive late over the unreliable
+            # channel can't be decoded now, and get dropped.
+            with self.dclasses_lock:
+                self.dclasses_by_dobject_id.pop(dobject_id, None)
+        return message
+
+    def _open_unreliable_channel(self, token, port):
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setblocking(False)
+        self.udp_socket.connect((self.host, port))
+        self.udp_token = token
+        if self.selector is not None:
+            self.selector.register(self.udp_socket, selectors.EVENT_READ)
+        self._claim_unreliable_channel()
+
+    def _claim_unreliable_channel(self):
+        self.udp_last_claim = time.perf_counter()
+        self.udp_socket.send(self.pack_message(
+            msgtypes.UNRELIABLE_CHANNEL,
+            self.udp_token,
+            0,
+        ))
+
+    def _read_unreliable(self):
+        if self.udp_socket is None:
+            return
+        if not self.udp_confirmed and \
+           time.perf_counter() - self.udp_last_claim > \
+           self.unreliable_claim_interval:
+            self._claim_unreliable_channel()
+        try:
+            while True:
+                self._handle_unreliable_datagram(self.udp_socket.recv(65536))
+        except (BlockingIOError, ConnectionRefusedError):
+            pass
+
+    def _handle_unreliable_datagram(self, datagram):
+        """Pass on the updates in the datagram, unless newer ones of the same
+        fields have arrived already."""
+        try:
+            (sequence, ), offset = sequence_header_codec.unpack_from(datagram)
+        except DatagramIncomplete:
+            return
+        self.udp_confirmed = True
+        while offset < len(datagram):
+            try:
+                start, end = self.frame_bounds(datagram, offset)
+                message = self.unpack_frame(datagram, start, end)
+            except DatagramIncomplete:
+                return  # Truncated
+            except KeyError:
+                # For a dobject whose view is not known (anymore)
+                offset = end
+                continue
+            offset = end
+            _message_type, dobject_id, field_id, _values = message
+            key = (dobject_id, field_id)
+            latest = self.udp_sequences.get(key)
+            if latest is None or sequence_newer(sequence, latest):
+                self.udp_sequences[key] = sequence
+                if self.queue_incoming:
+                    self.inbound.append(message)
+                else:
+                    self.handle_message(*message)
+
+    def _read_available(self):
+        super()._read_available()
+        self._read_unreliable()
 
-    def handle_incoming_datagram(self, datagram):
-        logger.info("Handling incoming datagram")
-        message, datagram = self.unpack_message(datagram)
-        [message_type, *args] = message
+    def _read_socket(self):
+        super()._read_socket()
+        self._read_unreliable()
+
+    def handle_incoming_frame(self, datagram, start, end):
+        logger.info("Handling incoming frame")
+        message = self.unpack_frame(datagram, start, end)
+        if self.handle_transport_message(message):
+            return
+        [message_type, *args] = self.resolve_message(message)
         self.handle_message(
             message_type,
             *args,
-        ) # FIXME: This should write into a queue instead, and i.e. a Panda3D
-          # task should process what's in it.
-        logger.info("Handled incoming datagram")
-        return datagram
+        )  # See queue_incoming for handling it in a Panda3D task instead.
+        logger.info("Handled incoming frame")
 
     def send_message(self, message_type, *args):
         datagram = self.pack_message(
             message_type,
             *args,
         )
-        self.socket.send(datagram)
+        self._send(datagram)
+
+
+class MessageDirectorLink:
+    """The connection to one peer MessageDirector, as seen from the local
+    one. It is subscribed to all channels that the peer has advertised local
+    subscribers on, forwards the messages for them, and routes the messages
+    that the peer sends to the local listeners."""
+    # Frames are forwarded both ways without being repacked.
+    pass_through = True
+    is_peer_link = True
+
+    def __init__(self, backbone, sock, address):
+        self.backbone = backbone
+        self.message_director = backbone.message_director
+        self.address = address
+        self.subscriptions = set()
+        self.subscriptions_lock = Lock()
+        # The connection starts reading right away, so advertisements may be
+        # handled before the link is added as a peer below, or even before
+        # self.connection is set.
+        self.connection_set = Event()
+        self.connection = NetworkListenerConnection(
+            self,
+            sock,
+            address,
+            "peer {}".format(address),
+        )
+        self.connection_set.set()
+        self.message_director.add_peer(self)
+
+    def __repr__(self):
+        return "<MessageDirector link to {}>".format(self.address)
+
+    # Packing is left to the backbone, so that all links share what they have
+    # learned about dobjects' dclasses.
+
+    def frame_bounds(self, datagram, offset):
+        return self.backbone.frame_bounds(datagram, offset)
+
+    def unpack_frame(self, datagram, start, end):
+        return self.backbone.unpack_frame(datagram, start, end)
+
+    def peek_channels(self, datagram, start):
+        return self.backbone.peek_channels(datagram, start)
+
+    def pack_message(self, from_channel, to_channel, message_type, *args):
+        return self.backbone.pack_message(
+            from_channel,
+            to_channel,
+            message_type,
+            *args,
+        )
+
+    def pack_connection_message(self, connection, message):
+        return self.pack_message(*message)
+
+    # Towards the peer
+
+    def advertise_subscription(self, channel):
+        self.connection.enqueue(
+            self.message_director.channel,
+            channels.ALL_MESSAGE_DIRECTORS,
+            msgtypes.MD_SUBSCRIBE,
+            channel,
+        )
+
+    def advertise_unsubscription(self, channel):
+        self.connection.enqueue(
+            self.message_director.channel,
+            channels.ALL_MESSAGE_DIRECTORS,
+            msgtypes.MD_UNSUBSCRIBE,
+            channel,
+        )
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        self.connection.enqueue(from_channel, to_channel, message_type, *args)
+
+    def handle_multicast_message(self, from_channel, to_channels, message_type,
+                                 *args):
+        for frame in self.backbone.pack_multicast_message(
+                from_channel,
+                to_channels,
+                message_type,
+                *args):
+            self.connection.enqueue_frame(frame)
+
+    def handle_frame(self, from_channel, to_channel, frame):
+        self.connection.enqueue_frame(frame)
+
+    # From the peer
+
+    def handle_incoming_frame(self, frame):
+        start, end = self.frame_bounds(frame, 0)
+        from_channel, to_channel = self.peek_channels(frame, start)
+        if to_channel == channels.ALL_MESSAGE_DIRECTORS:
+            _from, _to, message_type, channel = self.unpack_frame(
+                frame,
+                start,
+                end,
+            )
+            self.handle_advertisement(message_type, channel)
+        else:
+            self.message_director.route_frame(
+                from_channel,
+                to_channel,
+                frame,
+                partial(self.unpack_frame, frame, start, end),
+                local=True,
+            )
+
+    def handle_advertisement(self, message_type, channel):
+        logger.debug("{} got {} for {}".format(self, message_type, channel))
+        with self.subscriptions_lock:
+            if message_type == msgtypes.MD_SUBSCRIBE:
+                if channel not in self.subscriptions:
+                    try:
+                        self.message_director.subscribe_to_channel(
+                            channel,
+                            self,
+                        )
+                    except ValueError as e:
+                        # E.g. both MessageDirectors run a state server on
+                        # the same channel, and would hand out the same IDs.
+                        logger.error("Refusing {}: {}".format(self, e))
+                        self._shutdown_connection()
+                        return
+                    self.subscriptions.add(channel)
+            elif message_type == msgtypes.MD_UNSUBSCRIBE:
+                if channel in self.subscriptions:
+                    self.subscriptions.remove(channel)
+                    self.message_director.unsubscribe_from_channel(
+                        channel,
+                        self,
+                    )
+            else:
+                raise NotImplementedError
+
+    def close_connection(self, connection_id):
+        logger.info("{} was closed".format(self))
+        self.message_director.remove_peer(self)
+        self.backbone.remove_link(self)
+        self._shutdown_connection()
+
+    def _shutdown_connection(self):
+        self.connection_set.wait()
+        try:
+            self.connection.shutdown()
+        except OSError:
+            pass  # Already disconnected
+
+    def shutdown(self):
+        self._shutdown_connection()
+        self.connection.join()
+
+
+class NetworkMessageDirectorBackbone:
+    """Links a MessageDirector to its peers in other processes or on other
+    hosts, over TCP. Any of them can listen for and make connections to the
+    others; once connected, both ends are equal. Messages are forwarded only
+    to peers that have advertised a subscriber on the message's channel."""
+    interface = '127.0.0.1'
+    port = 50553
+    timeout = 0.2
+
+    def __init__(self, message_director):
+        self.message_director = message_director
+        self.dclasses_by_id = [self.dclasses[dclass_name]
+                               for dclass_name in sorted(self.dclasses)]
+        self.dclasses_by_dobject_id = {}
+        self.dclasses_lock = Lock()
+        self.links = []
+        self.links_lock = Lock()
+        self.socket = None
+        self.listener_thread = None
+        self.keep_running = True
+
+    def __repr__(self):
+        return "<MessageDirector backbone>"
+
+    def listen(self):
+        """Accept connections from peers."""
+        self.socket = socket.socket()
+        self.socket.bind((self.interface, self.port))
+        self.socket.listen()
+        self.socket.settimeout(self.timeout)
+        self.listener_thread = Thread(
+            target=self._await_connection,
+            name="Listener thread ({})".format(self),
+        )
+        self.listener_thread.start()
+        logger.info("{} started listener".format(self))
+
+    def get_port(self):
+        """The port that the backbone listens on; useful with port 0."""
+        return self.socket.getsockname()[1]
+
+    def _await_connection(self):
+        while self.keep_running:
+            try:
+                sock, addr = self.socket.accept()
+                logger.info("Connection from peer {}".format(addr))
+                self._add_link(sock, addr)
+            except socket.timeout:
+                pass
+        logger.info("{} stopped listener".format(self))
+
+    def connect(self, host, port):
+        """Connect to a peer's backbone."""
+        sock = socket.create_connection((host, port))
+        self._add_link(sock, (host, port))
+
+    def _add_link(self, sock, address):
+        link = MessageDirectorLink(self, sock, address)
+        with self.links_lock:
+            self.links.append(link)
+
+    def remove_link(self, link):
+        with self.links_lock:
+            if link in self.links:
+                self.links.remove(link)
+
+    def shutdown(self):
+        self.keep_running = False
+        if self.listener_thread is not None:
+            self.listener_thread.join()
+            self.socket.close()
+        with self.links_lock:
+            links = list(self.links)
+        for link in links:
+            link.shutdown()
+        logger.info("{} shut down".format(self))
 
 
 # "Internal" "network" means that everything is running in the same process, and
@@ -1,12 +1,20 @@
-from threading import Lock
+from threading import Lock, Thread, Event
 from queue import Queue, Empty
+from contextlib import contextmanager
 import logging
+import gc
 
 from pandamonium.base import BaseComponent
 from pandamonium.constants import channels, msgtypes
 from pandamonium.constants import field_policies as fp
 from pandamonium.dobject import Recipient, Zone
-from pandamonium.util import IDGenerator, AssociativeTable, BijectiveMap
+from pandamonium.util import (
+    IDGenerator,
+    AssociativeTable,
+    BijectiveMap,
+    message_director_state_server_channel,
+    state_server_dobject_ids,
+)
 
 
 logger = logging.getLogger(__name__)
@@ -25,9 +33,20 @@ class BaseStateKeeper:
 
 
 class SimpleStateKeeper(BaseStateKeeper):
-    def __init__(self, dclasses):
+    # Number of locks that the dobjects are partitioned over. While the GIL
+    # makes threads take turns anyway, more shards buy little throughput, and
+    # none at all with few workers (see benchmarks/state_keeper_sharding.py),
+    # so there is only one by default; raise it on free-threaded builds.
+    shard_count = 1
+    # If set, updates of UNRELIABLE fields are not emitted right away, but
+    # collected per (dobject, field) and flushed every this many seconds, so
+    # that recipients get only the latest value set during each tick.
+    coalesce_interval = None
+
+    def __init__(self, dclasses, persistence=None, journal=None):
+        self.dclass_names = sorted(dclasses)
         self.dclasses = [dclasses[dclass_name]
-                         for dclass_name in sorted(dclasses)]
+                         for dclass_name in self.dclass_names]
         for dclass_id, dclass in enumerate(self.dclasses):
             dclass.dclass_id = dclass_id
         self.state = AssociativeTable('recipients', 'zones', 'dobjects')
@@ -35,53 +54,228 @@ class SimpleStateKeeper(BaseStateKeeper):
         self.recipients = AssociativeTable('r_id', 'r_object')
         self.zones = AssociativeTable('z_id', 'z_object')
         self.dobjects = BijectiveMap()
-        # TODO: For the moment, we'll use a single lock to protect the whole of
-        # the state; dobject existence, presence in zones, and interest. This is
-        # a topic ripe for optimization, if you can do it without creating
-        # deadlocks. Maybe do optimistic concurrency? Have a nifty planner
-        # that'll schedule event processing into isolated parallelity?
+        # recipient -> dobject -> number of zones that they share
+        self.visibility = {}
+        # dobject -> IDs of the recipients that see it
+        self.viewers = {}
+        # Locking is split in two levels, so that field updates don't wait on
+        # each other, or on interest and presence changes elsewhere.
+        # * The state lock protects the structure of the state; existence of
+        #   recipients, zones and dobjects, presence, interest, and the
+        #   visibility index. Those changes reach across zones anyway, so they
+        #   are serialized.
+        # * The dobjects are partitioned into shards by their ID, each with its
+        #   own lock. A shard lock protects its dobjects' fields, owner and AI,
+        #   and their viewer sets. Field updates take only the lock of their
+        #   dobject's shard.
+        # Locks are always acquired in this order: The state lock first (if at
+        # all), then shard locks in ascending shard order, as done by
+        # _locked_shards(). No lock is ever taken while holding a shard lock
+        # of a higher order. The coalescing lock, and the persistence's and
+        # journal's locks are taken last, and nothing is acquired while holding
+        # them.
+        # Shards are keyed by dobject rather than by zone, since a dobject can
+        # be present in several zones, and a field update would then have to
+        # lock all of them.
         self.state_lock = Lock()
+        self.shard_locks = [Lock() for _ in range(self.shard_count)]
         self.emission_queue = Queue()
+        # (dobject_id, field_id) -> (source, value) of the latest update
+        self.coalesced_updates = {}
+        self.coalescing_lock = Lock()
+        self.coalescing_stopped = Event()
+        self.coalescing_thread = None
+        # PERSIST fields are handed to this, usually a WriteBehind, which
+        # stores them without making set_field wait on it.
+        self.persistence = persistence
+        # Every mutation of the state is written to this StateJournal, if set.
+        self.journal = None
+        # Set while the state is being restored, so that nothing gets emitted.
+        self.restoring = False
+        if self.coalesce_interval is not None:
+            self.coalescing_thread = Thread(
+                target=self._coalesce_updates,
+                name="Field update coalescing thread",
+            )
+            self.coalescing_thread.start()
+        if journal is not None:
+            self.restore_from_journal(journal)
+
+    def shutdown(self):
+        self.coalescing_stopped.set()
+        if self.coalescing_thread is not None:
+            self.coalescing_thread.join()
+        if self.persistence is not None:
+            self.persistence.shutdown()
+        if self.journal is not None:
+            self.journal.shutdown()
+
+    def restore_from_journal(self, journal):
+        """Replay the journal's snapshot and records, and continue journaling
+        into it."""
+        # Restoring allocates millions of objects and none of them are
+        # garbage, so the cyclic collector would only rescan them over and
+        # over.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        self.restoring = True
+        try:
+            journal.load(self)
+            self.rebuild_visibility()
+        finally:
+            self.restoring = False
+            if gc_was_enabled:
+                gc.enable()
+        self.journal = journal
+        journal.start(self.snapshot_journal)
+
+    # Restoring writes the replayed state straight into the dobjects and the
+    # zone table, without taking locks, emitting messages, persisting fields,
+    # or updating the visibility index; it is done before the state keeper is
+    # used, and rebuild_visibility() is called once at the end.
+
+    def restore_dobject(self, dobject_id, dclass_id, packed_storage):
+        dobject = self.dclasses[dclass_id](dobject_id, None)
+        dobject.set_packed_storage(packed_storage)
+        self.dobjects[dobject_id] = dobject
+        self.state.dobjects.add(dobject)
+        self.viewers[dobject] = set()
+
+    def restore_fields(self, dobject_id, fields):
+        """Set the values of several stored fields, by field ID."""
+        dobject = self.dobjects[dobject_id]
+        storage_index = dobject._storage_index
+        storage = dobject.storage
+        for field_id, values in fields.items():
+            storage[storage_index[field_id]] = values
+        dobject.storage = storage
+
+    def restore_presence(self, dobject_id, zone_id, present):
+        if zone_id not in self.zones:
+            self.create_zone(zone_id)
+        (zone, ) = self.zones[zone_id]
+        dobject = self.dobjects[dobject_id]
+        if present:
+            self.state._assoc(dobject, zone)
+        else:
+            self.state._dissoc(dobject, zone)
+
+    def restore_interest(self, recipient_id, zone_id, interested):
+        if recipient_id not in self.recipients:
+            self.create_recipient(recipient_id)
+        if zone_id not in self.zones:
+            self.create_zone(zone_id)
+        (recipient, ) = self.recipients[recipient_id]
+        (zone, ) = self.zones[zone_id]
+        if interested:
+            self.state._assoc(recipient, zone)
+        else:
+            self.state._dissoc(recipient, zone)
+
+    def rebuild_visibility(self):
+        """Recount the visibility index and viewer sets from the zones."""
+        for recipient in self.visibility:
+            self.visibility[recipient] = {}
+        for dobject in self.viewers:
+            self.viewers[dobject] = set()
+        for zone in self.state.zones.elements:
+            recipients = self._zone_recipients(zone)
+            if not recipients:
+                continue
+            for dobject in self._zone_dobjects(zone):
+                for recipient in recipients:
+                    self._add_visibility(recipient, dobject)
+
+    def snapshot_journal(self):
+        """Write a snapshot of the whole state, which replaces the journal up
+        to now. The state is only captured while everything is locked; it is
+        encoded and written afterwards."""
+        with self.state_lock, self._locked_shards(range(self.shard_count)):
+            dobjects = [(dobject_id, dobject.dclass_id,
+                         dobject.get_packed_storage(), dobject.owner,
+                         dobject.ai)
+                        for dobject_id, dobject
+                        in self.dobjects.forward_map.items()]
+            presence = [(dobject.dobject_id, zone.zone_id)
+                        for zone in self.state.zones.elements
+                        for dobject in self._zone_dobjects(zone)]
+            interest = [(recipient.recipient_id, zone.zone_id)
+                        for zone in self.state.zones.elements
+                        for recipient in self._zone_recipients(zone)]
+            generation = self.journal.rotate()
+        self.journal.write_snapshot(generation, dobjects, presence, interest)
+
+    def _shard_lock(self, dobject_id):
+        return self.shard_locks[dobject_id % self.shard_count]
+
+    @contextmanager
+    def _locked_shards(self, dobject_ids):
+        """Hold the locks of the shards of the given dobjects, acquiring them
+        in lock order."""
+        shards = sorted({dobject_id % self.shard_count
+                         for dobject_id in dobject_ids})
+        for shard in shards:
+            self.shard_locks[shard].acquire()
+        try:
+            yield
+        finally:
+            for shard in reversed(shards):
+                self.shard_locks[shard].release()
 
     def get_dobject_fields(self, dobject_id):
-        with self.state_lock:
-            dobject = self.dobjects[dobject_id].dfields
-        return dobject
+        with self._shard_lock(dobject_id):
+            return self.dobjects[dobject_id].storage
 
     def _queue_message(self, *message):
         # FIXME: Make sure that all data is copies.
-        self.emission_queue.put(message)
+        if self.restoring:
+            return
+        self.emission_queue.put((False, message))
+
+    def _queue_multicast_message(self, from_channel, to_channels, *message):
+        """Queue one message for several recipients, so that it gets encoded
+        only once."""
+        if self.restoring:
+            return
+        self.emission_queue.put(
+            (True, (from_channel, list(to_channels)) + message),
+        )
 
     def _work_emission_queue(self):
         working = True
         while working:
             try:
-                message = self.emission_queue.get(block=False)
-                self.message_director.create_message(*message)
+                multicast, message = self.emission_queue.get(block=False)
+                if multicast:
+                    self.message_director.create_multicast_message(*message)
+                else:
+                    self.message_director.create_message(*message)
             except Empty:
                 working = False
 
     def emit_create_dobject_view(self, recipients, dobject_maps):
-        for recipient in recipients:
-            for dobject_id, dobject in dobject_maps:
-                self._queue_message(
-                    self.individual_channel,
-                    recipient,
-                    msgtypes.CREATE_DOBJECT_VIEW,
-                    dobject_id,
-                    dobject.dclass_id,
-                    dobject.storage,
-                )
+        if not recipients:
+            return
+        for dobject_id, dobject in dobject_maps:
+            self._queue_multicast_message(
+                self.individual_channel,
+                recipients,
+                msgtypes.CREATE_DOBJECT_VIEW,
+                dobject_id,
+                dobject.dclass_id,
+                dobject.stored_fields(),
+            )
 
     def emit_destroy_dobject_view(self, recipients, dobject_ids):
-        for recipient in recipients:
-            for dobject_id in dobject_ids:
-                self._queue_message(
-                    self.individual_channel,
-                    recipient,
-                    msgtypes.DESTROY_DOBJECT_VIEW,
-                    dobject_id,
-                )
+        if not recipients:
+            return
+        for dobject_id in dobject_ids:
+            self._queue_multicast_message(
+                self.individual_channel,
+                recipients,
+                msgtypes.DESTROY_DOBJECT_VIEW,
+                dobject_id,
+            )
 
     def create_recipient(self, recipient_id):
         with self.state_lock:
@@ -90,16 +284,63 @@ class SimpleStateKeeper(BaseStateKeeper):
             self.recipients.r_object.add(recipient)
             self.recipients._assoc(recipient_id, recipient)
             self.state.recipients.add(recipient)
+            self.visibility[recipient] = {}
 
     def create_dobject(self, dobject_id, dclass_id, fields):
-        with self.state_lock:
+        with self.state_lock, self._shard_lock(dobject_id):
+            dobject = self._add_dobject(dobject_id, dclass_id, fields)
+            if self.journal is not None:
+                self.journal.create_dobject(dobject)
+            if self.persistence is not None:
+                persisted = {
+                    dobject._field_names[field_id]: dobject.get_stored_field(
+                        field_id,
+                    )
+                    for field_id in dobject._storage_ids
+                    if field_id in dobject._policy_fields[fp.PERSIST]
+                }
+                if persisted:
+                    self.persistence.create_dobject(
+                        dobject_id,
+                        self.dclass_names[dclass_id],
+                        persisted,
+                    )
+
+    def _add_dobject(self, dobject_id, dclass_id, fields):
+        dclass = self.dclasses[dclass_id]
+        dobject = dclass(
+            dobject_id,
+            fields,
+        )
+        self.dobjects[dobject_id] = dobject
+        self.state.dobjects.add(dobject)
+        self.viewers[dobject] = set()
+        return dobject
+
+    def load_persisted_dobjects(self):
+        """Recreate the dobjects stored by the persistence. Their fields
+        that weren't persisted get default values. Returns the IDs of the
+        loaded dobjects."""
+        dobject_ids = []
+        for dobject_id, dclass_name, persisted in self.persistence.load():
+            if dclass_name not in self.dclass_names:
+                logger.warning("Can't load dobject {} of unknown dclass {}"
+                               "".format(dobject_id, dclass_name))
+                continue
+            dclass_id = self.dclass_names.index(dclass_name)
             dclass = self.dclasses[dclass_id]
-            dobject = dclass(
-                dobject_id,
-                fields,
-            )
-            self.dobjects[dobject_id] = dobject
-            self.state.dobjects.add(dobject)
+            fields = list(dclass._storage_defaults)
+            for index, field_id in enumerate(dclass._storage_ids):
+                field_name = dclass._field_names[field_id]
+                if field_name in persisted:
+                    fields[index] = persisted[field_name]
+            with self.state_lock, self._shard_lock(dobject_id):
+                dobject = self._add_dobject(dobject_id, dclass_id, fields)
+                if self.journal is not None:
+                    self.journal.create_dobject(dobject)
+            dobject_ids.append(dobject_id)
+        logger.info("Loaded {} persisted dobjects".format(len(dobject_ids)))
+        return dobject_ids
 
     def create_zone(self, zone_id):
         with self.state_lock:
@@ -110,16 +351,47 @@ class SimpleStateKeeper(BaseStateKeeper):
             self.state.zones.add(zone)
 
     def _dobjects_seen(self, recipient):
-        return self.state.get(
-            recipient,
-            path=(self.state.zones, self.state.dobjects),
-        )
+        return set(self.visibility[recipient])
 
     def _dobject_seen_by(self, dobject):
-        return self.state.get(
-            dobject,
-            path=(self.state.zones, self.state.recipients),
-        )
+        return self.viewers[dobject]
+
+    def _zone_dobjects(self, zone):
+        return self.state.get(zone, tables=(self.state.dobjects, ))
+
+    def _zone_recipients(self, zone):
+        return self.state.get(zone, tables=(self.state.recipients, ))
+
+    # The visibility index counts, for each recipient and each dobject that it
+    # sees, the zones that the recipient has interest in and the dobject is
+    # present in. It is updated along with each association of a recipient or
+    # dobject with a zone, so that a change of interest or presence costs only
+    # as much as the zone has dobjects or recipients. The viewer sets are the
+    # same relation seen from the dobjects' side, and change only when a count
+    # goes from zero to one or back, so that field updates can be fanned out
+    # without looking at zones at all.
+
+    def _add_visibility(self, recipient, dobject):
+        """Count a shared zone. Returns whether the dobject became visible."""
+        seen = self.visibility[recipient]
+        count = seen.get(dobject, 0)
+        seen[dobject] = count + 1
+        if count == 0:
+            self.viewers[dobject].add(recipient.recipient_id)
+            return True
+        return False
+
+    def _remove_visibility(self, recipient, dobject):
+        """Uncount a shared zone. Returns whether the dobject became
+        invisible."""
+        seen = self.visibility[recipient]
+        count = seen[dobject] - 1
+        if count:
+            seen[dobject] = count
+            return False
+        del seen[dobject]
+        self.viewers[dobject].discard(recipient.recipient_id)
+        return True
 
     def _dobject_to_emittable(self, dobject):
         dobject_id = self.dobjects.getreverse(dobject)
@@ -137,10 +409,17 @@ class SimpleStateKeeper(BaseStateKeeper):
         with self.state_lock:
             (recipient, ) = self.recipients[recipient_id]
             (zone, ) = self.zones[zone_id]
-            dobjects_before = self._dobjects_seen(recipient)
+            if zone in self.state[recipient]:
+                return []
             self.state._assoc(recipient, zone)
-            dobjects_after = self._dobjects_seen(recipient)
-            new_dobjects = dobjects_after - dobjects_before
+            if self.journal is not None:
+                self.journal.set_interest(recipient_id, zone_id)
+            zone_dobjects = self._zone_dobjects(zone)
+            with self._locked_shards(dobject.dobject_id
+                                     for dobject in zone_dobjects):
+                new_dobjects = [dobject
+                                for dobject in zone_dobjects
+                                if self._add_visibility(recipient, dobject)]
             emittables = [self._dobject_to_emittable(dobject)
                           for dobject in new_dobjects]
             self.emit_create_dobject_view([recipient_id], emittables)
@@ -151,48 +430,61 @@ class SimpleStateKeeper(BaseStateKeeper):
         with self.state_lock:
             (recipient, ) = self.recipients[recipient_id]
             (zone, ) = self.zones[zone_id]
-            dobjects_before = self._dobjects_seen(recipient)
             self.state._dissoc(recipient, zone)
-            dobjects_after = self._dobjects_seen(recipient)
-            lost_dobjects = dobjects_before - dobjects_after
-            self.emit_destroy_dobject_view([recipient_id], lost_dobjects)
+            if self.journal is not None:
+                self.journal.unset_interest(recipient_id, zone_id)
+            zone_dobjects = self._zone_dobjects(zone)
+            with self._locked_shards(dobject.dobject_id
+                                     for dobject in zone_dobjects):
+                lost_dobject_ids = [
+                    dobject.dobject_id
+                    for dobject in zone_dobjects
+                    if self._remove_visibility(recipient, dobject)
+                ]
+            self.emit_destroy_dobject_view([recipient_id], lost_dobject_ids)
         self._work_emission_queue()
         return lost_dobject_ids
 
     def add_presence(self, dobject_id, zone_id):
         if zone_id not in self.zones:
             self.create_zone(zone_id)
-        with self.state_lock:
+        with self.state_lock, self._shard_lock(dobject_id):
             dobject = self.dobjects[dobject_id]
             (zone, ) = self.zones[zone_id]
-            recipients_before = self._dobject_seen_by(dobject)
+            if zone in self.state[dobject]:
+                return set()
             self.state._assoc(dobject, zone)
-            recipients_after = self._dobject_seen_by(dobject)
-            new_recipients = recipients_after - recipients_before
-            new_recipient_ids = {next(iter(self.recipients[nr]))
-                                 for nr in new_recipients}
+            if self.journal is not None:
+                self.journal.add_presence(dobject_id, zone_id)
+            new_recipient_ids = {recipient.recipient_id
+                                 for recipient in self._zone_recipients(zone)
+                                 if self._add_visibility(recipient, dobject)}
             emittable = [self._dobject_id_to_emittable(dobject_id)]
             self.emit_create_dobject_view(new_recipient_ids, emittable)
         self._work_emission_queue()
         return new_recipient_ids
 
     def remove_presence(self, dobject_id, zone_id):
-        with self.state_lock:
+        with self.state_lock, self._shard_lock(dobject_id):
             dobject = self.dobjects[dobject_id]
             (zone, ) = self.zones[zone_id]
-            recipients_before = self._dobject_seen_by(dobject)
             self.state._dissoc(dobject, zone)
-            recipients_after = self._dobject_seen_by(dobject)
-            lost_recipients = recipients_before - recipients_after
-            lost_recipient_ids = {next(iter(self.recipients[nr]))
-                                  for nr in lost_recipients}
+            if self.journal is not None:
+                self.journal.remove_presence(dobject_id, zone_id)
+            lost_recipient_ids = {
+                recipient.recipient_id
+                for recipient in self._zone_recipients(zone)
+                if self._remove_visibility(recipient, dobject)
+            }
             self.emit_destroy_dobject_view(lost_recipient_ids, [dobject_id])
         self._work_emission_queue()
         return lost_recipient_ids
 
     def set_ai(self, ai_channel, dobject_id):
-        with self.state_lock:
+        with self._shard_lock(dobject_id):
             self.dobjects[dobject_id].set_ai(ai_channel)
+            if self.journal is not None:
+                self.journal.set_ai(ai_channel, dobject_id)
         # self.message_director.create_message(
         #     self.all_connections,  # FIXME: This individual StateServer's ID
         #     ai_channel,
@@ -204,12 +496,14 @@ class SimpleStateKeeper(BaseStateKeeper):
         # )
 
     def set_owner(self, owner_channel, dobject_id):
-        with self.state_lock:
+        with self._shard_lock(dobject_id):
             # TODO: Destroy owner view if another owner was set.
             # TODO: Check whether dobject is even visible to client
             self.dobjects[dobject_id].set_owner(owner_channel)
+            if self.journal is not None:
+                self.journal.set_owner(owner_channel, dobject_id)
             self._queue_message(
-                self.all_connections,  # FIXME: This individual StateServer's ID
+                self.individual_channel,
                 owner_channel,
                 msgtypes.BECOME_OWNER,
                 dobject_id,
@@ -218,65 +512,123 @@ class SimpleStateKeeper(BaseStateKeeper):
 
 
     def set_field(self, source, dobject_id, field_id, value):
-        with self.state_lock:
+        with self._shard_lock(dobject_id):
             dobject = self.dobjects[dobject_id]
-            # FIXME: Jam this into DClass somehow?
-            _, field_type, policy = dobject._dfields[field_id]
+            policy = dobject._field_policies[field_id]
             # Is the source even allowed to set this field?
             if (policy & fp.CLIENT_SEND) or \
                ((policy & fp.OWNER_SEND) and source == dobject.owner) or \
                ((policy & fp.AI_SEND) and source == dobject.ai):
                 # If it's a storage field, set its value
                 if policy & (fp.RAM | fp.PERSIST):
-                    pass  # FIXME
-                # Emit
-                if policy & fp.CLIENT_RECEIVE:
-                    for recipient in self._dobject_seen_by(dobject):
-                        self._queue_message(
-                            source,
-                            recipient,
-                            msgtypes.FIELD_UPDATE,
-                            dobject_id,
-                            field_id,
-                            value
-                        )
-                elif policy & fp.OWNER_RECEIVE:
-                    self._queue_message(
-                        source,
-                        dobject.owner,
-                        msgtypes.FIELD_UPDATE,
+                    dobject.set_stored_field(field_id, value)
+                    if self.journal is not None:
+                        self.journal.set_field(dobject, field_id, value)
+                if (policy & fp.PERSIST) and self.persistence is not None:
+                    self.persistence.set_field(
                         dobject_id,
-                        field_id,
-                        value
-                    )
-                elif policy & fp.AI_RECEIVE:
-                    self._queue_message(
-                        source,
-                        dobject.ai,
-                        msgtypes.FIELD_UPDATE,
-                        dobject_id,
-                        field_id,
-                        value
+                        dobject._field_names[field_id],
+                        value,
                     )
-                # NOTE: else? I mean, there MUST be a sending policy?
+                if (policy & fp.UNRELIABLE) and \
+                   self.coalesce_interval is not None:
+                    with self.coalescing_lock:
+                        self.coalesced_updates[(dobject_id, field_id)] = \
+                            (source, value)
+                else:
+                    self._emit_field_update(source, dobject, field_id, policy,
+                                            value)
             else:
                 raise Exception("{} tried to set {} field {} to {}. "
                                 "".format(source, dobject, field_id, value))
         self._work_emission_queue()
 
+    def _emit_field_update(self, source, dobject, field_id, policy, value):
+        """Queue a FIELD_UPDATE for the dobject's recipients. The lock of the
+        dobject's shard must be held."""
+        if policy & fp.CLIENT_RECEIVE:
+            self._queue_multicast_message(
+                source,
+                self._dobject_seen_by(dobject),
+                msgtypes.FIELD_UPDATE,
+                dobject.dobject_id,
+                field_id,
+                value
+            )
+        elif policy & fp.OWNER_RECEIVE:
+            self._queue_message(
+                source,
+                dobject.owner,
+                msgtypes.FIELD_UPDATE,
+                dobject.dobject_id,
+                field_id,
+                value
+            )
+        elif policy & fp.AI_RECEIVE:
+            self._queue_message(
+                source,
+                dobject.ai,
+                msgtypes.FIELD_UPDATE,
+                dobject.dobject_id,
+                field_id,
+                value
+            )
+        # NOTE: else? I mean, there MUST be a sending policy?
+
+    def flush_coalesced_updates(self):
+        """Emit the latest value of each coalesced field update."""
+        with self.coalescing_lock:
+            updates = self.coalesced_updates
+            self.coalesced_updates = {}
+        for (dobject_id, field_id), (source, value) in updates.items():
+            with self._shard_lock(dobject_id):
+                dobject = self.dobjects[dobject_id]
+                policy = dobject._field_policies[field_id]
+                self._emit_field_update(source, dobject, field_id, policy,
+                                        value)
+        self._work_emission_queue()
+
+    def _coalesce_updates(self):
+        while not self.coalescing_stopped.wait(self.coalesce_interval):
+            try:
+                self.flush_coalesced_updates()
+            except Exception:
+                logger.exception("Failed to flush coalesced field updates")
+
 
 class BaseStateServer(BaseComponent):
     all_connections = channels.ALL_STATE_SERVERS
-    individual_channel = 17  # FIXME: Override in internal sample. Also, assign
-                            # a free channel dynamically.
-    dobject_ids = (0, 999999)
+    individual_channel = channels.STATE_SERVERS[0]
 
-    def __init__(self):
-        self.id_gen = IDGenerator(id_range=self.dobject_ids)
+    def __init__(self, channel=None):
+        # Without a channel of its own, the state server takes the one of its
+        # MessageDirector once it has one.
+        self.channel_given = channel is not None
+        if channel is None:
+            channel = self.individual_channel
+        self.set_channel(channel)
 
     def __repr__(self):
         return "StateServer {}".format(self.individual_channel)
 
+    def set_channel(self, channel):
+        """Make this the state server on channel, owning that channel's range
+        of dobject IDs."""
+        self.individual_channel = channel
+        self.dobject_ids = state_server_dobject_ids(channel)
+        self.id_gen = IDGenerator(id_range=self.dobject_ids)
+
+    def set_message_director(self, message_director):
+        if not self.channel_given:
+            self.set_channel(message_director_state_server_channel(
+                message_director.channel,
+            ))
+        super().set_message_director(message_director)
+        self.message_director.subscribe_to_channel(
+            self.individual_channel,
+            self,
+        )
+
     def shutdown(self):
         pass
 
@@ -305,7 +657,7 @@ class BaseStateServer(BaseComponent):
         elif message_type == msgtypes.REMOVE_FROM_ZONE:
             dobject_id = args[0]
             zone = args[1]
-            self.remove_from_zone(dobject_id, zone)
+            self.handle_remove_from_zone(dobject_id, zone)
         elif message_type == msgtypes.SET_AI:
             ai_channel = args[0]
             dobject_id = args[1]
@@ -372,6 +724,24 @@ class BaseStateServer(BaseComponent):
         self.set_field(source, dobject_id, field_id, value)
 
 class StateServer(BaseStateServer, SimpleStateKeeper):
-    def __init__(self, dclasses):
-        SimpleStateKeeper.__init__(self, dclasses)
-        BaseStateServer.__init__(self)
+    def __init__(self, dclasses, channel=None, persistence=None,
+                 journal=None):
+        SimpleStateKeeper.__init__(self, dclasses, persistence, journal)
+        # What the journal restored includes what was persisted.
+        if persistence is not None and not self.dobjects.forward_map:
+            self.load_persisted_dobjects()
+        BaseStateServer.__init__(self, channel)
+
+    def set_channel(self, channel):
+        super().set_channel(channel)
+        # Don't hand out the IDs of reloaded dobjects again.
+        first_id, last_id = self.dobject_ids
+        owned_ids = [dobject_id
+                     for dobject_id in self.dobjects.forward_map
+                     if first_id <= dobject_id <= last_id]
+        if owned_ids:
+            self.id_gen.reserve(max(owned_ids))
+
+    def shutdown(self):
+        BaseStateServer.shutdown(self)
+        SimpleStateKeeper.shutdown(self)
@@ -1,5 +1,7 @@
 from threading import Lock
 
+from pandamonium.constants import channels
+
 
 # TODO: Actually respect range limits, and reuse released IDs.
 class IDGenerator:
@@ -12,6 +14,38 @@ class IDGenerator:
             self.counter += 1
             return self.counter
 
+    def reserve(self, used_id):
+        """Make sure that used_id, e.g. of a reloaded dobject, and the IDs
+        before it won't be handed out."""
+        with self.lock:
+            self.counter = max(self.counter, used_id)
+
+
+def state_server_dobject_ids(channel):
+    """The range of dobject IDs that the state server on channel owns."""
+    block = channel - channels.STATE_SERVERS[0]
+    first_id = block * channels.DOBJECT_IDS_PER_STATE_SERVER
+    return (first_id, first_id + channels.DOBJECT_IDS_PER_STATE_SERVER - 1)
+
+
+def message_director_state_server_channel(md_channel):
+    """The channel of the state server that runs with the MessageDirector on
+    md_channel, unless it was given one. Linked MessageDirectors have distinct
+    channels, so their state servers own distinct ranges of dobject IDs."""
+    return channels.STATE_SERVERS[0] + md_channel - channels.MESSAGE_DIRECTORS[0]
+
+
+def state_server_channel(dobject_id):
+    """The channel of the state server that owns the dobject."""
+    block = dobject_id // channels.DOBJECT_IDS_PER_STATE_SERVER
+    return channels.STATE_SERVERS[0] + block
+
+
+def sequence_newer(sequence, other):
+    """Whether sequence number sequence comes after other, allowing for the
+    32 bit sequence numbers to wrap around."""
+    return 0 < (sequence - other) % 2**32 < 2**31
+
 
 class AssociativeTable:
     class AssociativeColumn:
@@ -19,6 +53,8 @@ class AssociativeTable:
             self.table = table
             self.name = name
             self.elements = {}
+            # element -> column -> associated elements in that column
+            self.by_column = {}
 
         def __contains__(self, element):
             return element in self.elements
@@ -27,13 +63,17 @@ class AssociativeTable:
             if element in self.table._column_of_element:
                 raise ValueError(element)
             self.elements[element] = set()
+            self.by_column[element] = {}
             self.table._column_of_element[element] = self
 
-        def add_assoc(self, element, associated_element):
+        def add_assoc(self, element, associated_element, column):
             self.elements[element].add(associated_element)
+            associates = self.by_column[element].setdefault(column, set())
+            associates.add(associated_element)
 
-        def del_assoc(self, element, associated_element):
+        def del_assoc(self, element, associated_element, column):
             self.elements[element].remove(associated_element)
+            self.by_column[element][column].remove(associated_element)
 
         def __getitem__(self, element):
             return self.elements[element]
@@ -82,13 +122,14 @@ class AssociativeTable:
         else:
             all_assocs = set()
             for element in elements:
-                assocs = self._column_of_element[element][element]
-                all_assocs.update(assocs)
-            if tables is None:
-                return all_assocs
-            else:
-                return {assoc for assoc in all_assocs
-                        if self._column_of_element[assoc] in tables}
+                column = self._column_of_element[element]
+                if tables is None:
+                    all_assocs.update(column[element])
+                else:
+                    by_column = column.by_column[element]
+                    for table in tables:
+                        all_assocs.update(by_column.get(table, ()))
+            return all_assocs
 
     def __delitem__(self, element):
         if element not in self:
@@ -103,16 +144,20 @@ class AssociativeTable:
             raise KeyError(element_a)
         if element_b not in self._column_of_element:
             raise KeyError(element_b)
-        self._column_of_element[element_a].add_assoc(element_a, element_b)
-        self._column_of_element[element_b].add_assoc(element_b, element_a)
+        column_a = self._column_of_element[element_a]
+        column_b = self._column_of_element[element_b]
+        column_a.add_assoc(element_a, element_b, column_b)
+        column_b.add_assoc(element_b, element_a, column_a)
 
     def _dissoc(self, element_a, element_b):
         if element_a not in self._column_of_element:
             raise KeyError(element_a)
         if element_b not in self._column_of_element:
             raise KeyError(element_b)
-        self._column_of_element[element_a].del_assoc(element_a, element_b)
-        self._column_of_element[element_b].del_assoc(element_b, element_a)
+        column_a = self._column_of_element[element_a]
+        column_b = self._column_of_element[element_b]
+        column_a.del_assoc(element_a, element_b, column_b)
+        column_b.del_assoc(element_b, element_a, column_a)
 
 
 class BijectiveMap:
@@ -137,3 +182,56 @@ class BijectiveMap:
         right_item = self.forward_map[left_item]
         del self.forward_map[left_item]
         del self.backward_map[right_item]
+
+
+class ReceiveBuffer:
+    """A single receive buffer with a moving read offset. Sockets read into its
+    free space, messages are parsed in place through a memoryview, and
+    consumed bytes are only dropped by compacting when space runs out."""
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.start = 0  # Offset of the first unconsumed byte
+        self.end = 0  # Offset behind the last received byte
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _make_room(self):
+        unconsumed = self.end - self.start
+        if unconsumed < len(self.buffer) // 2:
+            self.buffer[:unconsumed] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = unconsumed
+        else:
+            self.buffer.extend(bytes(len(self.buffer)))
+
+    def writable(self):
+        """A memoryview of the free space at the end of the buffer. It has to
+        be released before the next call, and the bytes written into it
+        reported with written()."""
+        if self.end == len(self.buffer):
+            self._make_room()
+        return memoryview(self.buffer)[self.end:]
+
+    def written(self, num_bytes):
+        self.end += num_bytes
+
+    def recv_from(self, sock):
+        """Read once from sock into the free space. Returns the number of bytes
+        that were read."""
+        with self.writable() as view:
+            num_bytes = sock.recv_into(view)
+        self.written(num_bytes)
+        return num_bytes
+
+    def view(self):
+        """A memoryview of the buffer up to the end of received data. It has to
+        be released before the next read."""
+        return memoryview(self.buffer)[:self.end]
+
+    def consume(self, offset):
+        """Mark everything before offset as parsed."""
+        self.start = offset
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
@@ -0,0 +1,65 @@
+import logging
+import signal
+
+from pandamonium.core import (
+    ClientAgent,
+    AIAgent,
+    StateServerAgent,
+    MessageDirector,
+)
+from pandamonium.sockets import (
+    NetworkAIListener,
+    NetworkClientListener,
+    NetworkStateServerListener,
+)
+from pandamonium.packers import AIPacker, ClientPacker
+
+from game_code import (
+    dclasses,
+)
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Like simple_network_server.py, but the state is kept by state servers in
+# processes of their own; run state_server_process.py for each of them.
+
+
+class DemoAIAgent(AIPacker, AIAgent, NetworkAIListener):
+    timeout = 0.2
+    dclasses = dclasses
+
+
+class DemoClientAgent(ClientPacker, ClientAgent, NetworkClientListener):
+    timeout = 0.2
+    dclasses = dclasses
+    udp_port = 50551
+
+
+class DemoStateServerAgent(AIPacker, StateServerAgent,
+                           NetworkStateServerListener):
+    timeout = 0.2
+    dclasses = dclasses
+
+
+state_server_agent = DemoStateServerAgent()
+client_agent = DemoClientAgent()
+ai_agent = DemoAIAgent()
+message_director = MessageDirector(
+    state_server=state_server_agent,
+    client_agent=client_agent,
+    ai_agent=ai_agent,
+)
+
+
+def signal_sigint(sig, frame):
+    logger.warning("Shutdown initiated")
+    message_director.shutdown()  # Also shuts down the state server agent
+    logger.info("Shutdown complete.")
+
+
+signal.signal(signal.SIGINT, signal_sigint)
+message_director.startup()
+state_server_agent.listen()
@@ -91,7 +91,7 @@ class AuthServiceClientView(ClientView, AuthService, DirectObject):
 class Avatar(DClass):
     dfield_move_command = ((float, float), fp.OWNER_SEND|fp.AI_RECEIVE)
     dfield_position = ((float, float, float, bool), # x, y, h, still_moving
-                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM|fp.UNRELIABLE)
 
 
 class AvatarAIView(AIView, Avatar):
@@ -17,6 +17,7 @@ logger = logging.getLogger(__name__)
 
 class DemoAIRepository(AIPacker, NetworkAIConnector, GameAIRepository):
     dclasses = dclasses
+    queue_incoming = True
 
     def __init__(self):
         NetworkAIConnector.__init__(self)
@@ -42,11 +43,7 @@ class DemoAI(ShowBase):
         logger.info("Starting AI")
         self.ai_repository = DemoAIRepository()
         self.ai_repository.connect()
-        base.taskMgr.add(self.read_network_messages, "Network read")
-
-    def read_network_messages(self, task):
-        self.ai_repository._read_socket()
-        return task.cont
+        base.taskMgr.add(self.ai_repository.pump_task, "Network pump")
 
 
 demo_ai = DemoAI()
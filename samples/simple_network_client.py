@@ -20,6 +20,7 @@ logger = logging.getLogger(__name__)
 class DemoClientRepository(ClientPacker, NetworkClientConnector,
                            GameClientRepository):
     dclasses = dclasses
+    queue_incoming = True
 
     def __init__(self):
         NetworkClientConnector.__init__(self)
@@ -40,11 +41,7 @@ class DemoClient(ShowBase):
         logger.info("Starting Client")
         self.client_repository = DemoClientRepository()
         self.client_repository.connect()
-        base.taskMgr.add(self.read_network_messages, "Network read")
-
-    def read_network_messages(self, task):
-        self.client_repository._read_socket()
-        return task.cont
+        base.taskMgr.add(self.client_repository.pump_task, "Network pump")
 
 
 demo_client = DemoClient()
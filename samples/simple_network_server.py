@@ -2,6 +2,7 @@ import sys
 import logging
 import signal
 
+from pandamonium.constants import overflow_policies
 from pandamonium.core import ClientAgent, AIAgent, MessageDirector
 from pandamonium.state_server import StateServer
 from pandamonium.sockets import NetworkAIListener, NetworkClientListener
@@ -28,6 +29,9 @@ class DemoAIAgent(AIPacker, AIAgent, NetworkAIListener):
 class DemoClientAgent(ClientPacker, ClientAgent, NetworkClientListener):
     timeout = 0.2
     dclasses = dclasses
+    udp_port = 50551
+    send_queue_max_bytes = 1 << 20
+    send_queue_overflow = overflow_policies.DROP_UNRELIABLE
 
     def handle_connection(self, conn_id, addr):
         print("Client {} connected from {}".format(conn_id, addr))
@@ -0,0 +1,26 @@
+import logging
+
+from pandamonium.state_server import StateServer
+from pandamonium.sockets import NetworkStateServerConnector
+from pandamonium.packers import AIPacker
+
+from game_code import (
+    dclasses,
+)
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Run one of these per state server, after starting
+# clustered_network_server.py. Each gets its own channel, and owns the dobjects
+# that it creates.
+class DemoStateServerConnector(AIPacker, NetworkStateServerConnector):
+    dclasses = dclasses
+
+
+state_server = StateServer(dclasses)
+connector = DemoStateServerConnector(state_server)
+connector.connect()
+connector.serve_forever()
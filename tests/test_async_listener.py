@@ -0,0 +1,214 @@
+import socket
+import time
+
+from pandamonium.base import BaseComponent
+from pandamonium.constants import channels, field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.core import AIAgent, ClientAgent, MessageDirector
+from pandamonium.dobject import DClass
+from pandamonium.packers import AIPacker, ClientPacker, DatagramIncomplete
+from pandamonium.sockets import (
+    AsyncNetworkAIListener,
+    AsyncNetworkClientListener,
+    NetworkClientConnector,
+)
+from pandamonium.state_server import StateServer
+
+
+class DemoAIAgent(AIPacker, AIAgent, AsyncNetworkAIListener):
+    dclasses = {}
+    port = 0
+
+
+class DemoClientAgent(ClientPacker, ClientAgent, AsyncNetworkClientListener):
+    interface = '127.0.0.1'
+    dclasses = {}
+    port = 0
+
+
+def receive_messages(sock, packer, num_messages):
+    datagram = b''
+    messages = []
+    while len(messages) < num_messages:
+        datagram += sock.recv(1024)
+        try:
+            while len(messages) < num_messages:
+                message, datagram = packer.unpack_message(datagram)
+                messages.append(message)
+        except DatagramIncomplete:
+            pass
+    return messages
+
+
+def test_ai_connection():
+    ai_agent = DemoAIAgent()
+    client_agent = DemoClientAgent()
+    message_director = MessageDirector(
+        state_server=StateServer({}),
+        client_agent=client_agent,
+        ai_agent=ai_agent,
+    )
+    message_director.startup()
+    try:
+        packer = AIPacker()
+        sock = socket.create_connection(('127.0.0.1', ai_agent.get_port()))
+        sock.settimeout(5.0)
+        assigned, message = receive_messages(sock, packer, 2)
+        from_channel, to_channel, message_type, channel = assigned
+        assert message_type == msgtypes.AI_CHANNEL_ASSIGNED
+        assert to_channel == channel
+        assert message == [channel, channels.ALL_AIS, msgtypes.AI_CONNECTED,
+                           channel]
+        # Split a message across two sends
+        datagram = packer.pack_message(
+            channel,
+            channels.ALL_AIS,
+            msgtypes.AI_CONNECTED,
+            channel,
+        )
+        sock.sendall(datagram[:5])
+        sock.sendall(datagram[5:])
+        assert receive_messages(sock, packer, 1) == [message]
+        sock.close()
+    finally:
+        ai_agent.shutdown()
+        client_agent.shutdown()
+
+
+class Mover(DClass):
+    dfield_position = ((field_types.FLOAT, field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE)
+
+
+class DeltaClientAgent(ClientPacker, ClientAgent, AsyncNetworkClientListener):
+    interface = '127.0.0.1'
+    dclasses = {'Mover': Mover}
+    port = 0
+    delta_updates = True
+
+
+class DeltaClientRepository(ClientPacker, NetworkClientConnector):
+    dclasses = {'Mover': Mover}
+    queue_incoming = True
+
+    def __init__(self, host, port):
+        NetworkClientConnector.__init__(self, host=host, port=port)
+        self.received = []
+        self.messages = []
+
+    def resolve_message(self, message):
+        self.received.append(message[0])
+        return super().resolve_message(message)
+
+    def handle_message(self, message_type, *args):
+        self.messages.append([message_type, *args])
+
+
+class SilentComponent(BaseComponent):
+    def __init__(self, channel):
+        self.all_connections = channel
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        pass
+
+
+def test_delta_field_updates():
+    client_agent = DeltaClientAgent()
+    md = MessageDirector(
+        state_server=SilentComponent(channels.ALL_STATE_SERVERS),
+        client_agent=client_agent,
+        ai_agent=SilentComponent(channels.ALL_AIS),
+    )
+    client_agent.listen()
+    clients = [DeltaClientRepository('127.0.0.1', client_agent.get_port())
+               for _ in range(2)]
+    try:
+        for client in clients:
+            client.connect()
+        deadline = time.monotonic() + 5.0
+        while len(client_agent.connections) < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.001)
+        client_ids = list(client_agent.connections)
+        md.create_multicast_message(17, client_ids,
+                                    msgtypes.CREATE_DOBJECT_VIEW, 5, 0, [])
+        for position in [(1.0, 2.0), (1.0, 3.0), (4.0, 3.0)]:
+            md.create_multicast_message(1000, client_ids,
+                                        msgtypes.FIELD_UPDATE, 5, 0, position)
+        md.create_multicast_message(17, client_ids,
+                                    msgtypes.DESTROY_DOBJECT_VIEW, 5)
+        md.create_multicast_message(17, client_ids,
+                                    msgtypes.CREATE_DOBJECT_VIEW, 5, 0, [])
+        md.create_message(1000, client_ids[0], msgtypes.FIELD_UPDATE,
+                          5, 0, (4.0, 3.0))
+        for client in clients[:1]:
+            while len(client.messages) < 8:
+                assert time.monotonic() < deadline
+                client.pump()
+                time.sleep(0.001)
+        assert clients[0].received == [
+            msgtypes.CONNECTED,
+            msgtypes.CREATE_DOBJECT_VIEW,
+            msgtypes.FIELD_UPDATE,
+            msgtypes.FIELD_DELTA,
+            msgtypes.FIELD_DELTA,
+            msgtypes.DESTROY_DOBJECT_VIEW,
+            msgtypes.CREATE_DOBJECT_VIEW,
+            # The baseline was dropped with the view.
+            msgtypes.FIELD_UPDATE,
+        ]
+        updates = [message[3] for message in clients[0].messages
+                   if message[0] == msgtypes.FIELD_UPDATE]
+        assert updates == [(1.0, 2.0), (1.0, 3.0), (4.0, 3.0), (4.0, 3.0)]
+        assert clients[0].field_baselines == {5: {0: (4.0, 3.0)}}
+    finally:
+        for client in clients:
+            client.socket.close()
+        client_agent.shutdown()
+
+
+class RecordingComponent(BaseComponent):
+    def __init__(self, channel):
+        self.all_connections = channel
+        self.messages = []
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        self.messages.append((message_type, ) + args)
+
+
+class BoundedClientAgent(ClientPacker, ClientAgent,
+                         AsyncNetworkClientListener):
+    interface = '127.0.0.1'
+    dclasses = {}
+    port = 0
+    send_queue_max_messages = 10
+
+
+def test_slow_client_is_disconnected():
+    client_agent = BoundedClientAgent()
+    ai_agent = RecordingComponent(channels.ALL_AIS)
+    md = MessageDirector(
+        state_server=SilentComponent(channels.ALL_STATE_SERVERS),
+        client_agent=client_agent,
+        ai_agent=ai_agent,
+    )
+    client_agent.listen()
+    try:
+        sock = socket.create_connection(('127.0.0.1', client_agent.get_port()))
+        sock.settimeout(5.0)
+        packer = ClientPacker()
+        assert receive_messages(sock, packer, 1) == [[msgtypes.CONNECTED]]
+        (client_id, connection), = client_agent.connections.items()
+        # Pretend that the transport's buffer is full.
+        client_agent.loop.call_soon_threadsafe(connection.pause_writing)
+        for idx in range(11):
+            md.create_message(17, client_id, msgtypes.DISCONNECTED,
+                              "filler {}".format(idx))
+        assert receive_messages(sock, packer, 1) == [
+            [msgtypes.DISCONNECTED, "Too many messages waiting to be sent."],
+        ]
+        assert sock.recv(1024) == b''
+        sock.close()
+        assert (msgtypes.CLIENT_DISCONNECTED, client_id) in ai_agent.messages
+    finally:
+        client_agent.shutdown()
@@ -0,0 +1,113 @@
+import socket
+from threading import Thread
+
+from pandamonium.constants import msgtypes
+from pandamonium.packers import AIPacker, ClientPacker
+from pandamonium.sockets import NetworkAIConnector, NetworkClientConnector
+
+
+class DemoClientRepository(ClientPacker, NetworkClientConnector):
+    dclasses = {}
+    queue_incoming = True
+
+    def __init__(self, host, port):
+        NetworkClientConnector.__init__(self, host=host, port=port)
+        self.messages = []
+
+    def handle_message(self, message_type, *args):
+        self.messages.append([message_type, *args])
+
+
+def test_budgeted_pump():
+    server_socket = socket.socket()
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+    repository = DemoClientRepository(*server_socket.getsockname())
+    repository.connect()
+    agent_socket, _ = server_socket.accept()
+    packer = ClientPacker()
+    datagram = b''.join([
+        packer.pack_message(msgtypes.DISCONNECTED, "reason {}".format(idx))
+        for idx in range(3)
+    ])
+    agent_socket.sendall(datagram[:-3])
+    while len(repository.inbound) < 2:
+        repository.pump(max_messages=0)
+    assert repository.messages == []
+    assert repository.pump(max_messages=1) == 1
+    assert repository.messages == [[msgtypes.DISCONNECTED, "reason 0"]]
+    agent_socket.sendall(datagram[-3:])
+    while len(repository.messages) < 3:
+        repository.pump(max_messages=1)
+    assert repository.messages[2] == [msgtypes.DISCONNECTED, "reason 2"]
+    repository.send_message(msgtypes.DISCONNECT, 0, "Bye")
+    agent_socket.settimeout(5.0)
+    message, _ = packer.unpack_message(agent_socket.recv(1024))
+    assert message == [msgtypes.DISCONNECT, 0, "Bye"]
+    agent_socket.close()
+    server_socket.close()
+
+
+class DemoAIRepository(AIPacker, NetworkAIConnector):
+    dclasses = {}
+    queue_incoming = True
+
+
+def test_messages_from_several_threads_stay_whole():
+    server_socket = socket.socket()
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+    repository = DemoAIRepository()
+    repository.host, repository.port = server_socket.getsockname()
+    repository.connect()
+    agent_socket, _ = server_socket.accept()
+    agent_socket.settimeout(5.0)
+
+    def send(sender):
+        for idx in range(2000):
+            repository.send_message(sender, 0, msgtypes.DISCONNECT, idx,
+                                    "reason {}".format(idx))
+
+    def multicast(sender):
+        for idx in range(1000):
+            repository._send_all(repository.pack_multicast_message(
+                sender, [0, 1], msgtypes.DISCONNECT, idx, "reason",
+            ))
+
+    threads = [Thread(target=send, args=(1000, )),
+               Thread(target=send, args=(1001, )),
+               Thread(target=multicast, args=(1002, ))]
+    for thread in threads:
+        thread.start()
+    received = bytearray()
+    while any(thread.is_alive() for thread in threads) or repository.outbound:
+        repository._flush()
+        try:
+            agent_socket.settimeout(0.01)
+            received += agent_socket.recv(65536)
+        except socket.timeout:
+            pass
+    for thread in threads:
+        thread.join()
+    agent_socket.settimeout(0.5)
+    try:
+        while True:
+            data = agent_socket.recv(65536)
+            if not data:
+                break
+            received += data
+    except socket.timeout:
+        pass
+
+    packer = AIPacker()
+    messages = {1000: [], 1001: [], 1002: []}
+    datagram = bytes(received)
+    while datagram:
+        message, datagram = packer.unpack_message(datagram)
+        messages[message[0]].append(message[3])
+    assert messages[1000] == list(range(2000))
+    assert messages[1001] == list(range(2000))
+    assert messages[1002] == [idx for idx in range(1000) for _ in range(2)]
+    repository.socket.close()
+    agent_socket.close()
+    server_socket.close()
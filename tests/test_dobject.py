@@ -0,0 +1,180 @@
+import pytest
+
+from pandamonium.constants import field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass, AIView, ClientView
+
+
+class Avatar(DClass):
+    dfield_move_command = ((field_types.FLOAT, field_types.FLOAT),
+                           fp.OWNER_SEND|fp.AI_RECEIVE)
+    dfield_name = ((field_types.STRING, ), fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+    dfield_position = ((field_types.FLOAT, field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+
+
+class PythonTypedAvatar(DClass):
+    dfield_position = ((float, float, bool), fp.AI_SEND|fp.RAM)
+
+
+def test_stored_fields_are_packed():
+    avatar = Avatar(23, [("Bob", ), (1.5, -2.5)])
+    assert Avatar._storage_ids == [1, 2]
+    assert isinstance(avatar._storage, bytes)
+    assert avatar.storage == [("Bob", ), (1.5, -2.5)]
+    avatar.set_stored_field(2, (3.0, 4.0))
+    assert avatar.get_stored_field(2) == (3.0, 4.0)
+    assert avatar.storage == [("Bob", ), (3.0, 4.0)]
+    with pytest.raises(AttributeError):
+        avatar.nickname = "Bobby"
+
+
+def test_stored_fields_are_taken_at_a_point_in_time():
+    avatar = Avatar(23, [("Bob", ), (1.5, -2.5)])
+    fields = avatar.stored_fields()
+    avatar.set_stored_field(1, ("Robert", ))
+    assert avatar.storage == [("Robert", ), (1.5, -2.5)]
+    assert fields == [("Bob", ), (1.5, -2.5)]
+    assert fields.packed != avatar.get_packed_storage()
+
+
+def test_stored_fields_are_shared_until_written():
+    avatar = Avatar(23, [("Bob", ), (1.5, -2.5)])
+    fields = avatar.stored_fields()
+    assert avatar.stored_fields() is fields
+    avatar.set_stored_field(2, (3.0, 4.0))
+    assert avatar.stored_fields() is not fields
+
+
+def test_unpackable_fields_are_stored_as_tuples():
+    avatar = PythonTypedAvatar(23, [(1.0, 2.0, True)])
+    assert PythonTypedAvatar._storage_codecs is None
+    avatar.set_stored_field(0, [3.0, 4.0, False])
+    assert avatar.storage == [(3.0, 4.0, False)]
+
+
+def test_stored_fields_default_to_empty_values():
+    assert Avatar(23, []).storage == [("", ), (0.0, 0.0)]
+    assert PythonTypedAvatar(23, []).storage == [(0.0, 0.0, False)]
+    with pytest.raises(ValueError):
+        Avatar(23, [("Bob", )])
+
+
+def test_views_keep_their_attributes():
+    class AvatarView(ClientView, Avatar):
+        def on_name(self, name):
+            pass
+
+        def on_position(self, x, y):
+            pass
+
+        def do_move_command(self, x, y):
+            return (x, y)
+
+    view = AvatarView(None, 23, [("Bob", ), (1.5, -2.5)])
+    assert view.repository is None
+    assert view.storage == [("Bob", ), (1.5, -2.5)]
+
+
+def test_view_methods_are_compiled_once_per_view_class():
+    class Repository:
+        def __init__(self):
+            self.sent = []
+
+        def send_message(self, *message):
+            self.sent.append(message)
+
+    class AvatarView(ClientView, Avatar):
+        def on_name(self, name):
+            self.name = name
+
+        def on_position(self, x, y):
+            self.position = (x, y)
+
+        def do_move_command(self, x, y):
+            return (x, y)
+
+    class MyAvatarView(AvatarView):
+        pass
+
+    repository = Repository()
+    views = [AvatarView(repository, 23, []),
+             AvatarView(repository, 24, []),
+             MyAvatarView(repository, 25, [])]
+    for view in views:
+        view.do_move_command(1.0, 2.0)
+    assert repository.sent == [
+        (msgtypes.SET_FIELD, dobject_id, 0, (1.0, 2.0))
+        for dobject_id in (23, 24, 25)
+    ]
+    views[2].handle_field_update(1, ("Bob", ))
+    views[2].handle_field_update(2, (1.5, -2.5))
+    assert views[2].name == "Bob"
+    assert views[2].position == (1.5, -2.5)
+
+
+def test_inherited_senders_send_the_subclass_field_id():
+    class Repository:
+        channel = 1000
+
+        def __init__(self):
+            self.sent = []
+
+        def send_message(self, *message):
+            self.sent.append(message)
+
+    class Base(DClass):
+        dfield_move = ((field_types.FLOAT, ), fp.AI_SEND)
+
+    class BaseView(AIView, Base):
+        def do_move(self, speed):
+            return (speed, )
+
+    class Derived(Base):
+        # Sorts before move, so move's field ID shifts to 1.
+        dfield_attack = ((field_types.FLOAT, ), fp.AI_SEND)
+
+    class DerivedView(BaseView, Derived):
+        def do_attack(self, strength):
+            return (strength, )
+
+    repository = Repository()
+    BaseView(repository, 23, []).do_move(1.0)
+    DerivedView(repository, 24, []).do_move(2.0)
+    BaseView(repository, 25, []).do_move(3.0)
+    assert [(dobject_id, field_id, values)
+            for _, _, _, dobject_id, field_id, values in repository.sent] == [
+        (23, 0, (1.0, )),
+        (24, 1, (2.0, )),
+        (25, 0, (3.0, )),
+    ]
+
+
+def test_only_unslotted_dclasses_take_attributes():
+    class PlayerAvatar(Avatar):
+        pass
+
+    for dclass in (Avatar, PlayerAvatar, PythonTypedAvatar):
+        with pytest.raises(AttributeError):
+            dclass(23, []).mood = "happy"
+
+    class MoodyAvatar(Avatar):
+        slotted = False
+
+    class MoodyPlayerAvatar(MoodyAvatar):
+        pass
+
+    for dclass in (MoodyAvatar, MoodyPlayerAvatar):
+        avatar = dclass(23, [])
+        avatar.mood = "happy"
+        assert avatar.mood == "happy"
+
+
+def test_view_methods_are_checked_when_the_view_class_is_created():
+    with pytest.raises(Exception, match="Method on_position is missing"):
+        class AvatarView(ClientView, Avatar):
+            def on_name(self, name):
+                pass
+
+            def do_move_command(self, x, y):
+                return (x, y)
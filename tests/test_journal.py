@@ -0,0 +1,89 @@
+import os
+
+from pandamonium.constants import field_types
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
+from pandamonium.journal import StateJournal
+from pandamonium.state_server import StateServer
+
+
+class Avatar(DClass):
+    dfield_name = ((field_types.STRING, ), fp.OWNER_SEND|fp.RAM)
+    dfield_position = ((float, float), fp.OWNER_SEND|fp.RAM)
+    dfield_emote = ((field_types.STRING, ), fp.OWNER_SEND|fp.CLIENT_RECEIVE)
+
+
+class NullMessageDirector:
+    def create_message(self, *message):
+        pass
+
+    def create_multicast_message(self, *message):
+        pass
+
+
+def start_state_server(directory):
+    state_server = StateServer(
+        dict(Avatar=Avatar),
+        journal=StateJournal(directory, snapshot_interval=None),
+    )
+    state_server.message_director = NullMessageDirector()
+    return state_server
+
+
+def test_state_is_restored_from_journal(tmp_path):
+    state_server = start_state_server(str(tmp_path))
+    try:
+        state_server.create_dobject(5, 0, [("Bob", ), (0.0, 0.0)])
+        state_server.create_dobject(6, 0, [("Alice", ), (0.0, 0.0)])
+        state_server.add_presence(5, 1)
+        state_server.add_presence(6, 1)
+        state_server.add_presence(6, 2)
+        state_server.remove_presence(6, 1)
+        state_server.set_interest(100000, 1)
+        state_server.set_owner(100000, 5)
+        state_server.set_ai(1000, 5)
+        state_server.set_field(100000, 5, 2, (2.5, 3.5))
+        state_server.set_field(100000, 5, 0, ("waves", ))
+    finally:
+        state_server.shutdown()
+
+    state_server = start_state_server(str(tmp_path))
+    try:
+        avatar = state_server.dobjects[5]
+        assert avatar.storage == [("Bob", ), (2.5, 3.5)]
+        assert avatar.owner == 100000
+        assert avatar.ai == 1000
+        assert state_server._dobject_seen_by(avatar) == {100000}
+        assert state_server._dobject_seen_by(state_server.dobjects[6]) == set()
+    finally:
+        state_server.shutdown()
+
+
+def test_snapshot_replaces_journal(tmp_path):
+    directory = str(tmp_path)
+    state_server = start_state_server(directory)
+    try:
+        state_server.create_dobject(5, 0, [("Bob", ), (0.0, 0.0)])
+        state_server.add_presence(5, 1)
+        state_server.set_interest(100000, 1)
+        state_server.set_owner(100000, 5)
+        state_server.snapshot_journal()
+        assert sorted(os.listdir(directory)) == ['journal.00000001',
+                                                 'snapshot']
+        state_server.set_field(100000, 5, 1, ("Robert", ))
+    finally:
+        state_server.shutdown()
+    # The process died while writing a record.
+    with open(os.path.join(directory, 'journal.00000001'), 'ab') as f:
+        f.write(b'\x07\x20\x00')
+
+    state_server = start_state_server(directory)
+    try:
+        avatar = state_server.dobjects[5]
+        assert avatar.storage == [("Robert", ), (0.0, 0.0)]
+        assert avatar.owner == 100000
+        assert state_server._dobject_seen_by(avatar) == {100000}
+        # Journaling goes on in a fresh generation.
+        assert state_server.journal.generation == 2
+    finally:
+        state_server.shutdown()
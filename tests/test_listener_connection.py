@@ -0,0 +1,146 @@
+import socket
+import struct
+from threading import Event
+
+from pandamonium.constants import msgtypes, overflow_policies
+from pandamonium.packers import ClientPacker
+from pandamonium.sockets import NetworkListenerConnection, SendQueue
+
+
+class DemoAgent(ClientPacker):
+    pass_through = False
+
+    def pack_connection_message(self, connection, message):
+        return self.pack_message(*message)
+
+    def close_connection(self, connection_id):
+        pass
+
+
+def test_queued_messages_are_packed_together():
+    agent_socket, client_socket = socket.socketpair()
+    connection = NetworkListenerConnection(DemoAgent(), agent_socket, None, 1)
+    try:
+        # Stop the connection's own threads, and write batches by hand.
+        connection.keep_running = False
+        connection.join()
+        connection.timeout = 0
+        connection.flush_max_messages = 50
+        for idx in range(120):
+            connection.enqueue(msgtypes.DISCONNECTED, "reason {}".format(idx))
+        batches = [connection._next_batch() for _ in range(4)]
+        assert batches[3] is None
+
+        packer = ClientPacker()
+        messages = []
+        for batch in batches[:3]:
+            while batch:
+                message, batch = packer.unpack_message(batch)
+                messages.append(message)
+            if len(messages) < 120:
+                assert len(messages) % 50 == 0
+        assert messages == [[msgtypes.DISCONNECTED, "reason {}".format(idx)]
+                            for idx in range(120)]
+    finally:
+        agent_socket.close()
+        client_socket.close()
+
+
+def test_invalid_messages_close_the_connection():
+    class ClosingAgent(DemoAgent):
+        def __init__(self):
+            self.closed = Event()
+
+        def close_connection(self, connection_id):
+            self.closed.set()
+
+    agent = ClosingAgent()
+    agent_socket, client_socket = socket.socketpair()
+    connection = NetworkListenerConnection(agent, agent_socket, None, 1)
+    try:
+        # A frame of an unknown message type
+        client_socket.sendall(struct.pack('=Ih', 2, 32000))
+        assert agent.closed.wait(5.0)
+        connection.reader_tread.join(5.0)
+        assert not connection.reader_tread.is_alive()
+    finally:
+        connection.keep_running = False
+        connection.join()
+        agent_socket.close()
+        client_socket.close()
+
+
+def test_failing_handlers_keep_the_connection():
+    class FailingAgent(DemoAgent):
+        def __init__(self):
+            self.closed = Event()
+            self.handled = Event()
+            self.messages = []
+
+        def handle_incoming_message(self, message_type, *args):
+            self.messages.append(args)
+            if len(self.messages) == 1:
+                raise KeyError(23)  # E.g. an unknown dobject
+            self.handled.set()
+
+        def close_connection(self, connection_id):
+            self.closed.set()
+
+    agent = FailingAgent()
+    agent_socket, client_socket = socket.socketpair()
+    connection = NetworkListenerConnection(agent, agent_socket, None, 1)
+    try:
+        packer = ClientPacker()
+        client_socket.sendall(b''.join([
+            packer.pack_message(msgtypes.DISCONNECT, 0, "first"),
+            packer.pack_message(msgtypes.DISCONNECT, 0, "second"),
+        ]))
+        assert agent.handled.wait(5.0)
+        assert agent.messages == [(0, "first"), (0, "second")]
+        assert not agent.closed.is_set()
+    finally:
+        connection.keep_running = False
+        connection.join()
+        agent_socket.close()
+        client_socket.close()
+
+
+def test_send_queue_drops_oldest_unreliable_updates():
+    queue = SendQueue(max_messages=3,
+                      overflow=overflow_policies.DROP_UNRELIABLE)
+    assert queue.put(b'position 1', (5, 1), droppable=True)
+    assert queue.put(b'name', (5, 0))
+    assert queue.put(b'position 2', (5, 1), droppable=True)
+    assert queue.put(b'position 3', (5, 1), droppable=True)
+    assert [queue.get(block=False) for _ in range(len(queue))] == [
+        b'name', b'position 2', b'position 3',
+    ]
+    assert queue.dropped == 1
+    assert queue.peak_messages == 3
+    assert queue.num_bytes == 0
+    # Reliable messages can't be dropped.
+    for idx in range(3):
+        assert queue.put(b'name', (5, 0))
+    assert not queue.put(b'DISCONNECTED')
+
+
+def test_send_queue_collapses_field_updates():
+    queue = SendQueue(max_bytes=20, overflow=overflow_policies.COLLAPSE_FIELDS)
+    assert queue.put(b'x=1', (5, 1))
+    assert queue.put(b'y=1', (5, 2))
+    assert queue.put(b'VIEW', None)
+    assert queue.put(b'x=2', (5, 1))
+    assert queue.num_bytes == 13
+    assert queue.put(b'x=3', (5, 1))
+    assert queue.put(b'y=2', (5, 2))
+    assert queue.put(b'x=4', (5, 1))
+    assert [queue.get(block=False) for _ in range(len(queue))] == [
+        b'VIEW', b'y=2', b'x=4',
+    ]
+    assert queue.dropped == 4
+
+
+def test_send_queue_disconnects_by_default():
+    queue = SendQueue(max_messages=1)
+    assert queue.put(b'x=1', (5, 1), droppable=True)
+    assert not queue.put(b'x=2', (5, 1), droppable=True)
@@ -0,0 +1,95 @@
+import threading
+
+from pandamonium.base import BaseComponent
+from pandamonium.core import MessageDirector
+
+
+class RecordingComponent(BaseComponent):
+    def __init__(self, channel, pass_through=False):
+        self.all_connections = channel
+        self.pass_through = pass_through
+        self.messages = []
+        self.frames = []
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        self.messages.append((from_channel, to_channel, message_type) + args)
+        self.thread = threading.current_thread()
+
+    def handle_frame(self, from_channel, to_channel, frame):
+        self.frames.append((from_channel, to_channel, frame))
+
+
+def make_message_director(queued_dispatch=False):
+    state_server = RecordingComponent(1)
+    client_agent = RecordingComponent(3)
+    ai_agent = RecordingComponent(2, pass_through=True)
+    md = MessageDirector(
+        state_server=state_server,
+        client_agent=client_agent,
+        ai_agent=ai_agent,
+        queued_dispatch=queued_dispatch,
+    )
+    return md, state_server, ai_agent
+
+
+def test_route_frame_to_pass_through_listener():
+    md, state_server, ai_agent = make_message_director()
+    decoded = []
+    md.route_frame(1000, 2, b'frame', lambda: decoded.append(1))
+    assert ai_agent.frames == [(1000, 2, b'frame')]
+    assert decoded == []
+
+
+def test_route_frame_decodes_once():
+    md, state_server, ai_agent = make_message_director()
+    other_state_server = RecordingComponent(1)
+    other_state_server.set_message_director(md)
+    decoded = []
+
+    def decode():
+        decoded.append(1)
+        return [1000, 1, 'MESSAGE', 23]
+
+    md.route_frame(1000, 1, b'frame', decode)
+    assert decoded == [1]
+    assert state_server.messages == [(1000, 1, 'MESSAGE', 23)]
+    assert other_state_server.messages == [(1000, 1, 'MESSAGE', 23)]
+
+
+def test_multicast_groups_channels_by_listener():
+    md, state_server, ai_agent = make_message_director()
+    md.subscribe_to_channel(1000, ai_agent)
+    md.subscribe_to_channel(1001, ai_agent)
+    calls = []
+    ai_agent.handle_multicast_message = lambda *message: calls.append(message)
+    md.create_multicast_message(1, [1000, 1001], 'MESSAGE', 23)
+    assert len(calls) == 1
+    from_channel, to_channels, message_type, arg = calls[0]
+    assert sorted(to_channels) == [1000, 1001]
+    assert (from_channel, message_type, arg) == (1, 'MESSAGE', 23)
+
+
+def test_subscription_does_not_change_routed_listeners():
+    md, state_server, ai_agent = make_message_director()
+    md.subscribe_to_channel(1000, ai_agent)
+    listeners = md.channels[1000]
+    other_agent = RecordingComponent(2)
+    md.subscribe_to_channel(1000, other_agent)
+    assert listeners == frozenset([ai_agent])
+    assert md.channels[1000] == frozenset([ai_agent, other_agent])
+    md.unsubscribe_from_channel(1000, ai_agent)
+    assert md.channels[1000] == frozenset([other_agent])
+
+
+def test_queued_dispatch():
+    md, state_server, ai_agent = make_message_director(queued_dispatch=True)
+    try:
+        for idx in range(250):
+            md.create_message(1000, 1, 'MESSAGE', idx)
+        md.join_dispatch()
+        assert state_server.messages == [(1000, 1, 'MESSAGE', idx)
+                                         for idx in range(250)]
+        assert state_server.thread is not threading.current_thread()
+    finally:
+        for worker in md.workers.values():
+            worker.shutdown()
@@ -0,0 +1,235 @@
+import multiprocessing
+import time
+
+from pandamonium.base import BaseComponent
+from pandamonium.constants import channels, field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.core import MessageDirector
+from pandamonium.dobject import DClass
+from pandamonium.packers import AIPacker
+from pandamonium.sockets import NetworkMessageDirectorBackbone
+from pandamonium.state_server import StateServer
+
+
+class DemoBackbone(AIPacker, NetworkMessageDirectorBackbone):
+    dclasses = {}
+    port = 0
+
+
+class RecordingComponent(BaseComponent):
+    def __init__(self, channel):
+        self.all_connections = channel
+        self.messages = []
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        self.messages.append((from_channel, to_channel, message_type) + args)
+
+
+class EchoComponent(RecordingComponent):
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        self.message_director.create_message(
+            to_channel,
+            from_channel,
+            message_type,
+            *args,
+        )
+
+
+class RecordingPeerLink(RecordingComponent):
+    is_peer_link = True
+
+    def __init__(self):
+        super().__init__(None)
+        self.advertised = []
+
+    def advertise_subscription(self, channel):
+        self.advertised.append(('+', channel))
+
+    def advertise_unsubscription(self, channel):
+        self.advertised.append(('-', channel))
+
+
+def make_message_director(md_channel=channels.MESSAGE_DIRECTORS[0]):
+    return MessageDirector(
+        state_server=RecordingComponent(channels.ALL_STATE_SERVERS),
+        client_agent=RecordingComponent(channels.ALL_CLIENTS),
+        ai_agent=RecordingComponent(channels.ALL_AIS),
+        channel=md_channel,
+    )
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_subscriptions_are_advertised_to_peers():
+    md = make_message_director()
+    peer = RecordingPeerLink()
+    md.add_peer(peer)
+    assert sorted(peer.advertised) == [('+', channels.ALL_STATE_SERVERS),
+                                       ('+', channels.ALL_AIS),
+                                       ('+', channels.ALL_CLIENTS)]
+    del peer.advertised[:]
+    first = RecordingComponent(1000)
+    second = RecordingComponent(1000)
+    md.subscribe_to_channel(1000, first)
+    md.subscribe_to_channel(1000, second)
+    # The peer's own subscriptions are not advertised back.
+    md.subscribe_to_channel(100000, peer)
+    md.unsubscribe_from_channel(1000, first)
+    md.unsubscribe_from_channel(1000, second)
+    assert peer.advertised == [('+', 1000), ('-', 1000)]
+
+
+def test_messages_from_peers_stay_local():
+    md = make_message_director()
+    peer = RecordingPeerLink()
+    md.add_peer(peer)
+    md.subscribe_to_channel(100000, peer)
+    local = RecordingComponent(100000)
+    md.subscribe_to_channel(100000, local)
+    md.create_message(1000, 100000, msgtypes.CONNECTED)
+    md.create_message(1000, 100000, msgtypes.DISCONNECTED, "Bye", local=True)
+    assert peer.messages == [(1000, 100000, msgtypes.CONNECTED)]
+    assert local.messages == [(1000, 100000, msgtypes.CONNECTED),
+                              (1000, 100000, msgtypes.DISCONNECTED, "Bye")]
+    md.remove_peer(peer)
+    assert md.channels[100000] == frozenset([local])
+
+
+def run_echoing_message_director(port, stop):
+    md = make_message_director(channels.MESSAGE_DIRECTORS[0] + 1)
+    for channel in [100000, 100001]:
+        echo = EchoComponent(channel)
+        echo.set_message_director(md)
+    backbone = DemoBackbone(md)
+    backbone.connect('127.0.0.1', port)
+    stop.wait()
+    backbone.shutdown()
+
+
+def test_message_director_processes():
+    md = make_message_director()
+    ai = RecordingComponent(1000)
+    ai.set_message_director(md)
+    backbone = DemoBackbone(md)
+    backbone.listen()
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    process = context.Process(
+        target=run_echoing_message_director,
+        args=(backbone.get_port(), stop),
+    )
+    try:
+        process.start()
+        wait_for(lambda: 100001 in md.channels)
+        assert 100002 not in md.channels
+
+        md.create_message(1000, 100000, msgtypes.CLIENT_CONNECTED, 42)
+        wait_for(lambda: len(ai.messages) == 1)
+        assert ai.messages == [(100000, 1000, msgtypes.CLIENT_CONNECTED, 42)]
+
+        md.create_multicast_message(1000, [100000, 100001],
+                                    msgtypes.DISCONNECTED, "Bye")
+        wait_for(lambda: len(ai.messages) == 3)
+        assert sorted(ai.messages[1:]) == [
+            (100000, 1000, msgtypes.DISCONNECTED, "Bye"),
+            (100001, 1000, msgtypes.DISCONNECTED, "Bye"),
+        ]
+    finally:
+        stop.set()
+        process.join(timeout=10.0)
+        if process.is_alive():
+            process.terminate()
+        backbone.shutdown()
+    # The peer's subscriptions are gone with it.
+    wait_for(lambda: not md.peers)
+    assert not md.channels[100000]
+
+
+class Thing(DClass):
+    dfield_value = ((field_types.CHANNEL, ),
+                    fp.CLIENT_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+
+
+class ThingBackbone(AIPacker, NetworkMessageDirectorBackbone):
+    dclasses = {'Thing': Thing}
+    port = 0
+
+
+def make_clustered_message_director(md_channel, state_server_channel=None):
+    return MessageDirector(
+        state_server=StateServer({'Thing': Thing}, state_server_channel),
+        client_agent=RecordingComponent(channels.ALL_CLIENTS),
+        ai_agent=RecordingComponent(channels.ALL_AIS),
+        channel=md_channel,
+    )
+
+
+def test_linked_message_directors_run_distinct_state_servers():
+    first_md = make_clustered_message_director(channels.MESSAGE_DIRECTORS[0])
+    second_md = make_clustered_message_director(
+        channels.MESSAGE_DIRECTORS[0] + 1,
+    )
+    first_ai = RecordingComponent(1000)
+    first_ai.set_message_director(first_md)
+    second_ai = RecordingComponent(1001)
+    second_ai.set_message_director(second_md)
+    first_backbone = ThingBackbone(first_md)
+    second_backbone = ThingBackbone(second_md)
+    try:
+        first_backbone.listen()
+        second_backbone.connect('127.0.0.1', first_backbone.get_port())
+        for md in (first_md, second_md):
+            wait_for(lambda: md.state_server_channels == (100, 101))
+        wait_for(lambda: 1001 in first_md.channels and
+                         1000 in second_md.channels)
+
+        # Each MessageDirector takes turns between both state servers.
+        for token in range(2):
+            first_md.create_message(1000, channels.ALL_STATE_SERVERS,
+                                    msgtypes.CREATE_DOBJECT, 0, [(7, )], token)
+            second_md.create_message(1001, channels.ALL_STATE_SERVERS,
+                                     msgtypes.CREATE_DOBJECT, 0, [(7, )], token)
+        wait_for(lambda: len(first_ai.messages) == 2 and
+                         len(second_ai.messages) == 2)
+        assert sorted(message[0] for message
+                      in first_ai.messages + second_ai.messages) == \
+            [100, 100, 101, 101]
+        dobject_ids = [message[3]
+                       for message in first_ai.messages + second_ai.messages]
+        assert len(set(dobject_ids)) == 4
+        assert set(first_md.state_server.dobjects.forward_map) == \
+            {dobject_id for dobject_id in dobject_ids if dobject_id < 1000000}
+        assert set(second_md.state_server.dobjects.forward_map) == \
+            {dobject_id for dobject_id in dobject_ids if dobject_id >= 1000000}
+    finally:
+        second_backbone.shutdown()
+        first_backbone.shutdown()
+        first_md.state_server.shutdown()
+        second_md.state_server.shutdown()
+
+
+def test_peers_with_the_same_state_server_channel_are_refused():
+    first_md = make_clustered_message_director(channels.MESSAGE_DIRECTORS[0])
+    second_md = make_clustered_message_director(
+        channels.MESSAGE_DIRECTORS[0] + 1,
+        state_server_channel=100,
+    )
+    first_backbone = ThingBackbone(first_md)
+    second_backbone = ThingBackbone(second_md)
+    try:
+        first_backbone.listen()
+        second_backbone.connect('127.0.0.1', first_backbone.get_port())
+        wait_for(lambda: not first_md.peers and not second_md.peers)
+        for md in (first_md, second_md):
+            assert md.state_server_channels == (100, )
+            assert md.channels[100] == frozenset([md.state_server])
+    finally:
+        second_backbone.shutdown()
+        first_backbone.shutdown()
+        first_md.state_server.shutdown()
+        second_md.state_server.shutdown()
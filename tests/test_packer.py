@@ -1,3 +1,5 @@
+from threading import Lock
+
 import pytest
 
 from pandamonium.constants import (
@@ -71,6 +73,31 @@ def test_ai_packer_int_args():
     assert channel_3 == args[2]
 
 
+def test_ai_packer_unpack_from_offsets():
+    packer = AIPacker()
+    message_type = msgtypes.TEST_THREE_CHANNEL_ARGS
+    datagram = b''.join([
+        packer.pack_message(1, 2, message_type, 3, 4, 5),
+        packer.pack_message(6, 7, message_type, 8, 9, 10),
+    ])
+    view = memoryview(datagram)
+    message_1, offset = packer.unpack_message_from(view, 0)
+    message_2, offset = packer.unpack_message_from(view, offset)
+    assert message_1 == [1, 2, message_type, 3, 4, 5]
+    assert message_2 == [6, 7, message_type, 8, 9, 10]
+    assert offset == len(datagram)
+    with pytest.raises(DatagramIncomplete):
+        packer.unpack_message_from(view, offset)
+
+
+def test_ai_packer_multicast():
+    packer = AIPacker()
+    message_type = msgtypes.TEST_THREE_CHANNEL_ARGS
+    frames = packer.pack_multicast_message(1, [2, 3], message_type, 4, 5, 6)
+    assert frames[0] == packer.pack_message(1, 2, message_type, 4, 5, 6)
+    assert frames[1] == packer.pack_message(1, 3, message_type, 4, 5, 6)
+
+
 def test_client_packer_no_args():
     packer = ClientPacker()
     message_type = msgtypes.TEST_NO_ARGS
@@ -94,6 +121,17 @@ def test_incomplete_datagram_client_packer():
         packer.unpack_message(message)
 
 
+def test_incomplete_frame():
+    packer = AIPacker()
+    message = packer.pack_message(1, 2, msgtypes.TEST_THREE_CHANNEL_ARGS,
+                                  3, 4, 5)
+    with pytest.raises(DatagramIncomplete):
+        packer.frame_bounds(message[:-1], 0)
+    start, end = packer.frame_bounds(message, 0)
+    assert end == len(message)
+    assert packer.unpack_frame(message, start, end)[3:] == [3, 4, 5]
+
+
 def test_field_roundtrip():
     packer = type('Packer', (BasePacker, ), {'dclasses': {'foo': DemoDClass}})()
     packer.dclasses_by_id = [packer.dclasses[dclass_name]
@@ -162,4 +200,150 @@ def test_pack_message_with_create_dobject():
     assert token == token_p
 
 
+def test_ai_packer_string_args():
+    packer = AIPacker()
+    from_channel = 5
+    to_channel = 8
+    message_type = msgtypes.DISCONNECT_CLIENT
+    client_id = 100001
+    reason = "Because!"
+    message = packer.pack_message(
+        from_channel,
+        to_channel,
+        message_type,
+        client_id,
+        reason,
+    )
+    [from_p, to_p, type_p, *args], datagram = packer.unpack_message(message)
+    assert datagram == b''
+    assert message_type == type_p
+    assert args == [client_id, reason]
+    with pytest.raises(DatagramIncomplete):
+        packer.unpack_message(message[:-1])
+
+
+def test_pack_message_with_set_field():
+    packer = type('Packer', (AIPacker, ), {'dclasses': {'foo': DemoDClass}})()
+    packer.dclasses_by_id = [packer.dclasses[dclass_name]
+                             for dclass_name in sorted(packer.dclasses)]
+    packer.dclasses_by_dobject_id = {23: 0}
+    packer.dclasses_lock = Lock()
+    from_channel = 5
+    to_channel = 8
+    message_type = msgtypes.SET_FIELD
+    dobject_id = 23
+    field_id = 1
+    field_values = (456, 789)
+    datagram = packer.pack_message(
+        from_channel,
+        to_channel,
+        message_type,
+        dobject_id,
+        field_id,
+        field_values,
+    )
+    message, datagram = packer.unpack_message(datagram)
+    from_p, to_p, message_type_p, dobject_id_p, field_id_p, values_p = message
+    assert datagram == b''
+    assert message_type == message_type_p
+    assert dobject_id == dobject_id_p
+    assert field_id == field_id_p
+    assert field_values == values_p
+
+
+
+class MovingDClass(DClass):
+    dfield_position = ((field_types.FLOAT,
+                        field_types.FLOAT,
+                        field_types.CHANNEL),
+                       field_policies.CLIENT_RECEIVE)
+
+
+def make_delta_packer(float_quantum=None):
+    packer = type('Packer', (ClientPacker, ), {
+        'dclasses': {'foo': MovingDClass},
+        'float_quantum': float_quantum,
+    })()
+    packer.dclasses_by_id = [packer.dclasses[dclass_name]
+                             for dclass_name in sorted(packer.dclasses)]
+    packer.dclasses_by_dobject_id = {23: 0}
+    packer.dclasses_lock = Lock()
+    return packer
+
+
+def test_field_update_delta():
+    packer = make_delta_packer()
+    full, known = packer.pack_field_update(None, 23, 0, (1.5, 2.5, 7))
+    assert known == (1.5, 2.5, 7)
+    message, _ = packer.unpack_message(full)
+    assert message == [msgtypes.FIELD_UPDATE, 23, 0, (1.5, 2.5, 7)]
+
+    delta, known = packer.pack_field_update(known, 23, 0, (1.5, 3.5, 7))
+    assert known == (1.5, 3.5, 7)
+    assert len(delta) < len(full)
+    message, datagram = packer.unpack_message(delta)
+    assert datagram == b''
+    assert message == [msgtypes.FIELD_DELTA, 23, 0, 0b010, (3.5, )]
+    _, _, _, mask, changed = message
+    assert packer.apply_field_delta((1.5, 2.5, 7), mask, changed) == known
+
+    # With everything changed, the complete update is sent instead.
+    frame, known = packer.pack_field_update(known, 23, 0, (0.5, 0.5, 8))
+    message, _ = packer.unpack_message(frame)
+    assert message[0] == msgtypes.FIELD_UPDATE
+
+
+def test_field_update_delta_quantized():
+    packer = make_delta_packer(float_quantum=0.25)
+    baseline = (1.0, 2.0, 7)
+    # A change below the quantum is not sent at all.
+    frame, known = packer.pack_field_update(baseline, 23, 0, (1.1, 3.3, 7))
+    assert known == (1.0, 3.25, 7)
+    message, _ = packer.unpack_message(frame)
+    assert message == [msgtypes.FIELD_DELTA, 23, 0, 0b010, (3.25, )]
+    # Values that don't fit into the quantized range get sent completely.
+    frame, known = packer.pack_field_update(baseline, 23, 0, (1.0, 1e6, 7))
+    assert known == (1.0, 1e6, 7)
+    message, _ = packer.unpack_message(frame)
+    assert message[0] == msgtypes.FIELD_UPDATE
+
 # TODO: Test packing/unpacking with CREATE_OBJECT, CREATE_*_VIEW
+
+
+class NamedDClass(DClass):
+    dfield_name = ((field_types.STRING, field_types.CHANNEL),
+                   field_policies.RAM)
+    dfield_position = ((field_types.FLOAT, field_types.FLOAT),
+                       field_policies.RAM)
+
+
+def test_stored_fields_are_sent_as_stored():
+    packer = type('Packer', (AIPacker, ), {'dclasses': {'foo': NamedDClass}})()
+    packer.dclasses_by_id = [packer.dclasses[dclass_name]
+                             for dclass_name in sorted(packer.dclasses)]
+    packer.dclasses_by_dobject_id = {}
+    packer.dclasses_lock = Lock()
+    dobject = NamedDClass(23, [("Bob", 5), (1.5, 2.5)])
+    dobject.set_stored_field(0, ("Robert", 6))
+    field_values = [("Robert", 6), (1.5, 2.5)]
+    assert dobject.get_packed_storage() == packer.pack_fields(0, field_values)
+    frame = packer.pack_message(
+        5,
+        8,
+        msgtypes.CREATE_DOBJECT_VIEW,
+        23,
+        0,
+        dobject.stored_fields(),
+    )
+    message, datagram = packer.unpack_message(frame)
+    assert datagram == b''
+    assert message[3:] == [23, 0, field_values]
+    # The message is encoded once for all recipients.
+    assert list(dobject.stored_fields().encoded) == [
+        (msgtypes.CREATE_DOBJECT_VIEW.num_id, 23),
+    ]
+    frames = packer.pack_multicast_message(5, [8, 9],
+                                           msgtypes.CREATE_DOBJECT_VIEW,
+                                           23, 0, dobject.stored_fields())
+    assert frames[0] == frame
+    assert frames[1][12:] == frame[12:]
@@ -0,0 +1,126 @@
+from threading import Event
+
+from pandamonium.constants import field_types
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
+from pandamonium.journal import StateJournal
+from pandamonium.persistence import (
+    BasePersistence,
+    SQLitePersistence,
+    WriteBehind,
+)
+from pandamonium.state_server import StateServer
+
+
+class RecordingPersistence(BasePersistence):
+    def __init__(self):
+        self.batches = []
+        self.written = Event()
+
+    def write_batch(self, dobjects, fields):
+        self.batches.append((dobjects, fields))
+        self.written.set()
+
+    def load(self):
+        return iter(())
+
+
+def test_writes_are_batched():
+    backend = RecordingPersistence()
+    persistence = WriteBehind(backend, flush_interval=3600, batch_size=3)
+    try:
+        persistence.create_dobject(5, 'Player', {'name': ("Bob", )})
+        persistence.set_field(5, 'name', ("Alice", ))
+        # Only the latest value of a field is kept.
+        assert not backend.written.wait(0.05)
+        persistence.set_field(5, 'score', (3, ))
+        assert backend.written.wait(5.0)
+        assert backend.batches == [
+            ([(5, 'Player')], {(5, 'name'): ("Alice", ),
+                               (5, 'score'): (3, )}),
+        ]
+    finally:
+        persistence.shutdown()
+    assert not persistence.thread.is_alive()
+
+
+class Player(DClass):
+    dfield_name = ((field_types.STRING, ), fp.CLIENT_SEND|fp.PERSIST)
+    dfield_position = ((field_types.FLOAT, field_types.FLOAT),
+                       fp.CLIENT_SEND|fp.RAM)
+    dfield_score = ((field_types.DOBJECT_ID, ), fp.CLIENT_SEND|fp.PERSIST)
+
+
+class NullMessageDirector:
+    def create_message(self, *message):
+        pass
+
+    def create_multicast_message(self, *message):
+        pass
+
+
+def test_dobjects_are_reloaded(tmp_path):
+    path = str(tmp_path / 'state.db')
+    state_server = StateServer(
+        dict(Player=Player),
+        persistence=WriteBehind(SQLitePersistence(path), flush_interval=3600),
+    )
+    state_server.message_director = NullMessageDirector()
+    dobject_id = state_server.id_gen.get_new()
+    state_server.create_dobject(dobject_id, 0,
+                                [("Bob", ), (1.0, 2.0), (0, )])
+    state_server.set_field(0, dobject_id, 2, (7, ))
+    state_server.set_field(0, dobject_id, 1, (3.0, 4.0))
+    state_server.shutdown()
+
+    state_server = StateServer(
+        dict(Player=Player),
+        persistence=WriteBehind(SQLitePersistence(path), flush_interval=3600),
+    )
+    try:
+        dobject = state_server.dobjects[dobject_id]
+        # The RAM field is back at its default.
+        assert dobject.storage == [("Bob", ), (0.0, 0.0), (7, )]
+        assert state_server.id_gen.get_new() == dobject_id + 1
+    finally:
+        state_server.shutdown()
+
+
+def test_journal_replay_leaves_persisted_fields_alone(tmp_path):
+    path = str(tmp_path / 'state.db')
+
+    def start_state_server():
+        state_server = StateServer(
+            dict(Player=Player),
+            persistence=WriteBehind(SQLitePersistence(path),
+                                    flush_interval=3600),
+            journal=StateJournal(str(tmp_path / 'journal'),
+                                 snapshot_interval=None),
+        )
+        state_server.message_director = NullMessageDirector()
+        return state_server
+
+    state_server = start_state_server()
+    dobject_id = state_server.id_gen.get_new()
+    state_server.create_dobject(dobject_id, 0,
+                                [("Bob", ), (1.0, 2.0), (0, )])
+    state_server.set_field(0, dobject_id, 2, (99, ))
+    state_server.set_field(0, dobject_id, 1, (3.0, 4.0))
+    state_server.shutdown()
+
+    state_server = start_state_server()
+    try:
+        dobject = state_server.dobjects[dobject_id]
+        # The journal restores the RAM field too.
+        assert dobject.storage == [("Bob", ), (3.0, 4.0), (99, )]
+        assert state_server.id_gen.get_new() == dobject_id + 1
+    finally:
+        state_server.shutdown()
+
+    persistence = SQLitePersistence(path)
+    try:
+        assert list(persistence.load()) == [
+            (dobject_id, 'Player', {'name': ("Bob", ), 'score': (99, )}),
+        ]
+    finally:
+        persistence.close()
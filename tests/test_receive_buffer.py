@@ -0,0 +1,41 @@
+import socket
+
+from pandamonium.util import ReceiveBuffer
+
+
+def test_receive_and_consume():
+    sender, receiver = socket.socketpair()
+    receive_buffer = ReceiveBuffer(size=8)
+    sender.send(b'foobar')
+    assert receive_buffer.recv_from(receiver) == 6
+    with receive_buffer.view() as view:
+        assert bytes(view[receive_buffer.start:]) == b'foobar'
+    receive_buffer.consume(3)
+    assert len(receive_buffer) == 3
+    receive_buffer.consume(6)
+    assert len(receive_buffer) == 0
+    assert receive_buffer.start == 0
+
+
+def test_compaction():
+    sender, receiver = socket.socketpair()
+    receive_buffer = ReceiveBuffer(size=8)
+    sender.send(b'abcdefgh')
+    receive_buffer.recv_from(receiver)
+    receive_buffer.consume(6)
+    sender.send(b'ij')
+    receive_buffer.recv_from(receiver)
+    assert len(receive_buffer.buffer) == 8
+    with receive_buffer.view() as view:
+        assert bytes(view[receive_buffer.start:]) == b'ghij'
+
+
+def test_growth():
+    sender, receiver = socket.socketpair()
+    receive_buffer = ReceiveBuffer(size=8)
+    sender.send(b'abcdefghij')
+    receive_buffer.recv_from(receiver)
+    receive_buffer.recv_from(receiver)
+    assert len(receive_buffer.buffer) == 16
+    with receive_buffer.view() as view:
+        assert bytes(view[receive_buffer.start:]) == b'abcdefghij'
@@ -1,3 +1,8 @@
+from threading import Thread
+
+from pandamonium.constants import field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.dobject import DClass
 from pandamonium.state_server import SimpleStateKeeper as SimpleStateKeeperBase
 
 
@@ -124,5 +129,175 @@ def test_remove_presence_from_full_zone():
 
 
 
+class DemoDClass(DClass):
+    pass
+
+
+def test_interest_in_several_zones():
+    client = 0
+    dobject = 0
+    sk = SimpleStateKeeper(dict(DemoDClass=DemoDClass))
+    sk.create_dobject(dobject, 0, [])
+    sk.add_presence(dobject, 1)
+    sk.add_presence(dobject, 2)
+
+    assert sk.set_interest(client, 1) == [dobject]
+    assert sk.set_interest(client, 2) == []
+    assert sk._dobject_seen_by(sk.dobjects[dobject]) == {client}
+    assert sk.unset_interest(client, 1) == []
+    assert sk._dobject_seen_by(sk.dobjects[dobject]) == {client}
+    assert sk.unset_interest(client, 2) == [dobject]
+    assert sk._dobject_seen_by(sk.dobjects[dobject]) == set()
+
+
+def test_presence_in_several_zones():
+    client_a = 0
+    client_b = 1
+    dobject = 0
+    sk = SimpleStateKeeper(dict(DemoDClass=DemoDClass))
+    sk.create_dobject(dobject, 0, [])
+    sk.set_interest(client_a, 1)
+    sk.set_interest(client_a, 2)
+    sk.set_interest(client_b, 2)
+
+    assert sk.add_presence(dobject, 1) == {client_a}
+    assert sk.add_presence(dobject, 2) == {client_b}
+    assert sk._dobject_seen_by(sk.dobjects[dobject]) == {client_a, client_b}
+    assert sk.remove_presence(dobject, 2) == {client_b}
+    assert sk._dobject_seen_by(sk.dobjects[dobject]) == {client_a}
+    assert sk.remove_presence(dobject, 1) == {client_a}
+    assert sk._dobject_seen_by(sk.dobjects[dobject]) == set()
+
+
+class MovingDClass(DClass):
+    dfield_position = ((float, float), fp.CLIENT_SEND|fp.CLIENT_RECEIVE)
+
+
+class CountingMessageDirector:
+    def __init__(self):
+        self.updates = 0
+
+    def create_message(self, *message):
+        pass
+
+    def create_multicast_message(self, from_channel, to_channels, *message):
+        self.updates += len(to_channels)
+
+
+class ShardedStateKeeper(SimpleStateKeeper):
+    shard_count = 16
+
+
+def test_locked_shards_are_acquired_in_order():
+    sk = ShardedStateKeeper(dict(MovingDClass=MovingDClass))
+    with sk._locked_shards([5, 3, 5 + sk.shard_count]):
+        assert sk.shard_locks[3].locked()
+        assert sk.shard_locks[5].locked()
+        assert not sk.shard_locks[4].locked()
+    assert not any(lock.locked() for lock in sk.shard_locks)
+
+
+def test_concurrent_field_updates_and_interest():
+    num_dobjects = 32
+    num_updates = 200
+    sk = ShardedStateKeeper(dict(MovingDClass=MovingDClass))
+    sk.message_director = CountingMessageDirector()
+    for dobject in range(num_dobjects):
+        sk.create_dobject(dobject, 0, [])
+        sk.add_presence(dobject, dobject % 4)
+    for zone in range(4):
+        sk.set_interest(0, zone)
+
+    def update(dobjects):
+        for _ in range(num_updates):
+            for dobject in dobjects:
+                sk.set_field(0, dobject, 0, (1.0, 2.0))
+
+    def churn_interest():
+        for _ in range(num_updates):
+            sk.set_interest(1, 0)
+            sk.unset_interest(1, 0)
+
+    threads = [Thread(target=update, args=(range(n, num_dobjects, 4), ))
+               for n in range(4)]
+    threads.append(Thread(target=churn_interest))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+    # Recipient 0 sees everything throughout, recipient 1 only sometimes.
+    assert sk.message_director.updates >= num_dobjects * num_updates
+    assert sk._dobject_seen_by(sk.dobjects[0]) == {0}
+
+
+
+class SteeredDClass(DClass):
+    dfield_name = ((str, ), fp.CLIENT_SEND|fp.CLIENT_RECEIVE)
+    dfield_position = ((float, float),
+                       fp.CLIENT_SEND|fp.CLIENT_RECEIVE|fp.UNRELIABLE)
+
+
+class RecordingMessageDirector:
+    def __init__(self):
+        self.updates = []
+
+    def create_message(self, *message):
+        pass
+
+    def create_multicast_message(self, from_channel, to_channels, *message):
+        self.updates.append((sorted(to_channels), ) + message)
+
+
+class CoalescingStateKeeper(SimpleStateKeeper):
+    coalesce_interval = 3600
+
+
+def test_unreliable_updates_are_coalesced():
+    sk = CoalescingStateKeeper(dict(SteeredDClass=SteeredDClass))
+    try:
+        sk.message_director = RecordingMessageDirector()
+        sk.create_dobject(5, 0, [])
+        sk.add_presence(5, 0)
+        sk.set_interest(0, 0)
+        sk.set_field(0, 5, 1, (1.0, 1.0))
+        sk.set_field(0, 5, 0, ("Bob", ))
+        sk.set_field(0, 5, 1, (2.0, 2.0))
+        # Reliable fields go out right away.
+        assert sk.message_director.updates == [
+            ([0], msgtypes.FIELD_UPDATE, 5, 0, ("Bob", )),
+        ]
+        sk.set_interest(1, 0)
+        sk.flush_coalesced_updates()
+        assert sk.message_director.updates[1:] == [
+            ([0, 1], msgtypes.FIELD_UPDATE, 5, 1, (2.0, 2.0)),
+        ]
+        sk.flush_coalesced_updates()
+        assert len(sk.message_director.updates) == 2
+    finally:
+        sk.shutdown()
+        assert not sk.coalescing_thread.is_alive()
+
 
 # TODO: Test complex x-seen-by-y relations
+
+
+class NamedDClass(DClass):
+    dfield_name = ((field_types.STRING, ), fp.CLIENT_SEND|fp.RAM)
+
+
+class ViewingStateKeeper(SimpleStateKeeperBase):
+    individual_channel = 100
+
+
+def test_late_joiners_see_current_fields():
+    sk = ViewingStateKeeper(dict(NamedDClass=NamedDClass))
+    sk.message_director = RecordingMessageDirector()
+    sk.create_dobject(5, 0, [("Bob", )])
+    sk.add_presence(5, 0)
+    sk.set_field(0, 5, 0, ("Robert", ))
+    assert sk.get_dobject_fields(5) == [("Robert", )]
+    sk.set_interest(1, 0)
+    assert sk.message_director.updates[-1] == (
+        [1], msgtypes.CREATE_DOBJECT_VIEW, 5, 0, [("Robert", )],
+    )
@@ -0,0 +1,174 @@
+import multiprocessing
+import time
+
+from pandamonium.base import BaseComponent
+from pandamonium.constants import channels, field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.core import MessageDirector, StateServerAgent
+from pandamonium.dobject import DClass
+from pandamonium.packers import AIPacker
+from pandamonium.sockets import (
+    AsyncNetworkStateServerListener,
+    NetworkStateServerConnector,
+)
+from pandamonium.state_server import StateServer
+
+
+class Thing(DClass):
+    dfield_value = ((field_types.CHANNEL, ),
+                    fp.CLIENT_SEND|fp.CLIENT_RECEIVE|fp.RAM)
+
+
+dclasses = {'Thing': Thing}
+
+
+class DemoStateServerAgent(AIPacker, StateServerAgent,
+                           AsyncNetworkStateServerListener):
+    dclasses = dclasses
+    port = 0
+
+
+class DemoStateServerConnector(AIPacker, NetworkStateServerConnector):
+    dclasses = dclasses
+
+
+def run_state_server(port):
+    connector = DemoStateServerConnector(StateServer(dclasses), port=port)
+    connector.connect()
+    connector.serve_forever()
+
+
+class RecordingComponent(BaseComponent):
+    def __init__(self, channel):
+        self.all_connections = channel
+        self.messages = []
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        self.messages.append((from_channel, to_channel, message_type) + args)
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_messages_are_routed_to_owning_state_server():
+    ai = 1000
+    state_server = RecordingComponent(channels.ALL_STATE_SERVERS)
+    md = MessageDirector(
+        state_server=state_server,
+        client_agent=RecordingComponent(channels.ALL_CLIENTS),
+        ai_agent=RecordingComponent(channels.ALL_AIS),
+    )
+    first = RecordingComponent(100)
+    second = RecordingComponent(101)
+    first.set_message_director(md)
+    second.set_message_director(md)
+
+    md.create_message(ai, channels.ALL_STATE_SERVERS, msgtypes.SET_FIELD,
+                      1000005, 0, (23, ))
+    md.create_message(ai, channels.ALL_STATE_SERVERS, msgtypes.SET_OWNER,
+                      ai, 5)
+    assert first.messages == [(ai, 100, msgtypes.SET_OWNER, ai, 5)]
+    assert second.messages == [(ai, 101, msgtypes.SET_FIELD, 1000005, 0,
+                                (23, ))]
+    assert state_server.messages == []
+
+    for token in range(3):
+        md.create_message(ai, channels.ALL_STATE_SERVERS,
+                          msgtypes.CREATE_DOBJECT, 0, [], token)
+    creations = first.messages[1:] + second.messages[1:]
+    assert sorted(message[-1] for message in creations) == [0, 1, 2]
+    assert len(first.messages) != len(second.messages)
+
+    md.create_message(ai, channels.ALL_STATE_SERVERS, msgtypes.SET_INTEREST,
+                      ai, 5)
+    assert state_server.messages == [
+        (ai, channels.ALL_STATE_SERVERS, msgtypes.SET_INTEREST, ai, 5),
+    ]
+
+
+def test_messages_for_unowned_dobjects_are_dropped(caplog):
+    ai = 1000
+    md = MessageDirector(
+        state_server=RecordingComponent(channels.ALL_STATE_SERVERS),
+        client_agent=RecordingComponent(channels.ALL_CLIENTS),
+        ai_agent=RecordingComponent(channels.ALL_AIS),
+    )
+    first = RecordingComponent(100)
+    first.set_message_director(md)
+
+    # Beyond the owned ID blocks, or in the channel ranges of other
+    # components
+    for dobject_id in (5000000, 2000000000, -1):
+        md.create_message(ai, channels.ALL_STATE_SERVERS, msgtypes.SET_FIELD,
+                          dobject_id, 0, (23, ))
+    md.create_message(ai, 5555, msgtypes.SET_FIELD, 5, 0, (23, ))
+    assert first.messages == []
+    dropped = [record.getMessage() for record in caplog.records
+               if record.levelname == 'WARNING']
+    assert len(dropped) == 4
+    assert "channel 5555" in dropped[-1]
+
+
+def test_state_server_processes():
+    ai = 1000
+    client = 100000
+    zone = 5
+    agent = DemoStateServerAgent()
+    ai_agent = RecordingComponent(channels.ALL_AIS)
+    client_agent = RecordingComponent(channels.ALL_CLIENTS)
+    md = MessageDirector(
+        state_server=agent,
+        client_agent=client_agent,
+        ai_agent=ai_agent,
+    )
+    md.subscribe_to_channel(ai, ai_agent)
+    md.subscribe_to_channel(client, client_agent)
+    agent.listen()
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_state_server,
+                                 args=(agent.get_port(), ))
+                 for _ in range(2)]
+    try:
+        for process in processes:
+            process.start()
+        wait_for(lambda: md.state_server_channels == (100, 101))
+
+        for token in range(2):
+            md.create_message(ai, channels.ALL_STATE_SERVERS,
+                              msgtypes.CREATE_DOBJECT, 0, [(7, )], token)
+        wait_for(lambda: len(ai_agent.messages) == 2)
+        assert sorted(ai_agent.messages) == [
+            (100, ai, msgtypes.DOBJECT_CREATED, 0, 0),
+            (101, ai, msgtypes.DOBJECT_CREATED, 1000000, 1),
+        ]
+
+        md.create_message(ai, channels.ALL_STATE_SERVERS,
+                          msgtypes.SET_INTEREST, client, zone)
+        for dobject_id in [0, 1000000]:
+            md.create_message(ai, channels.ALL_STATE_SERVERS,
+                              msgtypes.ADD_TO_ZONE, dobject_id, zone)
+        wait_for(lambda: len(client_agent.messages) == 2)
+        assert sorted(client_agent.messages) == [
+            (100, client, msgtypes.CREATE_DOBJECT_VIEW, 0, 0, [(7, )]),
+            (101, client, msgtypes.CREATE_DOBJECT_VIEW, 1000000, 0, [(7, )]),
+        ]
+
+        md.create_message(client, channels.ALL_STATE_SERVERS,
+                          msgtypes.SET_FIELD, 1000000, 0, (9, ))
+        wait_for(lambda: len(client_agent.messages) == 3)
+        assert client_agent.messages[2] == (
+            client, client, msgtypes.FIELD_UPDATE, 1000000, 0, (9, ),
+        )
+        # Had the other state server gotten the update, too, it would have
+        # failed on the unknown dobject.
+        assert all(process.is_alive() for process in processes)
+    finally:
+        agent.shutdown()
+        for process in processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
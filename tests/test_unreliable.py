@@ -0,0 +1,143 @@
+import time
+
+from pandamonium.base import BaseComponent
+from pandamonium.constants import channels, field_types, msgtypes
+from pandamonium.constants import field_policies as fp
+from pandamonium.core import ClientAgent, MessageDirector
+from pandamonium.dobject import DClass
+from pandamonium.packers import ClientPacker, sequence_header_codec
+from pandamonium.sockets import (
+    AsyncNetworkClientListener,
+    NetworkClientConnector,
+)
+from pandamonium.util import sequence_newer
+
+
+class Mover(DClass):
+    dfield_name = ((field_types.CHANNEL, ), fp.AI_SEND|fp.CLIENT_RECEIVE)
+    dfield_position = ((field_types.FLOAT, field_types.FLOAT),
+                       fp.AI_SEND|fp.CLIENT_RECEIVE|fp.UNRELIABLE)
+
+
+dclasses = {'Mover': Mover}
+NAME = 0
+POSITION = 1
+
+
+class DemoClientAgent(ClientPacker, ClientAgent, AsyncNetworkClientListener):
+    interface = '127.0.0.1'
+    dclasses = dclasses
+    port = 0
+    udp_port = 0
+
+
+class DemoClientRepository(ClientPacker, NetworkClientConnector):
+    dclasses = dclasses
+    queue_incoming = True
+
+    def __init__(self, host, port):
+        NetworkClientConnector.__init__(self, host=host, port=port)
+        self.messages = []
+
+    def handle_message(self, message_type, *args):
+        self.messages.append([message_type, *args])
+
+
+class RecordingComponent(BaseComponent):
+    def __init__(self, channel):
+        self.all_connections = channel
+
+    def handle_message(self, from_channel, to_channel, message_type, *args):
+        pass
+
+
+def pump_until(repository, condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        repository.pump()
+        time.sleep(0.001)
+
+
+def test_sequence_newer():
+    assert sequence_newer(2, 1)
+    assert not sequence_newer(1, 2)
+    assert not sequence_newer(1, 1)
+    assert sequence_newer(0, 2**32 - 1)
+    assert not sequence_newer(2**32 - 1, 0)
+
+
+def test_older_updates_are_dropped():
+    repository = DemoClientRepository('127.0.0.1', 0)
+    repository.dclasses_by_dobject_id[5] = 0
+    packer = ClientPacker()
+    packer.dclasses_by_id = repository.dclasses_by_id
+    packer.dclasses_by_dobject_id = {5: 0}
+    packer.dclasses_lock = repository.dclasses_lock
+
+    def datagram(sequence, x):
+        return b''.join([
+            sequence_header_codec.pack((sequence, )),
+            packer.pack_message(msgtypes.FIELD_UPDATE, 5, POSITION, (x, 0.0)),
+        ])
+
+    repository._handle_unreliable_datagram(datagram(2, 2.0))
+    repository._handle_unreliable_datagram(datagram(1, 1.0))
+    repository._handle_unreliable_datagram(datagram(3, 3.0))
+    assert [message[3][0] for message in repository.inbound] == [2.0, 3.0]
+
+
+def test_updates_of_destroyed_views_are_dropped():
+    repository = DemoClientRepository('127.0.0.1', 0)
+    repository.dclasses_by_dobject_id.update({5: 0, 6: 0})
+    packer = ClientPacker()
+    packer.dclasses_by_id = repository.dclasses_by_id
+    packer.dclasses_by_dobject_id = {5: 0, 6: 0}
+    packer.dclasses_lock = repository.dclasses_lock
+
+    repository.resolve_message([msgtypes.DESTROY_DOBJECT_VIEW, 5])
+    repository._handle_unreliable_datagram(b''.join([
+        sequence_header_codec.pack((1, )),
+        packer.pack_message(msgtypes.FIELD_UPDATE, 5, POSITION, (1.0, 0.0)),
+        packer.pack_message(msgtypes.FIELD_UPDATE, 6, POSITION, (2.0, 0.0)),
+    ]))
+    assert list(repository.inbound) == [
+        [msgtypes.FIELD_UPDATE, 6, POSITION, (2.0, 0.0)],
+    ]
+
+
+def test_unreliable_fields_use_udp():
+    client_agent = DemoClientAgent()
+    md = MessageDirector(
+        state_server=RecordingComponent(channels.ALL_STATE_SERVERS),
+        client_agent=client_agent,
+        ai_agent=RecordingComponent(channels.ALL_AIS),
+    )
+    client_agent.listen()
+    repository = DemoClientRepository('127.0.0.1', client_agent.get_port())
+    try:
+        repository.connect()
+        pump_until(repository, lambda: repository.udp_confirmed)
+        assert repository.messages == [[msgtypes.CONNECTED]]
+        (client_id, connection), = client_agent.connections.items()
+        assert connection.udp_address is not None
+
+        md.create_message(17, client_id, msgtypes.CREATE_DOBJECT_VIEW,
+                          5, 0, [])
+        pump_until(repository, lambda: len(repository.messages) == 2)
+        md.create_multicast_message(1000, [client_id], msgtypes.FIELD_UPDATE,
+                                    5, NAME, (23, ))
+        md.create_message(1000, client_id, msgtypes.FIELD_UPDATE,
+                          5, POSITION, (1.0, 2.0))
+        pump_until(repository, lambda: len(repository.messages) == 4)
+        # The streams are not ordered relative to each other.
+        updates = sorted(repository.messages[2:], key=lambda m: m[2])
+        assert updates == [
+            [msgtypes.FIELD_UPDATE, 5, NAME, (23, )],
+            [msgtypes.FIELD_UPDATE, 5, POSITION, (1.0, 2.0)],
+        ]
+        # Only the position came over UDP.
+        assert list(repository.udp_sequences) == [(5, POSITION)]
+    finally:
+        repository.socket.close()
+        client_agent.shutdown()